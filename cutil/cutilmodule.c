@@ -14,8 +14,8 @@
 #define EPSILON 0.00001
 
 // https://en.wikibooks.org/wiki/Algorithm_Implementation/Strings/Levenshtein_distance#C
-static int ed(const Py_UNICODE* s1, const Py_UNICODE* s2, unsigned int s1len,
-              unsigned int s2len) {
+static int ed_dp(const Py_UCS4* s1, const Py_UCS4* s2, unsigned int s1len,
+                 unsigned int s2len) {
   unsigned int x, y, lastdiag, olddiag;
   unsigned int column[s1len + 1];
 
@@ -36,55 +36,229 @@ static int ed(const Py_UNICODE* s1, const Py_UNICODE* s2, unsigned int s1len,
   return (column[s1len]);
 }
 
-static int ped(const Py_UNICODE* s1, const Py_UNICODE* s2, unsigned int s1len,
-               unsigned int s2len) {
-  unsigned int x, y;
-  unsigned int matrix[s2len + 1][s1len + 1];
+// Levenshtein distance by Myers' bit-parallel algorithm, in the formulation
+// of Hyyrö and the block-based one of Myers for patterns longer than a word.
+// The pattern p is encoded into match vectors Peq (bit i of Peq[c] is set if
+// p[i] == c), the text t is then scanned one character at a time with O(m/64)
+// word operations each.
+
+#define ED_WORD 64
+#define ED_HIGH_BIT ((uint64_t)1 << (ED_WORD - 1))
+#define PEQ_EMPTY ((Py_UCS4)-1)
+
+// Slot of code point c in the open addressing table keys of size mask + 1,
+// which is either the slot holding c or the empty slot where c belongs
+static inline Py_ssize_t peq_slot(const Py_UCS4* keys, Py_ssize_t mask,
+                                  Py_UCS4 c) {
+  Py_ssize_t i = (Py_ssize_t)((c * 2654435761u) & mask);
+  while (keys[i] != c && keys[i] != PEQ_EMPTY) i = (i + 1) & mask;
+  return i;
+}
 
-  if (s1len == 0 && s2len == 0) return 0;
+// Pattern of at most ED_WORD characters, Peq is kept per table slot
+static int ed_myers(const Py_UCS4* p, unsigned int m, const Py_UCS4* t,
+                    unsigned int n) {
+  Py_UCS4 keys[2 * ED_WORD];
+  uint64_t peq[2 * ED_WORD];
+  memset(keys, 0xFF, sizeof(keys));
+  memset(peq, 0, sizeof(peq));
+
+  for (unsigned int i = 0; i < m; i++) {
+    Py_ssize_t s = peq_slot(keys, 2 * ED_WORD - 1, p[i]);
+    keys[s] = p[i];
+    peq[s] |= (uint64_t)1 << i;
+  }
 
-  matrix[0][0] = 0;
-  for (x = 1; x <= s2len; x++) matrix[x][0] = matrix[x - 1][0] + 1;
-  for (y = 1; y <= s1len; y++) matrix[0][y] = matrix[0][y - 1] + 1;
-  for (x = 1; x <= s2len; x++)
-    for (y = 1; y <= s1len; y++)
-      matrix[x][y] =
-          MIN3(matrix[x - 1][y] + 1, matrix[x][y - 1] + 1,
-               matrix[x - 1][y - 1] + (s1[y - 1] == s2[x - 1] ? 0 : 1));
-
-  unsigned int min = s1len;
-  for (unsigned int i = 0; i <= s2len; i++) {
-    if (matrix[i][s1len] < min) min = matrix[i][s1len];
+  uint64_t pv = ~(uint64_t)0;
+  uint64_t mv = 0;
+  uint64_t last = (uint64_t)1 << (m - 1);
+  int score = m;
+
+  for (unsigned int j = 0; j < n; j++) {
+    // characters not in the pattern hit an empty slot with Peq 0
+    uint64_t eq = peq[peq_slot(keys, 2 * ED_WORD - 1, t[j])];
+    uint64_t xv = eq | mv;
+    uint64_t xh = (((eq & pv) + pv) ^ pv) | eq;
+    uint64_t ph = mv | ~(xh | pv);
+    uint64_t mh = pv & xh;
+
+    if (ph & last)
+      score++;
+    else if (mh & last)
+      score--;
+
+    ph = (ph << 1) | 1;
+    mh <<= 1;
+    pv = mh | ~(xv | ph);
+    mv = ph & xv;
   }
 
-  return min;
+  return score;
 }
 
-static int sed(const Py_UNICODE* s1, const Py_UNICODE* s2, unsigned int s1len,
-               unsigned int s2len) {
-  unsigned int x, y;
-  unsigned int matrix[s2len + 1][s1len + 1];
+// Pattern of any length, split into blocks of ED_WORD characters which pass
+// their horizontal delta on to the next block. Returns -1 if out of memory.
+static int ed_myers_blocked(const Py_UCS4* p, unsigned int m,
+                            const Py_UCS4* t, unsigned int n) {
+  Py_ssize_t nb = (m + ED_WORD - 1) / ED_WORD;
+  Py_ssize_t slots = 2 * ED_WORD;
+  while (slots < 2 * (Py_ssize_t)m) slots *= 2;
+
+  Py_UCS4* keys = malloc(slots * sizeof(Py_UCS4));
+  Py_ssize_t* rows = malloc(slots * sizeof(Py_ssize_t));
+  // one row of nb words per distinct pattern character, plus a zero row
+  // for all other characters
+  uint64_t* peq = calloc((m + 1) * nb, sizeof(uint64_t));
+  uint64_t* pvs = malloc(nb * sizeof(uint64_t));
+  uint64_t* mvs = malloc(nb * sizeof(uint64_t));
+  int score = -1;
+
+  if (keys && rows && peq && pvs && mvs) {
+    memset(keys, 0xFF, slots * sizeof(Py_UCS4));
+
+    Py_ssize_t k = 0;
+    for (unsigned int i = 0; i < m; i++) {
+      Py_ssize_t s = peq_slot(keys, slots - 1, p[i]);
+      if (keys[s] == PEQ_EMPTY) {
+        keys[s] = p[i];
+        rows[s] = k++;
+      }
+      peq[rows[s] * nb + i / ED_WORD] |= (uint64_t)1 << (i % ED_WORD);
+    }
 
-  if (s1len == 0 && s2len == 0) return 0;
+    for (Py_ssize_t b = 0; b < nb; b++) {
+      pvs[b] = ~(uint64_t)0;
+      mvs[b] = 0;
+    }
 
-  matrix[0][0] = 0;
-  for (x = 1; x <= s2len; x++) matrix[x][0] = matrix[x - 1][0] + 1;
-  for (y = 1; y <= s1len; y++) matrix[0][y] = matrix[0][y - 1] + 1;
-  for (x = 1; x <= s2len; x++)
-    for (y = 1; y <= s1len; y++)
-      matrix[x][y] =
-          MIN3(matrix[x - 1][y] + 1, matrix[x][y - 1] + 1,
-               matrix[x - 1][y - 1] + (s1[s1len - y] == s2[s2len - x] ? 0 : 1));
-
-  unsigned int min = s1len;
-  for (unsigned int i = 0; i <= s2len; i++) {
-    if (matrix[i][s1len] < min) min = matrix[i][s1len];
+    uint64_t last = (uint64_t)1 << ((m - 1) % ED_WORD);
+    score = m;
+
+    for (unsigned int j = 0; j < n; j++) {
+      Py_ssize_t s = peq_slot(keys, slots - 1, t[j]);
+      const uint64_t* eqs = peq + (keys[s] == PEQ_EMPTY ? k : rows[s]) * nb;
+
+      // the first row of the DP matrix increases by one in each column
+      int hin = 1;
+      for (Py_ssize_t b = 0; b < nb; b++) {
+        uint64_t eq = eqs[b];
+        uint64_t pv = pvs[b];
+        uint64_t mv = mvs[b];
+        uint64_t xv = eq | mv;
+        if (hin < 0) eq |= 1;
+        uint64_t xh = (((eq & pv) + pv) ^ pv) | eq;
+        uint64_t ph = mv | ~(xh | pv);
+        uint64_t mh = pv & xh;
+
+        uint64_t high = b == nb - 1 ? last : ED_HIGH_BIT;
+        int hout = (ph & high) ? 1 : ((mh & high) ? -1 : 0);
+
+        ph <<= 1;
+        mh <<= 1;
+        if (hin < 0)
+          mh |= 1;
+        else if (hin > 0)
+          ph |= 1;
+
+        pvs[b] = mh | ~(xv | ph);
+        mvs[b] = ph & xv;
+        hin = hout;
+      }
+
+      score += hin;
+    }
   }
 
-  return min;
+  free(keys);
+  free(rows);
+  free(peq);
+  free(pvs);
+  free(mvs);
+  return score;
 }
 
-static double jaro(const Py_UNICODE* s1, const Py_UNICODE* s2, int s1len,
+static int ed(const Py_UCS4* s1, const Py_UCS4* s2, unsigned int s1len,
+              unsigned int s2len) {
+  if (s1len == 0) return s2len;
+  if (s2len == 0) return s1len;
+
+  // the distance is symmetric, use the shorter string as the pattern
+  if (s1len > s2len) return ed(s2, s1, s2len, s1len);
+
+  if (s1len <= ED_WORD) return ed_myers(s1, s1len, s2, s2len);
+
+  int d = ed_myers_blocked(s1, s1len, s2, s2len);
+  if (d < 0) d = ed_dp(s1, s2, s1len, s2len);
+  return d;
+}
+
+// Edit distance of s1 and s2 together with the prefix edit distance of s1 to
+// s2 and of s2 to s1. All three are read off the same DP matrix: the corner,
+// the minimum of the last column and the minimum of the last row. The matrix
+// is computed one column at a time in linear memory. With rev, the strings
+// are compared from their ends, which gives the suffix edit distances.
+// Writes d[0] = ed, d[1] = ped(s1, s2), d[2] = ped(s2, s1), returns 0 if out
+// of memory.
+static int affix_eds(const Py_UCS4* s1, const Py_UCS4* s2, unsigned int s1len,
+                     unsigned int s2len, int rev, unsigned int* d) {
+  unsigned int x, y, lastdiag, olddiag;
+  unsigned int* column = malloc((s1len + 1) * sizeof(unsigned int) +
+                                (rev ? (s1len + s2len) * sizeof(Py_UCS4) : 0));
+  if (!column) return 0;
+
+  if (rev) {
+    Py_UCS4* r1 = (Py_UCS4*)(column + s1len + 1);
+    Py_UCS4* r2 = r1 + s1len;
+    for (y = 0; y < s1len; y++) r1[y] = s1[s1len - 1 - y];
+    for (x = 0; x < s2len; x++) r2[x] = s2[s2len - 1 - x];
+    s1 = r1;
+    s2 = r2;
+  }
+
+  for (y = 0; y <= s1len; y++) column[y] = y;
+
+  unsigned int fw = s1len;
+
+  for (x = 1; x <= s2len; x++) {
+    column[0] = x;
+    for (y = 1, lastdiag = x - 1; y <= s1len; y++) {
+      olddiag = column[y];
+      column[y] = MIN3(column[y] + 1, column[y - 1] + 1,
+                       lastdiag + (s1[y - 1] == s2[x - 1] ? 0 : 1));
+      lastdiag = olddiag;
+    }
+    if (column[s1len] < fw) fw = column[s1len];
+  }
+
+  unsigned int bw = column[0];
+  for (y = 1; y <= s1len; y++)
+    if (column[y] < bw) bw = column[y];
+
+  d[0] = column[s1len];
+  d[1] = fw;
+  d[2] = bw;
+
+  free(column);
+  return 1;
+}
+
+// Prefix edit distance of s1 to s2, -1 if out of memory
+static int ped(const Py_UCS4* s1, const Py_UCS4* s2, unsigned int s1len,
+               unsigned int s2len) {
+  unsigned int d[3];
+  if (!affix_eds(s1, s2, s1len, s2len, 0, d)) return -1;
+  return d[1];
+}
+
+// Suffix edit distance of s1 to s2, -1 if out of memory
+static int sed(const Py_UCS4* s1, const Py_UCS4* s2, unsigned int s1len,
+               unsigned int s2len) {
+  unsigned int d[3];
+  if (!affix_eds(s1, s2, s1len, s2len, 1, d)) return -1;
+  return d[1];
+}
+
+static double jaro(const Py_UCS4* s1, const Py_UCS4* s2, int s1len,
                    int s2len) {
   // based on https://rosettacode.org/wiki/Jaro_distance
   if (s1len == 0) return s2len == 0 ? 1.0 : 0.0;
@@ -151,6 +325,76 @@ static double jaro(const Py_UNICODE* s1, const Py_UNICODE* s2, int s1len,
          3.0;
 }
 
+static double jaro_winkler(const Py_UCS4* s1, const Py_UCS4* s2, int s1len,
+                           int s2len) {
+  // length of the common prefix, up to 4
+  int k = 0;
+  while (k < MIN(MIN(s1len, s2len), 4) && s1[k] == s2[k]) k++;
+
+  double j = jaro(s1, s2, s1len, s2len);
+
+  // p is usually set to 0.1
+  return j + k * 0.1 * (1 - j);
+}
+
+// string similarities computed by the batch kernels, SIMI_PREFIX and
+// SIMI_SUFFIX give three similarities per pair, see affix_eds()
+enum {
+  SIMI_ED,
+  SIMI_PED,
+  SIMI_SED,
+  SIMI_JARO,
+  SIMI_JARO_WINKLER,
+  SIMI_PREFIX,
+  SIMI_SUFFIX
+};
+
+static int simi_cols(int metric) {
+  return metric == SIMI_PREFIX || metric == SIMI_SUFFIX ? 3 : 1;
+}
+
+// Edit distance d normalized to a similarity in [0, 1] by length len
+static double ed_simi(unsigned int d, unsigned int len) {
+  if (len == 0) return 1.0;
+  return 1.0 - (double)d / len;
+}
+
+// Write the simi_cols(metric) similarities in [0, 1] between s1 and s2 to
+// out, returns 0 if out of memory. The edit distances are normalized like in
+// the FeatureBuilder, by the longer string for ed and by the first string for
+// ped and sed. SIMI_PREFIX gives the ed, ped(s1, s2) and ped(s2, s1)
+// similarities, SIMI_SUFFIX the ed, sed(s1, s2) and sed(s2, s1) ones.
+static int simi(int metric, const Py_UCS4* s1, const Py_UCS4* s2, int s1len,
+                int s2len, double* out) {
+  unsigned int d[3];
+  switch (metric) {
+    case SIMI_ED:
+      out[0] = ed_simi(ed(s1, s2, s1len, s2len), MAX(s1len, s2len));
+      return 1;
+    case SIMI_PED:
+    case SIMI_SED:
+    case SIMI_PREFIX:
+    case SIMI_SUFFIX:
+      if (!affix_eds(s1, s2, s1len, s2len,
+                     metric == SIMI_SED || metric == SIMI_SUFFIX, d))
+        return 0;
+      if (metric == SIMI_PED || metric == SIMI_SED) {
+        out[0] = ed_simi(d[1], s1len);
+      } else {
+        out[0] = ed_simi(d[0], MAX(s1len, s2len));
+        out[1] = ed_simi(d[1], s1len);
+        out[2] = ed_simi(d[2], s2len);
+      }
+      return 1;
+    case SIMI_JARO:
+      out[0] = jaro(s1, s2, s1len, s2len);
+      return 1;
+    default:
+      out[0] = jaro_winkler(s1, s2, s1len, s2len);
+      return 1;
+  }
+}
+
 double haversine(double lat1, double lng1, double lat2, double lng2) {
   lat1 *= DEG_RAD;
   lng1 *= DEG_RAD;
@@ -333,43 +577,77 @@ static PyObject* cutil_poly_contains_point(PyObject* self, PyObject* args) {
   return PyBool_FromLong(poly_contains_point(px, py, poly));
 }
 
+// Parse two str arguments into UCS4 copies, to be freed with PyMem_Free()
+static int parse_str_pair(PyObject* args, Py_UCS4** a, Py_ssize_t* alen,
+                          Py_UCS4** b, Py_ssize_t* blen) {
+  PyObject* str_a;
+  PyObject* str_b;
+  if (!PyArg_ParseTuple(args, "UU", &str_a, &str_b)) return 0;
+
+  *alen = PyUnicode_GET_LENGTH(str_a);
+  *blen = PyUnicode_GET_LENGTH(str_b);
+  *a = PyUnicode_AsUCS4Copy(str_a);
+  if (!*a) return 0;
+  *b = PyUnicode_AsUCS4Copy(str_b);
+  if (!*b) {
+    PyMem_Free(*a);
+    return 0;
+  }
+  return 1;
+}
+
 static PyObject* cutil_ped(PyObject* self, PyObject* args) {
-  Py_UNICODE* str_a;
-  Py_UNICODE* str_b;
+  Py_UCS4* str_a;
+  Py_UCS4* str_b;
   Py_ssize_t len_a, len_b;
 
-  if (!PyArg_ParseTuple(args, "u#u#", &str_a, &len_a, &str_b, &len_b)) return 0;
+  if (!parse_str_pair(args, &str_a, &len_a, &str_b, &len_b)) return 0;
 
-  return PyLong_FromLong(ped(str_a, str_b, len_a, len_b));
+  int d = ped(str_a, str_b, len_a, len_b);
+  PyObject* ret = d < 0 ? PyErr_NoMemory() : PyLong_FromLong(d);
+  PyMem_Free(str_a);
+  PyMem_Free(str_b);
+  return ret;
 }
 
 static PyObject* cutil_sed(PyObject* self, PyObject* args) {
-  Py_UNICODE* str_a;
-  Py_UNICODE* str_b;
+  Py_UCS4* str_a;
+  Py_UCS4* str_b;
   Py_ssize_t len_a, len_b;
 
-  if (!PyArg_ParseTuple(args, "u#u#", &str_a, &len_a, &str_b, &len_b)) return 0;
+  if (!parse_str_pair(args, &str_a, &len_a, &str_b, &len_b)) return 0;
 
-  return PyLong_FromLong(sed(str_a, str_b, len_a, len_b));
+  int d = sed(str_a, str_b, len_a, len_b);
+  PyObject* ret = d < 0 ? PyErr_NoMemory() : PyLong_FromLong(d);
+  PyMem_Free(str_a);
+  PyMem_Free(str_b);
+  return ret;
 }
 
 static PyObject* cutil_jaro(PyObject* self, PyObject* args) {
-  Py_UNICODE* str_a;
-  Py_UNICODE* str_b;
+  Py_UCS4* str_a;
+  Py_UCS4* str_b;
   Py_ssize_t len_a, len_b;
 
-  if (!PyArg_ParseTuple(args, "u#u#", &str_a, &len_a, &str_b, &len_b)) return 0;
+  if (!parse_str_pair(args, &str_a, &len_a, &str_b, &len_b)) return 0;
 
-  return PyFloat_FromDouble(jaro(str_a, str_b, len_a, len_b));
+  PyObject* ret = PyFloat_FromDouble(jaro(str_a, str_b, len_a, len_b));
+  PyMem_Free(str_a);
+  PyMem_Free(str_b);
+  return ret;
 }
 
 static PyObject* cutil_ed(PyObject* self, PyObject* args) {
-  Py_UNICODE* str_a;
-  Py_UNICODE* str_b;
+  Py_UCS4* str_a;
+  Py_UCS4* str_b;
   Py_ssize_t len_a, len_b;
 
-  if (!PyArg_ParseTuple(args, "u#u#", &str_a, &len_a, &str_b, &len_b)) return 0;
-  return PyLong_FromLong(ed(str_a, str_b, len_a, len_b));
+  if (!parse_str_pair(args, &str_a, &len_a, &str_b, &len_b)) return 0;
+
+  PyObject* ret = PyLong_FromLong(ed(str_a, str_b, len_a, len_b));
+  PyMem_Free(str_a);
+  PyMem_Free(str_b);
+  return ret;
 }
 
 static PyObject* cutil_haversine(PyObject* self, PyObject* args) {
@@ -433,6 +711,339 @@ static PyObject* cutil_centroid(PyObject* self, PyObject* args) {
   return Py_BuildValue("(dd)", x, y);
 }
 
+// Packed polygons: the vertices of all polygons are stored as one
+// contiguous buffer of (lon, lat) doubles, polygon i spans the vertices
+// offs[i] to offs[i + 1], its bounding box is bboxes[4 * i] to
+// bboxes[4 * i + 3] as (min lon, min lat, max lon, max lat).
+
+int poly_contains_point_packed(double px, double py, const double* poly,
+                               Py_ssize_t n) {
+  int8_t c = -1;
+
+  for (Py_ssize_t i = 1; i < n; i++) {
+    c *= poly_cont_check(px, py, poly[2 * (i - 1)], poly[2 * (i - 1) + 1],
+                         poly[2 * i], poly[2 * i + 1]);
+    if (c == 0) return 1;
+  }
+
+  c *= poly_cont_check(px, py, poly[2 * (n - 1)], poly[2 * (n - 1) + 1],
+                       poly[0], poly[1]);
+
+  return c >= 0;
+}
+
+double hav_approx_poly_stat_packed(double lonp, double latp,
+                                   const double* poly, Py_ssize_t n) {
+  if (poly_contains_point_packed(lonp, latp, poly, n)) return 0;
+
+  double best = 1 / 0.0;
+
+  for (Py_ssize_t i = 1; i < n; i++) {
+    double cur = hav_to_segment_approx(poly[2 * (i - 1)], poly[2 * (i - 1) + 1],
+                                       poly[2 * i], poly[2 * i + 1], lonp,
+                                       latp);
+    if (cur < best) best = cur;
+  }
+  return best;
+}
+
+double hav_approx_poly_poly_packed(const double* polyA, Py_ssize_t na,
+                                   const double* polyB, Py_ssize_t nb) {
+  double best = 1 / 0.0;
+
+  for (Py_ssize_t i = 0; i < na; i++) {
+    double cur =
+        hav_approx_poly_stat_packed(polyA[2 * i], polyA[2 * i + 1], polyB, nb);
+    if (cur < EPSILON) return cur;
+    if (cur < best) best = cur;
+  }
+
+  for (Py_ssize_t i = 0; i < nb; i++) {
+    double cur =
+        hav_approx_poly_stat_packed(polyB[2 * i], polyB[2 * i + 1], polyA, na);
+    if (cur < EPSILON) return cur;
+    if (cur < best) best = cur;
+  }
+  return best;
+}
+
+// Lower bound for haversine_approx() between any two points of the boxes
+// a and b, the cosine is taken at the latitude farthest from the equator.
+double bbox_dist_lower_bound(const double* a, const double* b) {
+  double dlon = MAX(0, MAX(a[0] - b[2], b[0] - a[2]));
+  double dlat = MAX(0, MAX(a[1] - b[3], b[1] - a[3]));
+  double lat = MAX(MAX(fabs(a[1]), fabs(a[3])), MAX(fabs(b[1]), fabs(b[3])));
+
+  double x = dlon * DEG_RAD * cos(lat * DEG_RAD);
+  double y = dlat * DEG_RAD;
+  return 6371.0 * sqrt(x * x + y * y);
+}
+
+// Resolve polygon pid in the packed buffers, bboxes may be NULL. Returns 0
+// and sets an exception if pid is out of range.
+static int packed_poly(Py_buffer* coords, Py_buffer* offs, Py_buffer* bboxes,
+                       Py_ssize_t pid, const double** poly, Py_ssize_t* n,
+                       const double** bbox) {
+  Py_ssize_t npolys = offs->len / (Py_ssize_t)sizeof(int64_t) - 1;
+  const int64_t* o = (const int64_t*)offs->buf;
+
+  if (pid < 0 || pid >= npolys ||
+      (bboxes && bboxes->len < (pid + 1) * 4 * (Py_ssize_t)sizeof(double)) ||
+      coords->len < o[pid + 1] * 2 * (Py_ssize_t)sizeof(double) ||
+      o[pid] > o[pid + 1]) {
+    PyErr_SetString(PyExc_IndexError, "polygon id out of range");
+    return 0;
+  }
+
+  *poly = (const double*)coords->buf + 2 * o[pid];
+  *n = o[pid + 1] - o[pid];
+  if (bbox) *bbox = (const double*)bboxes->buf + 4 * pid;
+  return 1;
+}
+
+static PyObject* cutil_hav_approx_poly_stat_packed(PyObject* self,
+                                                   PyObject* args) {
+  double latp, lonp, bound;
+  Py_buffer coords, offs, bboxes;
+  Py_ssize_t pid;
+  if (!PyArg_ParseTuple(args, "ddy*y*y*nd", &lonp, &latp, &coords, &offs,
+                        &bboxes, &pid, &bound))
+    return 0;
+
+  const double* poly;
+  const double* bbox;
+  Py_ssize_t n;
+  PyObject* ret = 0;
+
+  if (packed_poly(&coords, &offs, &bboxes, pid, &poly, &n, &bbox)) {
+    double point[4] = {lonp, latp, lonp, latp};
+    double d = -1;
+    if (bound >= 0) d = bbox_dist_lower_bound(point, bbox);
+    if (d <= bound) d = hav_approx_poly_stat_packed(lonp, latp, poly, n);
+    ret = PyFloat_FromDouble(d);
+  }
+
+  PyBuffer_Release(&coords);
+  PyBuffer_Release(&offs);
+  PyBuffer_Release(&bboxes);
+  return ret;
+}
+
+static PyObject* cutil_hav_approx_poly_poly_packed(PyObject* self,
+                                                   PyObject* args) {
+  double bound;
+  Py_buffer coords, offs, bboxes;
+  Py_ssize_t pida, pidb;
+  if (!PyArg_ParseTuple(args, "y*y*y*nnd", &coords, &offs, &bboxes, &pida,
+                        &pidb, &bound))
+    return 0;
+
+  const double* polyA;
+  const double* polyB;
+  const double* bboxA;
+  const double* bboxB;
+  Py_ssize_t na, nb;
+  PyObject* ret = 0;
+
+  if (packed_poly(&coords, &offs, &bboxes, pida, &polyA, &na, &bboxA) &&
+      packed_poly(&coords, &offs, &bboxes, pidb, &polyB, &nb, &bboxB)) {
+    double d = -1;
+    if (bound >= 0) d = bbox_dist_lower_bound(bboxA, bboxB);
+    if (d <= bound) d = hav_approx_poly_poly_packed(polyA, na, polyB, nb);
+    ret = PyFloat_FromDouble(d);
+  }
+
+  PyBuffer_Release(&coords);
+  PyBuffer_Release(&offs);
+  PyBuffer_Release(&bboxes);
+  return ret;
+}
+
+static PyObject* cutil_centroid_packed(PyObject* self, PyObject* args) {
+  Py_buffer coords, offs;
+  Py_ssize_t pid;
+  if (!PyArg_ParseTuple(args, "y*y*n", &coords, &offs, &pid)) return 0;
+
+  const double* poly;
+  Py_ssize_t n;
+  PyObject* ret = 0;
+
+  if (packed_poly(&coords, &offs, 0, pid, &poly, &n, 0)) {
+    double x = 0;
+    double y = 0;
+    for (Py_ssize_t i = 0; i < n; i++) {
+      x += poly[2 * i];
+      y += poly[2 * i + 1];
+    }
+
+    ret = Py_BuildValue("(dd)", x / n, y / n);
+  }
+
+  PyBuffer_Release(&coords);
+  PyBuffer_Release(&offs);
+  return ret;
+}
+
+static PyObject* cutil_haversine_batch(PyObject* self, PyObject* args) {
+  Py_buffer lats1, lngs1, lats2, lngs2, out;
+  int approx;
+  if (!PyArg_ParseTuple(args, "y*y*y*y*w*p", &lats1, &lngs1, &lats2, &lngs2,
+                        &out, &approx))
+    return 0;
+
+  Py_ssize_t n = out.len / (Py_ssize_t)sizeof(double);
+  PyObject* ret = 0;
+
+  if (lats1.len < out.len || lngs1.len < out.len || lats2.len < out.len ||
+      lngs2.len < out.len) {
+    PyErr_SetString(PyExc_ValueError, "coordinate buffers too short");
+  } else {
+    const double* la1 = (const double*)lats1.buf;
+    const double* lo1 = (const double*)lngs1.buf;
+    const double* la2 = (const double*)lats2.buf;
+    const double* lo2 = (const double*)lngs2.buf;
+    double* d = (double*)out.buf;
+
+    Py_BEGIN_ALLOW_THREADS
+    if (approx) {
+      for (Py_ssize_t i = 0; i < n; i++)
+        d[i] = haversine_approx(la1[i], lo1[i], la2[i], lo2[i]);
+    } else {
+      for (Py_ssize_t i = 0; i < n; i++)
+        d[i] = haversine(la1[i], lo1[i], la2[i], lo2[i]);
+    }
+    Py_END_ALLOW_THREADS
+
+    Py_INCREF(Py_None);
+    ret = Py_None;
+  }
+
+  PyBuffer_Release(&lats1);
+  PyBuffer_Release(&lngs1);
+  PyBuffer_Release(&lats2);
+  PyBuffer_Release(&lngs2);
+  PyBuffer_Release(&out);
+  return ret;
+}
+
+// Compute the similarities of the string pairs (idx1[i], idx2[i]) of a
+// string table given as UCS4 code points and string offsets into out, which
+// holds simi_cols(metric) values per pair. A uint8 output buffer gets the
+// similarities quantized to 0..255, a float32 or float64 buffer the raw
+// values.
+static PyObject* simi_batch(PyObject* args, int metric) {
+  Py_buffer chars, offs, idx1, idx2, out;
+  PyObject* out_obj;
+  if (!PyArg_ParseTuple(args, "y*y*y*y*O", &chars, &offs, &idx1, &idx2,
+                        &out_obj))
+    return 0;
+
+  PyObject* ret = 0;
+
+  if (PyObject_GetBuffer(out_obj, &out, PyBUF_WRITABLE | PyBUF_FORMAT |
+                                            PyBUF_C_CONTIGUOUS) == 0) {
+    char fmt = out.format[strlen(out.format) - 1];
+    int cols = simi_cols(metric);
+    Py_ssize_t n = out.len / MAX(out.itemsize, 1) / cols;
+    Py_ssize_t n_strs = offs.len / (Py_ssize_t)sizeof(int64_t) - 1;
+    Py_ssize_t n_chars = chars.len / (Py_ssize_t)sizeof(Py_UCS4);
+
+    if (!((fmt == 'B' && out.itemsize == 1) ||
+          (fmt == 'f' && out.itemsize == sizeof(float)) ||
+          (fmt == 'd' && out.itemsize == sizeof(double)))) {
+      PyErr_SetString(PyExc_ValueError,
+                      "output buffer must be of type uint8, float32 or "
+                      "float64");
+    } else if (idx1.len < n * (Py_ssize_t)sizeof(int64_t) ||
+               idx2.len < n * (Py_ssize_t)sizeof(int64_t)) {
+      PyErr_SetString(PyExc_ValueError, "index buffers too short");
+    } else {
+      const Py_UCS4* c = (const Py_UCS4*)chars.buf;
+      const int64_t* o = (const int64_t*)offs.buf;
+      const int64_t* a = (const int64_t*)idx1.buf;
+      const int64_t* b = (const int64_t*)idx2.buf;
+      int bad = 0;
+      int oom = 0;
+
+      Py_BEGIN_ALLOW_THREADS
+      for (Py_ssize_t i = 0; i < n; i++) {
+        if (a[i] < 0 || a[i] >= n_strs || b[i] < 0 || b[i] >= n_strs ||
+            o[a[i]] < 0 || o[a[i] + 1] > n_chars || o[a[i]] > o[a[i] + 1] ||
+            o[b[i]] < 0 || o[b[i] + 1] > n_chars || o[b[i]] > o[b[i] + 1]) {
+          bad = 1;
+          break;
+        }
+
+        double d[3];
+        if (!simi(metric, c + o[a[i]], c + o[b[i]], o[a[i] + 1] - o[a[i]],
+                  o[b[i] + 1] - o[b[i]], d)) {
+          oom = 1;
+          break;
+        }
+
+        for (int k = 0; k < cols; k++) {
+          Py_ssize_t j = i * cols + k;
+          if (fmt == 'B') {
+            int q = (int)(d[k] * 255);
+            ((uint8_t*)out.buf)[j] = q < 0 ? 0 : (q > 255 ? 255 : q);
+          } else if (fmt == 'f') {
+            ((float*)out.buf)[j] = d[k];
+          } else {
+            ((double*)out.buf)[j] = d[k];
+          }
+        }
+      }
+      Py_END_ALLOW_THREADS
+
+      if (oom) {
+        PyErr_NoMemory();
+      } else if (bad) {
+        PyErr_SetString(PyExc_IndexError, "string index out of range");
+      } else {
+        Py_INCREF(Py_None);
+        ret = Py_None;
+      }
+    }
+
+    PyBuffer_Release(&out);
+  }
+
+  PyBuffer_Release(&chars);
+  PyBuffer_Release(&offs);
+  PyBuffer_Release(&idx1);
+  PyBuffer_Release(&idx2);
+  return ret;
+}
+
+static PyObject* cutil_ed_simi_batch(PyObject* self, PyObject* args) {
+  return simi_batch(args, SIMI_ED);
+}
+
+static PyObject* cutil_ped_simi_batch(PyObject* self, PyObject* args) {
+  return simi_batch(args, SIMI_PED);
+}
+
+static PyObject* cutil_sed_simi_batch(PyObject* self, PyObject* args) {
+  return simi_batch(args, SIMI_SED);
+}
+
+static PyObject* cutil_prefix_simi_batch(PyObject* self, PyObject* args) {
+  return simi_batch(args, SIMI_PREFIX);
+}
+
+static PyObject* cutil_suffix_simi_batch(PyObject* self, PyObject* args) {
+  return simi_batch(args, SIMI_SUFFIX);
+}
+
+static PyObject* cutil_jaro_simi_batch(PyObject* self, PyObject* args) {
+  return simi_batch(args, SIMI_JARO);
+}
+
+static PyObject* cutil_jaro_winkler_simi_batch(PyObject* self,
+                                               PyObject* args) {
+  return simi_batch(args, SIMI_JARO_WINKLER);
+}
+
 static PyMethodDef CutilMethods[] = {
     {"ed", cutil_ed, METH_VARARGS, "Compute the edit distance."},
     {"ped", cutil_ped, METH_VARARGS, "Compute the prefix edit distance."},
@@ -454,6 +1065,37 @@ static PyMethodDef CutilMethods[] = {
      "polygon"},
     {"centroid", cutil_centroid, METH_VARARGS,
      "Calculates the centroid of a polygon"},
+    {"hav_approx_poly_stat_packed", cutil_hav_approx_poly_stat_packed,
+     METH_VARARGS,
+     "Calculate the approximate haversine distance between a packed polygon "
+     "and lon/lat, or a lower bound above the given bound"},
+    {"hav_approx_poly_poly_packed", cutil_hav_approx_poly_poly_packed,
+     METH_VARARGS,
+     "Calculate the approximate haversine distance between two packed "
+     "polygons, or a lower bound above the given bound"},
+    {"centroid_packed", cutil_centroid_packed, METH_VARARGS,
+     "Calculates the centroid of a packed polygon"},
+    {"ed_simi_batch", cutil_ed_simi_batch, METH_VARARGS,
+     "Compute the edit distance similarities of string pairs into a buffer."},
+    {"ped_simi_batch", cutil_ped_simi_batch, METH_VARARGS,
+     "Compute the prefix edit distance similarities of string pairs into a "
+     "buffer."},
+    {"sed_simi_batch", cutil_sed_simi_batch, METH_VARARGS,
+     "Compute the suffix edit distance similarities of string pairs into a "
+     "buffer."},
+    {"prefix_simi_batch", cutil_prefix_simi_batch, METH_VARARGS,
+     "Compute the edit distance and both prefix edit distance similarities "
+     "of string pairs in one DP into a buffer."},
+    {"suffix_simi_batch", cutil_suffix_simi_batch, METH_VARARGS,
+     "Compute the edit distance and both suffix edit distance similarities "
+     "of string pairs in one DP into a buffer."},
+    {"jaro_simi_batch", cutil_jaro_simi_batch, METH_VARARGS,
+     "Compute the jaro similarities of string pairs into a buffer."},
+    {"jaro_winkler_simi_batch", cutil_jaro_winkler_simi_batch, METH_VARARGS,
+     "Compute the jaro-winkler similarities of string pairs into a buffer."},
+    {"haversine_batch", cutil_haversine_batch, METH_VARARGS,
+     "Compute the (approx) haversine distances between arrays of points into "
+     "an output buffer."},
     {NULL, NULL, 0, NULL}};
 
 static struct PyModuleDef cutilmodule = {PyModuleDef_HEAD_INIT, "cutil", 0, -1,
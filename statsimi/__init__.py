@@ -10,6 +10,7 @@ from .osm.osm_fixer import OsmFixer
 from .evaluate.evaluator import Evaluator
 from .feature.feature_builder import FeatureBuilder
 from .feature.model_builder import ModelBuilder
+from .osm.region import Region
 from .serv.classifier_server import ClassifierServer
 import argparse
 import time
@@ -69,12 +70,12 @@ def main():
 
     parser.add_argument(
         '--train', type=str, nargs='+', default=[],
-        help='Input training data, as OSM XML or pairs file.'
+        help='Input training data, as OSM XML, OSM PBF or pairs file.'
     )
 
     parser.add_argument(
         '--test', type=str, nargs='+',
-        help='Input test data, as OSM XML or pairs file.'
+        help='Input test data, as OSM XML, OSM PBF or pairs file.'
     )
 
     parser.add_argument(
@@ -107,6 +108,47 @@ def main():
         help='Also parse OSM ways for polyonal stations'
     )
 
+    parser.add_argument(
+        '--workers', type=int, default=0,
+        help='Number of worker processes used for parsing, 0 = number of CPUs'
+    )
+
+    parser.add_argument(
+        '--bbox', type=str, default=None,
+        help='Only parse OSM stations inside this bounding box, given as '
+        'minlat,minlon,maxlat,maxlon'
+    )
+
+    parser.add_argument(
+        '--region_poly', type=str, default=None,
+        help='Only parse OSM stations inside the polygon in this file '
+        '(Osmosis .poly format)'
+    )
+
+    parser.add_argument(
+        '--region_halo', type=float, default=0,
+        help='Also parse OSM stations within this distance in meters '
+        'around --bbox or --region_poly'
+    )
+
+    parser.add_argument(
+        '--cache_dir', type=str, default=None,
+        help='Directory to cache parsed OSM input files and built feature '
+        'matrices in, re-used on later runs on the same input'
+    )
+
+    parser.add_argument(
+        '--station_db', type=str, default=None,
+        help='Directory of a station database, written from the --test '
+        'OSM input, or updated with --osc'
+    )
+
+    parser.add_argument(
+        '--osc', type=str, nargs='+', default=[],
+        help='OSM change files to apply to --station_db, only the '
+        'neighbourhoods of the changed stations are then tested'
+    )
+
     parser.add_argument(
         '--topk', type=int, default=200,
         help='Top q-grams to use as features in training'
@@ -153,6 +195,12 @@ def main():
         help='output directory for evaluation run'
     )
 
+    parser.add_argument(
+        '--distr_out', type=str, default=None,
+        help='Record the distributions of the feature values and write '
+        'their histograms to this .npz file'
+    )
+
     parser.add_argument(
         '--spice', default=0, type=float,
         help='Spice stations for training with constructed "\
@@ -220,7 +268,15 @@ def main():
         args.topk = 0
         args.model_out = None
 
-    mb = ModelBuilder(args.method, args.norm_file, args.voting, args.unique, args.with_polygons)
+    region = None
+    if args.region_poly:
+        region = Region.from_poly_file(args.region_poly, args.region_halo)
+    elif args.bbox:
+        region = Region.from_bbox_str(args.bbox, args.region_halo)
+
+    mb = ModelBuilder(args.method, args.norm_file, args.voting, args.unique,
+                      args.with_polygons, args.workers or None,
+                      args.cache_dir, region)
 
     if args.cmd[0] == "evaluate-par":
         logging.info(" === Parameter evaluation mode ===\n")
@@ -244,6 +300,8 @@ def main():
             voting=args.voting,
             unique_names=args.unique,
             with_polygons=args.with_polygons,
+            cache_dir=args.cache_dir,
+            region=region,
             runs=args.runs)
         pareval.evaluate()
 
@@ -265,7 +323,8 @@ def main():
                 "spice": args.spice,
                 "cutoffdist": args.cutoffdist,
                 "topk": args.topk,
-                "clean_data": args.clean_data
+                "clean_data": args.clean_data,
+                "distr_out": args.distr_out
             })
 
         fbargs_model = fbargs
@@ -278,19 +337,32 @@ def main():
         logging.error("No model (--model) or training data (--train) given.")
         exit(1)
 
-    if args.test:
+    if args.osc and not args.station_db:
+        logging.error("--osc requires a station database (--station_db).")
+        exit(1)
+
+    if args.test or args.osc:
         # if prediction dataset was explicitly given, use it
-        logging.info("Test dataset(s) '%s' were given" % ", ".join(args.test))
+        if args.osc:
+            logging.info("Change file(s) '%s' were given" % ", ".join(args.osc))
+        else:
+            logging.info("Test dataset(s) '%s' were given" % ", ".join(args.test))
 
         fbargs = fbargs_model
         fbargs["spice"] = args.spice
         fbargs["cutoffdist"] = args.cutoffdist
         fbargs["force_orphans"] = args.cmd[0] == "fix"
         fbargs["clean_data"] = args.clean_data
+        fbargs["distr_out"] = args.distr_out
         fbargs["ngram_idx"] = ngram_model  # re-use the model ngrams
         fbargs["topk"] = len(ngram_model[2])  # re-use the top k
 
-        test_data = mb.build_from_file(args.test, fbargs=fbargs)
+        if args.osc:
+            test_data = mb.build_from_osc(args.station_db, args.osc,
+                                          fbargs=fbargs)
+        else:
+            test_data = mb.build_from_file(args.test, fbargs=fbargs,
+                                           station_db=args.station_db)
         if args.cmd[0] == "evaluate" or args.pairs_test_out is not None:
             tm = test_data.get_matrix()
             y_test = tm[:, -1].toarray().ravel()
@@ -42,29 +42,24 @@ class TFIDFClassifier(object):
         trainining data, for example, free user input.
         '''
 
-        train_station_ids = set()
-
         # take only the pairs present in the training data set
-        for i in range(X.shape[0]):
-            lookup = i
-            if train_data_idx is not None:
-                lookup = train_data_idx[i]
-
-            stid1 = train_data.pairs[lookup][0]
-            stid2 = train_data.pairs[lookup][1]
+        lookups = numpy.arange(X.shape[0])
+        if train_data_idx is not None:
+            lookups = numpy.asarray(train_data_idx)[lookups]
 
-            train_station_ids.add(stid1)
-            train_station_ids.add(stid2)
+        train_station_ids = numpy.unique(train_data.pairs[lookups])
 
         self.log.info(
             "Fitting words and document freqs for tf.idf scores on %d "
             "stations from training data..." % len(train_station_ids))
 
-        for sid in train_station_ids:
-            station = train_data.stations[sid]
+        stations = train_data.stations
+        names = stations.col("name_id")[train_station_ids]
+
+        for name_id in names.tolist():
             self.train_num_stations += 1
             # no normalization here!
-            for word in re.split(r"[^\w]+", station.name):
+            for word in re.split(r"[^\w]+", stations.string(name_id)):
                 word = word.strip()
                 # Ignore the word if it is empty.
                 if len(word) == 0:
@@ -99,28 +94,21 @@ class TFIDFClassifier(object):
         test_word_idx = {}
         test_words = []
 
-        test_station_ids = set()
-
         # take only the pairs present in the test data set
-        for i in range(X.shape[0]):
-            lookup = i
-            if test_data_idx is not None:
-                lookup = test_data_idx[i]
+        lookups = numpy.arange(X.shape[0])
+        if test_data_idx is not None:
+            lookups = numpy.asarray(test_data_idx)[lookups]
 
-            stid1 = test_data.pairs[lookup][0]
-            stid2 = test_data.pairs[lookup][1]
+        pairs = test_data.pairs[lookups]
+        test_station_ids = numpy.unique(pairs)
 
-            test_station_ids.add(stid1)
-            test_station_ids.add(stid2)
-
-        test_station_ids = list(test_station_ids)
-
-        for _, sid in enumerate(test_station_ids):
-            station = test_data.stations[sid]
+        stations = test_data.stations
+        names = stations.col("name_id")[test_station_ids]
 
+        for name_id in names.tolist():
             tfs.append({})
 
-            for word in re.split(r"[^\w]+", station.name):
+            for word in re.split(r"[^\w]+", stations.string(name_id)):
                 word = word.strip()
 
                 if len(word) == 0:
@@ -146,12 +134,7 @@ class TFIDFClassifier(object):
         indices = []
         indptr = [0]
 
-        # mapping maps station ids to rows in the td.idf matrix
-        glob_mapping = {}
-
-        for iid, sid in enumerate(test_station_ids):
-            station = test_data.stations[sid]
-            glob_mapping[sid] = iid
+        for iid in range(len(test_station_ids)):
             for _, wid in enumerate(tfs[iid]):
                 indices.append(wid)
                 tf = tfs[iid][wid]
@@ -185,48 +168,24 @@ class TFIDFClassifier(object):
 
                 locret = numpy.empty([maxr - minr, 2], dtype=numpy.float)
 
-                chunkstationids = set()
-                for i in range(minr, maxr):
-                    lookup = i
-                    if test_data_idx is not None:
-                        lookup = test_data_idx[i]
-
-                    stid1 = test_data.pairs[lookup][0]
-                    stid2 = test_data.pairs[lookup][1]
-
-                    chunkstationids.add(stid1)
-                    chunkstationids.add(stid2)
-
-                chunkstationids = list(chunkstationids)
-
                 # build a view of our tfidf score matrix containing the
-                # stations in this chunk
-                chunk_map = {}
-                mapping_l = []
-                chunk_matrix = None
-
-                for iid, sid in enumerate(chunkstationids):
-                    chunk_map[sid] = iid
-                    mapping_l.append(glob_mapping[sid])
-
-                chunk_matrix = matrix[mapping_l, :]
+                # stations in this chunk, test_station_ids is sorted, so
+                # the matrix rows of station ids are found by searchsorted
+                chunk_pairs = pairs[minr:maxr]
+                chunkstationids = numpy.unique(chunk_pairs)
+                chunk_matrix = matrix[numpy.searchsorted(
+                    test_station_ids, chunkstationids), :]
                 simi_mat = cosine_similarity(chunk_matrix)
 
-                for i in range(minr, maxr):
-                    lookup = i
-                    if test_data_idx is not None:
-                        lookup = test_data_idx[i]
-
-                    simi = simi_mat[chunk_map[test_data.pairs[lookup][
-                        0]], chunk_map[test_data.pairs[lookup][1]]]
-
-                    if simi > self.t:
-                        simi = 0.5 + (simi - self.t) / (2.0 * (1.0 - self.t))
-                    else:
-                        simi = simi / (2 * self.t)
+                simi = simi_mat[
+                    numpy.searchsorted(chunkstationids, chunk_pairs[:, 0]),
+                    numpy.searchsorted(chunkstationids, chunk_pairs[:, 1])]
 
-                    locret[i - minr, 1] = simi
-                    locret[i - minr, 0] = 1 - locret[i - minr, 1]
+                locret[:, 1] = numpy.where(
+                    simi > self.t,
+                    0.5 + (simi - self.t) / (2.0 * (1.0 - self.t)),
+                    simi / (2 * self.t))
+                locret[:, 0] = 1 - locret[:, 1]
                 out.append([locret, minr, maxr])
 
         manager = mp.Manager()
@@ -43,6 +43,8 @@ class ParamEvaluator(object):
             voting="soft",
             unique_names=False,
             with_polygons=False,
+            cache_dir=None,
+            region=None,
             runs=5):
         self.p = p
         self.log = logging.getLogger('pareval')
@@ -62,6 +64,10 @@ class ParamEvaluator(object):
         self.vote = voting
         self.unique = unique_names
         self.with_polygons = with_polygons
+        self.cache_dir = cache_dir
+
+        # if set, only stations within this Region are parsed
+        self.region = region
 
         self.fbargs_test_prev = None
         self.run_testfile_prev = None
@@ -140,7 +146,9 @@ class ParamEvaluator(object):
             print_classification_report(*[c[curi] for c in conf_ms], digits=5)
 
     def evaluate(self):
-        mb = ModelBuilder(self.method, self.norm_file, self.vote, self.unique, self.with_polygons)
+        mb = ModelBuilder(self.method, self.norm_file, self.vote, self.unique,
+                          self.with_polygons, cache_dir=self.cache_dir,
+                          region=self.region)
 
         modelargs_base = self.modelargs
         fbargs_base = self.fbargs
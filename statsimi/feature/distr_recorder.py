@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright 2019, University of Freiburg.
+Chair of Algorithms and Data Structures.
+Patrick Brosi <brosi@informatik.uni-freiburg.de>
+'''
+
+import logging
+import numpy as np
+
+
+class DistrRecorder(object):
+    '''
+    Records the value distributions of features in fixed-bin histograms,
+    together with the count, sum, sum of squares, minimum and maximum of
+    the values. Values outside of the histogram range are counted in the
+    first or last bin.
+
+    >>> d = DistrRecorder()
+    >>> d.add_feature("simi", 0, 1, 4)
+    >>> d.add("simi", np.array([0.1, 0.3, 0.35, 1.0, 2.0]))
+    >>> d.add("simi", np.array([]))
+    >>> d.hists["simi"].tolist()
+    [1, 2, 0, 2]
+    >>> s = d.summary("simi")
+    >>> s["count"], round(s["mean"], 2), s["min"], s["max"]
+    (5, 0.75, 0.1, 2.0)
+    >>> d.quantile("simi", 0.5)
+    0.4375
+    '''
+
+    def __init__(self):
+        self.log = logging.getLogger('distr')
+        self.edges = {}
+        self.hists = {}
+        self.moments = {}
+
+    def add_feature(self, name, lo, hi, bins=100):
+        '''
+        Record values of feature name in bins equal-width bins in [lo, hi]
+        '''
+        self.edges[name] = np.linspace(lo, hi, bins + 1)
+        self.hists[name] = np.zeros(bins, dtype=np.int64)
+        self.moments[name] = np.array([0, 0, 0, np.inf, -np.inf],
+                                      dtype=np.float64)
+
+    def add(self, name, vals):
+        '''
+        Record the values vals of feature name.
+        '''
+        if name not in self.hists or len(vals) == 0:
+            return
+
+        vals = np.asarray(vals, dtype=np.float64)
+        edges = self.edges[name]
+        hist = self.hists[name]
+
+        bins = np.searchsorted(edges, vals, side="right") - 1
+        np.clip(bins, 0, len(hist) - 1, out=bins)
+        hist += np.bincount(bins, minlength=len(hist))
+
+        m = self.moments[name]
+        m[0] += len(vals)
+        m[1] += vals.sum()
+        m[2] += np.dot(vals, vals)
+        m[3] = min(m[3], vals.min())
+        m[4] = max(m[4], vals.max())
+
+    def summary(self, name):
+        '''
+        Return the count, mean, standard deviation, minimum and maximum of
+        the recorded values of feature name.
+        '''
+        count, total, sq, lo, hi = self.moments[name].tolist()
+        if count == 0:
+            return {"count": 0, "mean": 0, "std": 0, "min": 0, "max": 0}
+        mean = total / count
+        return {"count": int(count), "mean": mean,
+                "std": max(0, sq / count - mean * mean) ** 0.5,
+                "min": lo, "max": hi}
+
+    def quantile(self, name, q):
+        '''
+        Return the approximate q-quantile of the recorded values of feature
+        name, interpolated linearly within its histogram bin
+        '''
+        hist = self.hists[name]
+        edges = self.edges[name]
+        cum = np.cumsum(hist)
+        if cum[-1] == 0:
+            return 0
+
+        target = q * cum[-1]
+        b = min(int(np.searchsorted(cum, target)), len(hist) - 1)
+        prev = cum[b - 1] if b > 0 else 0
+        frac = (target - prev) / hist[b] if hist[b] else 0
+        val = edges[b] + frac * (edges[b + 1] - edges[b])
+
+        # the extremes are known exactly
+        m = self.moments[name]
+        return float(min(max(val, m[3]), m[4]))
+
+    def dump(self, path):
+        '''
+        Write the histograms, bin edges and moments of all features to the
+        .npz file path.
+        '''
+        self.log.info("Writing feature distributions to %s..." % path)
+        arrs = {}
+        for name in self.hists:
+            s = self.summary(name)
+            self.log.info("%s: %d values, mean %.4f, std %.4f, "
+                          "min %.4f, max %.4f" % (name, s["count"], s["mean"],
+                                                  s["std"], s["min"],
+                                                  s["max"]))
+            arrs[name + "_hist"] = self.hists[name]
+            arrs[name + "_edges"] = self.edges[name]
+            arrs[name + "_moments"] = self.moments[name]
+
+        with open(path, "wb") as f:
+            np.savez(f, **arrs)
@@ -8,31 +8,91 @@ import string
 import os
 import copy
 import logging
-from statistics import mean
-from statistics import median
 from numpy import argsort
 from numpy import ones
 from numpy import std
 import random
+import numpy as np
 from scipy.sparse import csr_matrix
 from scipy.stats import anderson
 from numpy import uint8
 from statsimi.feature.station_idx import StationIdx
+from statsimi.feature.station_idx import station_pairs
+from statsimi.feature.station_table import StationTable
+from statsimi.feature.station_table import grown
+from statsimi.feature.distr_recorder import DistrRecorder
 from statsimi.util import hav
 from statsimi.util import centroid
-from statsimi.util import ed
 from statsimi.util import bts_simi
-from statsimi.util import jaro_simi
-from statsimi.util import jaro_winkler_simi
-from statsimi.util import ped
-from statsimi.util import sed
 from statsimi.util import jaccard
+from statsimi.util import pack_strings
+from statsimi.util import simi_batch
 from statsimi.util import FileList
 from statsimi.util import hav_approx
+from statsimi.util import hav_batch
 from statsimi.util import hav_approx_poly_poly
 from statsimi.util import hav_approx_poly_stat
 import matplotlib.pyplot as plt
 
+# number of matrix rows computed at once by FeatureBuilder.write_rows()
+ROW_BATCH = 1 << 16
+
+
+def pair_keys(sid1, sids):
+    '''
+    Return the int64 keys (min(sid1, sid2) << 32) | max(sid1, sid2) of the
+    pairs between station sid1 and the stations sids
+
+    >>> pair_keys(3, np.array([1, 5])).tolist()
+    [4294967299, 12884901893]
+    '''
+    sids = np.asarray(sids, dtype=np.int64)
+    return (np.minimum(sids, sid1) << 32) | np.maximum(sids, sid1)
+
+
+class KeySet(object):
+    '''
+    Set of int64 keys, stored as sorted runs. A run is merged with the
+    previous one while that one is at most twice as large, so there are
+    O(log n) runs and membership is one binary search per run.
+
+    >>> s = KeySet()
+    >>> s.add(np.array([5, 1]))
+    >>> s.add(np.array([3]))
+    >>> s.contains(np.array([1, 2, 3, 5, 6])).tolist()
+    [True, False, True, True, False]
+    >>> len(s), len(s.runs)
+    (3, 1)
+    '''
+
+    def __init__(self):
+        self.runs = []
+
+    def __len__(self):
+        return sum(len(run) for run in self.runs)
+
+    def contains(self, keys):
+        '''
+        Return a boolean array telling which of keys are in the set
+        '''
+        ret = np.zeros(len(keys), dtype=bool)
+        for run in self.runs:
+            pos = np.searchsorted(run, keys)
+            np.minimum(pos, len(run) - 1, out=pos)
+            ret |= run[pos] == keys
+        return ret
+
+    def add(self, keys):
+        '''
+        Add the int64 array keys to the set
+        '''
+        if len(keys) == 0:
+            return
+        run = np.unique(keys)
+        while len(self.runs) and len(self.runs[-1]) <= 2 * len(run):
+            run = np.union1d(self.runs.pop(), run)
+        self.runs.append(run)
+
 
 class FeatureBuilder(object):
     '''
@@ -50,7 +110,8 @@ class FeatureBuilder(object):
         ngram=3,
         cutoffdist=1000,
         features=['lev_simi', 'geodist'],
-        clean_data=False
+        clean_data=False,
+        distr_out=None
     ):
 
         # list of arguments needed to later init a matching feature builder
@@ -64,17 +125,32 @@ class FeatureBuilder(object):
 
         self.log = logging.getLogger('featbld')
 
-        self.write_distr = True
+        # if set, the feature value distributions are recorded and
+        # written to this file after the matrix was built
+        self.distr_out = distr_out
+        self.distr = None
+        if distr_out:
+            self.distr = DistrRecorder()
 
         if force_orphans:
             self.log.info("(forcing pairs for station orphans)")
 
         self._grps = []
         self._stats = []
-        self._pairs = []
+        # station pairs of the matrix rows, see add_pairs()
+        self._pairs = np.zeros((1024, 2), dtype=np.int32)
+        self._n_pairs = 0
+
+        # string features per pair of name ids, see name_features()
+        self._name_feats = {}
+
+        # rows queued for write_rows(), see queue_row()
+        self._rows = [[], [], [], [], []]
         self.clean_data = clean_data
 
-        self.dists = []
+        # distances between the stations of matching pairs, in meters
+        self.dists = DistrRecorder()
+        self.dists.add_feature("dist", 0, 10000, 10000)
 
         # a high number of pos pairs may lead to local overfitting
         self.num_pos_pairs = num_pos_pairs
@@ -92,7 +168,7 @@ class FeatureBuilder(object):
         # top ngrams
         self.top_ngrams = None
 
-        self.topngram_idx = []
+        self.topngram_mat = None
         self.st_ngram_idx = []
         self.st_ngram_idx_set = []
         self.top_ngrams_map = []
@@ -132,58 +208,12 @@ class FeatureBuilder(object):
         self.jaro_simi_idx = None
         self.jaro_winkler_simi_idx = None
 
-        self.lev_simi_file = None
-        self.geodist_file = None
-        self.ped_simi_fw_file = None
-        self.ped_simi_bw_file = None
-        self.sed_simi_fw_file = None
-        self.sed_simi_bw_file = None
-        self.jaccard_simi_file = None
-        self.missing_ngram_count_file = None
-        self.bts_file = None
-        self.jaro_simi_file = None
-        self.jaro_winkler_simi_file = None
-
         self.matrix = csr_matrix(([], [], [0]), shape=(
             0, self.num_feats + 1 + self.topk),
             dtype=uint8)
 
         self.prepare_features()
 
-    def __del__(self):
-        if self.lev_simi_file is not None:
-            self.lev_simi_file.close()
-
-        if self.geodist_file is not None:
-            self.geodist_file.close()
-
-        if self.ped_simi_fw_file is not None:
-            self.ped_simi_fw_file.close()
-
-        if self.ped_simi_bw_file is not None:
-            self.ped_simi_bw_file.close()
-
-        if self.sed_simi_fw_file is not None:
-            self.sed_simi_fw_file.close()
-
-        if self.sed_simi_bw_file is not None:
-            self.sed_simi_bw_file.close()
-
-        if self.jaccard_simi_file is not None:
-            self.jaccard_simi_file.close()
-
-        if self.missing_ngram_count_file is not None:
-            self.missing_ngram_count_file.close()
-
-        if self.bts_file is not None:
-            self.bts_file.close()
-
-        if self.jaro_simi_file is not None:
-            self.jaro_simi_file.close()
-
-        if self.jaro_winkler_simi_file is not None:
-            self.jaro_winkler_simi_file.close()
-
     def get_feat_idx(self, feat):
         return self.feature_idx[feat]
 
@@ -196,7 +226,7 @@ class FeatureBuilder(object):
 
     @property
     def pairs(self):
-        return self._pairs
+        return self._pairs[:self._n_pairs]
 
     @property
     def groups(self):
@@ -209,9 +239,9 @@ class FeatureBuilder(object):
 
     def build_from_stat_grp(self, stations, groups):
         self._grps = groups
-        self._stats = stations
+        self._stats = StationTable.wrap(stations)
+        self._name_feats = {}
 
-        self.topngram_idx = [[] for i in range(len(self._stats))]
         self.st_ngram_idx = [[] for i in range(len(self._stats))]
         self.st_ngram_idx_set = [set() for i in range(len(self._stats))]
 
@@ -219,9 +249,9 @@ class FeatureBuilder(object):
         self.build_matrix()
 
     def build_from_pairs(self, stations, pairs, simi):
-        self._stats = stations
+        self._stats = StationTable.wrap(stations)
+        self._name_feats = {}
 
-        self.topngram_idx = [[] for i in range(len(self._stats))]
         self.st_ngram_idx = [[] for i in range(len(self._stats))]
         self.st_ngram_idx_set = [set() for i in range(len(self._stats))]
 
@@ -237,14 +267,38 @@ class FeatureBuilder(object):
             # don't use empty names, as they might occur with normalization
             if len(st1.name) == 0 or len(st2.name) == 0:
                 continue
-            matched = simi[i]
-            self.write_row(sid1, sid2, st1, st2, matched, data, ind, iptr)
+            self.queue_row(sid1, sid2, sid1, sid2, simi[i], data, ind, iptr)
+
+        self.flush_rows(data, ind, iptr)
 
         self.matrix = csr_matrix(
             (data.get_mmap(), ind.get_mmap(), iptr.get_mmap()),
             shape=(len(iptr) - 1, self.num_feats + 1 + len(self.top_ngrams)),
             dtype=uint8)
 
+        self.log.info("Computed string features for %d distinct name pairs "
+                      "in %d rows" % (len(self._name_feats), len(iptr) - 1))
+        self._name_feats = {}
+
+        if self.distr:
+            self.distr.dump(self.distr_out)
+
+    def build_from_matrix(self, stations, groups, pairs, matrix, ngram_idx):
+        '''
+        Use an already built feature matrix for the stations and groups,
+        for example one read from a MatrixCache. ngram_idx is the n-gram
+        vocabulary the matrix was built with, as returned by get_ngram_idx()
+        '''
+        self._grps = groups
+        self._stats = StationTable.wrap(stations)
+        self._pairs = pairs
+        self._n_pairs = len(pairs)
+        self.matrix = matrix
+
+        self.ngram_id_idx = ngram_idx[0]
+        self.id_ngram_idx = ngram_idx[1]
+        self.top_ngrams = ngram_idx[2]
+
     def ngrams(self, string, n):
         '''
         Return the padded n-grams for the input string
@@ -353,19 +407,45 @@ class FeatureBuilder(object):
             for sid in range(len(self._stats)):
                 self.store_ngrams_for(sid)
 
-        for sid, st in enumerate(self._stats):
-            self.topngram_idx[sid] = self.get_top_ngrams_for(st)
+        self.topngram_mat = self.build_topngram_mat()
+
+    def build_topngram_mat(self):
+        '''
+        Build the CSR matrix of the top n-gram counts of each station, its
+        columns are the top n-grams in the order of their gram ids
+        '''
+        if len(self._stats) == 0:
+            return csr_matrix((0, len(self.top_ngrams)), dtype=np.int32)
+
+        # the counts only depend on the name
+        names = self._stats.col("name_id")
+        _, first, inv = np.unique(names, return_index=True,
+                                  return_inverse=True)
+
+        indices = []
+        data = []
+        indptr = [0]
+        for sid in first.tolist():
+            for gr_id, count in self.get_top_ngrams_for(self._stats[sid]):
+                indices.append(gr_id)
+                data.append(count)
+            indptr.append(len(indices))
+
+        mat = csr_matrix((np.array(data, dtype=np.int32),
+                          np.array(indices, dtype=np.int32), indptr),
+                         shape=(len(first), len(self.top_ngrams)))
+        return mat[inv.reshape(-1)]
 
     def prep_matr(self):
         # random file name
         rand = ''.join(random.choice(string.ascii_lowercase +
                                      string.digits) for _ in range(8))
 
-        # the matrix is stored on the hard disk to safe memory
+        # large matrices are stored on the hard disk to safe memory
         # FileList is the backing array
-        ind = FileList(32, ".indices" + rand)
+        ind = FileList(32, ".indices" + rand, signed=True)
         data = FileList(8, ".data" + rand)
-        iptr = FileList(64, ".indptr" + rand)
+        iptr = FileList(64, ".indptr" + rand, signed=True)
         iptr.append(0)
 
         return ind, data, iptr
@@ -405,14 +485,40 @@ class FeatureBuilder(object):
 
         ind, data, iptr = self.prep_matr()
 
-        sidx = StationIdx(1000, self.bbox)
-        matched = [set() for i in range(len(self._stats))]
-
-        for stat in self._stats:
-            if stat.lon is None:
-                sidx.add_stat_group_poly(stat.gid, stat.poly)
-            else:
-                sidx.add_stat_group(stat.gid, stat.lon, stat.lat)
+        # keys of the negative pairs written so far, see pair_keys()
+        matched = KeySet()
+
+        # distances of matching pairs not yet added to self.dists
+        dists = []
+
+        cand_offs, cand_sids, cand_dists = self.candidate_pairs()
+        cols = self.pair_cols()
+
+        # the negative pair filters only depend on the two stations and
+        # their distance, apply them to all candidates at once
+        cand_sids1 = np.repeat(np.arange(len(cand_offs) - 1),
+                               np.diff(cand_offs))
+        keep = self.group_mask(cand_sids1, cand_sids, cols) & \
+            self.pair_mask(cand_sids1, cand_sids, cand_dists, cols)
+        cand_sids = cand_sids[keep]
+        cand_offs = np.searchsorted(cand_sids1[keep],
+                                    np.arange(len(cand_offs)))
+
+        # the group index is only needed to sample spice groups
+        if self.spice > 0:
+            sidx = StationIdx(1000, self.bbox)
+
+            gids = self._stats.gid.tolist()
+            lons = self._stats.lon.tolist()
+            lats = self._stats.lat.tolist()
+            poly_ids = self._stats.col("poly_id").tolist()
+
+            for sid, gid in enumerate(gids):
+                if poly_ids[sid] >= 0:
+                    sidx.add_stat_group_poly(
+                        gid, self._stats.polys[poly_ids[sid]])
+                else:
+                    sidx.add_stat_group(gid, lons[sid], lats[sid])
 
         self.log.info("Writing matrix from %s groups, %s station identifiers"
                       % (len(self._grps), len(self._stats)))
@@ -436,8 +542,12 @@ class FeatureBuilder(object):
                         continue
 
                     if sid1 != sid2 and st1.osmnid != st2.osmnid:
-                        d = self.dist(st1, st2)
-                        self.dists.append(d)
+                        dists.append(self.dist(st1, st2))
+                        if len(dists) == ROW_BATCH:
+                            self.dists.add("dist", dists)
+                            dists = []
+
+                    gsid2 = sid2
 
                     # spice with probability p
                     if self.spice > 0 and random.uniform(0, 1) <= self.spice:
@@ -446,11 +556,14 @@ class FeatureBuilder(object):
                         st2 = copy.copy(self._stats[sid2])
                         st2.lon = st1.lon + random.gauss(0, 0.0005)
                         st2.lat = st1.lat + random.gauss(0, 0.0005)
-                        st2.spice_id = len(self._stats)
+                        gsid2 = len(self._stats)
+                        st2.spice_id = gsid2
                         self._stats.append(st2)
 
-                    self.write_row(sid1, sid2, st1, st2, True, data, ind, iptr)
-                    self.write_row(sid2, sid1, st2, st1, True, data, ind, iptr)
+                    self.queue_row(sid1, sid2, sid1, gsid2, True, data, ind,
+                                   iptr)
+                    self.queue_row(sid2, sid1, gsid2, sid1, True, data, ind,
+                                   iptr)
 
                 if not group1.osm_rel_id and not self.force_orphans:
                     # dont negative-match orphan groups with any other group,
@@ -460,12 +573,9 @@ class FeatureBuilder(object):
 
                 stations_in_group += 1
 
-                if st1.lon is None:
-                    loc = sidx.get_neighbors_poly(st1.poly, self.cutoff)
-                else:
-                    loc = sidx.get_neighbors(st1.lon, st1.lat, self.cutoff)
-
-                self.build_pairs(sid1, False, loc, matched, data, ind, iptr)
+                loc = cand_sids[cand_offs[sid1]:cand_offs[sid1 + 1]]
+                self.build_pairs(sid1, False, loc, None, cols, matched, data,
+                                 ind, iptr)
 
                 # spice with probability p
                 if self.spice > 0 and random.uniform(0, 1) <= self.spice:
@@ -481,20 +591,27 @@ class FeatureBuilder(object):
                         sp = sidx.get_neighbors(
                             st1.lon, st1.lat, self.cutoff * 10)
 
-                    sp = random.sample(sp, k=min(len(sp), n))
+                    sp = random.sample(sp.tolist(), k=min(len(sp), n))
+                    sp = [sid2 for gid2 in sp
+                          for sid2 in self._grps[gid2].stats]
 
-                    self.build_pairs(sid1, True, sp, matched, data, ind, iptr)
+                    self.build_pairs(sid1, True, np.array(sp, dtype=np.int64),
+                                     None, cols, matched, data, ind, iptr)
 
             if stations_in_group > 1:
                 group_nums_aggr += stations_in_group
                 group_num += 1
 
-        if (len(self.dists) > 0):
+        self.flush_rows(data, ind, iptr)
+
+        self.dists.add("dist", dists)
+
+        if self.dists.summary("dist")["count"] > 0:
             self.log.info("Average distance between matching pairs is %.2f"
-                          % mean(self.dists))
+                          % self.dists.summary("dist")["mean"])
 
-            self.log.info("Median distance between matching pairs is %.2f"
-                          % median(self.dists))
+            self.log.info("Median distance between matching pairs is ~%.0f"
+                          % self.dists.quantile("dist", 0.5))
 
         self.log.info("Average number of station identifiers per group is %.2f"
                       % (group_nums_aggr / group_num))
@@ -504,126 +621,155 @@ class FeatureBuilder(object):
             shape=(len(iptr) - 1, self.num_feats + 1 + len(self.top_ngrams)),
             dtype=uint8)
 
-    def write_row(self, sid1, sid2, st1, st2, match, data, ind, iptr):
+        self.log.info("Computed string features for %d distinct name pairs "
+                      "in %d rows" % (len(self._name_feats), len(iptr) - 1))
+        self._name_feats = {}
+
+        if self.distr:
+            self.distr.dump(self.distr_out)
+
+    def add_pairs(self, sids1, sids2):
         '''
-        Write a single row to the matrix.
+        Append the station pairs (sids1[i], sids2[i]) of new matrix rows
+
+        >>> fb = FeatureBuilder()
+        >>> fb.add_pairs([1, 2], [3, 4])
+        >>> fb.add_pairs(np.arange(2000), np.arange(2000))
+        >>> fb.pairs.shape, fb.pairs.dtype, fb.pairs[:3].tolist()
+        ((2002, 2), dtype('int32'), [[1, 3], [2, 4], [0, 0]])
+        '''
+        n = self._n_pairs + len(sids1)
+        self._pairs = grown(self._pairs, n)
+        self._pairs[self._n_pairs:n, 0] = sids1
+        self._pairs[self._n_pairs:n, 1] = sids2
+        self._n_pairs = n
+
+    def write_rows(self, sids1, sids2, gsids1, gsids2, match, data, ind,
+                   iptr):
+        '''
+        Write a batch of rows to the matrix, computing each feature for the
+        whole batch at once. Row i compares the names of stations sids1[i]
+        and sids2[i] and the positions of stations gsids1[i] and gsids2[i],
+        see queue_row().
         '''
-        if (len(iptr) - 1) % 50000 == 1:
-            self.log.info("@ pair #%d" % (len(iptr) - 1))
+        n = len(sids1)
+        if n == 0:
+            return
 
-        if self.lev_simi_idx is not None:
-            lev_simi = 1.0 - (ed(st1.name, st2.name) / max(
-                len(st1.name), len(st2.name)))
+        first = len(iptr) - 1
+        for row in range(first + (1 - first) % 50000, first + n, 50000):
+            self.log.info("@ pair #%d" % row)
+
+        distinct = sids1 != sids2
 
-            if self.lev_simi_file and sid1 != sid2:
-                self.lev_simi_file.write("%f\r\n" % (lev_simi))
+        inv, name_feats = self.batch_name_features(sids1, sids2)
 
-            lev_simi = int(lev_simi * 255)
-            lev_simi = self.oflow(lev_simi, st1, st2, 255, "editdist")
+        if self.distr:
+            lev_simi = np.array([f[0] for f in name_feats])[inv]
+            self.distr.add("lev_simi", lev_simi[distinct])
 
-            if lev_simi > 0:
-                ind.append(self.lev_simi_idx)
-                data.append(lev_simi)
+        # (row, column, value) arrays of the entries, in the column order
+        # of the features within a row
+        entries = [row_entries([f[2] for f in name_feats], inv)]
 
         if self.geodist_idx is not None:
-            geodist = self.dist(st1, st2)
+            geodist = self.batch_dists(gsids1, gsids2)
 
-            if self.geodist_file and sid1 != sid2 and st1.osmnid != st2.osmnid:
-                self.geodist_file.write("%f\r\n" % (geodist))
+            if self.distr:
+                osmnids = self._stats.osmnid
+                self.distr.add("geodist", geodist[
+                    distinct & (osmnids[gsids1] != osmnids[gsids2])])
 
             geodist = geodist // 4
-            geodist = self.oflow(geodist, st1, st2, 255, "meterdist")
+            for i in np.flatnonzero(geodist > 255).tolist():
+                self.oflow(int(geodist[i]), self._stats[int(gsids1[i])],
+                           self._stats[int(gsids2[i])], 255, "meterdist")
+            geodist = np.minimum(geodist, 255)
 
-            if geodist > 0:
-                ind.append(self.geodist_idx)
-                data.append(geodist)
+            rows = np.flatnonzero(geodist)
+            entries.append((rows, np.full(len(rows), self.geodist_idx),
+                            geodist[rows]))
 
-        if self.ped_simi_fw_idx is not None:
-            p = int((1.0 - (ped(st1.name, st2.name) / len(st1.name))) * 255)
-            ped_simi_fw = self.oflow(p, st1, st2, 255, "ped_simi_fw")
+        if self.distr:
+            bts = np.array([f[1] for f in name_feats])[inv]
+            self.distr.add("bts_simi", bts[distinct])
 
-            if ped_simi_fw > 0:
-                ind.append(self.ped_simi_fw_idx)
-                data.append(ped_simi_fw)
+        entries.append(row_entries([f[3] for f in name_feats], inv))
 
-        if self.ped_simi_bw_idx is not None:
-            p = int((1.0 - (ped(st2.name, st1.name) / len(st2.name))) * 255)
-            ped_simi_bw = self.oflow(p, st1, st2, 255, "ped_simi_bw")
+        if self.num_pos_pairs > 0:
+            entries.append(self.batch_pos_pairs(gsids1, gsids2,
+                                                self.num_pos_pairs))
 
-            if ped_simi_bw > 0:
-                ind.append(self.ped_simi_bw_idx)
-                data.append(ped_simi_bw)
+        entries.append(self.batch_ngram_diffs(sids1, sids2))
 
-        if self.sed_simi_fw_idx is not None:
-            p = int((1.0 - (sed(st1.name, st2.name) / len(st1.name))) * 255)
-            sed_simi_fw = self.oflow(p, st1, st2, 255, "sed_simi_fw")
+        rows = np.flatnonzero(match)
+        match_idx = self.num_feats + len(self.top_ngrams)
+        entries.append((rows, np.full(len(rows), match_idx),
+                        np.ones_like(rows)))
 
-            if sed_simi_fw > 0:
-                ind.append(self.sed_simi_fw_idx)
-                data.append(sed_simi_fw)
+        # a stable sort by row keeps the order of the entries within rows
+        rows = np.concatenate([e[0] for e in entries])
+        order = np.argsort(rows, kind="stable")
 
-        if self.sed_simi_bw_idx is not None:
-            p = int((1.0 - (sed(st2.name, st1.name) / len(st2.name))) * 255)
-            sed_simi_bw = self.oflow(p, st1, st2, 255, "sed_simi_bw")
+        offset = len(ind)
+        ind.extend(np.concatenate([e[1] for e in entries])[order])
+        data.extend(np.concatenate([e[2] for e in entries])[order])
+        iptr.extend(offset + np.cumsum(np.bincount(rows, minlength=n)))
 
-            if sed_simi_bw > 0:
-                ind.append(self.sed_simi_bw_idx)
-                data.append(sed_simi_bw)
+        self.add_pairs(gsids1, gsids2)
 
-        if self.jaccard_simi_idx is not None:
-            j = int(jaccard(st2.name, st1.name) * 255)
-            jaccard_simi = self.oflow(j, st1, st2, 255, "jaccard_simi")
+    def name_features(self, sid1, sid2, st1, st2, lev_simi, simis, i):
+        '''
+        Compute the features of a pair which only depend on the station
+        names, besides the n-gram differences. The string similarities are
+        taken from row i of the result lev_simi, simis of string_simis().
+        Returns the raw edit distance and bts similarities, the (index,
+        value) entries written before the geographic distance and those
+        written after it.
+        '''
+        name1 = st1.name
+        name2 = st2.name
 
-            if jaccard_simi > 0:
-                ind.append(self.jaccard_simi_idx)
-                data.append(jaccard_simi)
+        head = []
+        tail = []
 
-        if self.bts_simi_idx is not None:
-            b = bts_simi(st2.name, st1.name)
+        bts = None
 
-            if self.bts_file and sid1 != sid2:
-                self.bts_file.write("%f\r\n" % (b))
+        if self.lev_simi_idx is not None:
+            lev_simi = lev_simi.item(i)
 
-            b = int(b * 255)
-            bts_simi_val = self.oflow(b, st1, st2, 255, "bts")
+            val = simis[self.lev_simi_idx].item(i)
+            if val > 0:
+                head.append((self.lev_simi_idx, val))
 
-            if bts_simi_val > 0:
-                ind.append(self.bts_simi_idx)
-                data.append(bts_simi_val)
+        for idx in (self.ped_simi_fw_idx, self.ped_simi_bw_idx,
+                    self.sed_simi_fw_idx, self.sed_simi_bw_idx):
+            if idx is not None and simis[idx].item(i) > 0:
+                tail.append((idx, simis[idx].item(i)))
 
-        if self.jaro_simi_idx is not None:
-            j = int(jaro_simi(st2.name, st1.name) * 255)
-            jaro_simi_val = self.oflow(j, st1, st2, 255, "jaro")
+        if self.jaccard_simi_idx is not None:
+            j = int(jaccard(name2, name1) * 255)
+            jaccard_simi = self.oflow(j, st1, st2, 255, "jaccard_simi")
 
-            if jaro_simi_val > 0:
-                ind.append(self.jaro_simi_idx)
-                data.append(jaro_simi_val)
+            if jaccard_simi > 0:
+                tail.append((self.jaccard_simi_idx, jaccard_simi))
 
-        if self.jaro_winkler_simi_idx is not None:
-            j = int(jaro_winkler_simi(st2.name, st1.name) * 255)
-            jaro_winkler_simi_val = self.oflow(j, st1, st2, 255, "jaro")
+        if self.bts_simi_idx is not None:
+            bts = bts_simi(name2, name1)
 
-            if jaro_winkler_simi_val > 0:
-                ind.append(self.jaro_winkler_simi_idx)
-                data.append(jaro_winkler_simi_val)
+            val = int(bts * 255)
+            bts_simi_val = self.oflow(val, st1, st2, 255, "bts")
 
-        if self.missing_ngram_count_idx is not None:
-            st1set = None
-            st2set = None
+            if bts_simi_val > 0:
+                tail.append((self.bts_simi_idx, bts_simi_val))
 
-            if sid1 is not None:
-                st1set = self.st_ngram_idx_set[sid1]
-            else:
-                # in case we have no qgram index, this is a
-                # set of strings
-                st1set = set(self.ngrams(st1.name, self.ngram))
+        for idx in (self.jaro_simi_idx, self.jaro_winkler_simi_idx):
+            if idx is not None and simis[idx].item(i) > 0:
+                tail.append((idx, simis[idx].item(i)))
 
-            if sid2 is not None:
-                st2set = self.st_ngram_idx_set[sid2]
-            else:
-                # in case we have no qgram index, this is a
-                # set of strings
-                st2set = set(self.ngrams(st2.name, self.ngram))
+        if self.missing_ngram_count_idx is not None:
+            st1set = self.st_ngram_idx_set[sid1]
+            st2set = self.st_ngram_idx_set[sid2]
 
             a = len(st1set | st2set)
             b = len(st1set & st2set)
@@ -631,120 +777,191 @@ class FeatureBuilder(object):
             missing = self.oflow(a - b, st1, st2, 255, "missing_ngram_count")
 
             if missing > 0:
-                ind.append(self.missing_ngram_count_idx)
-                data.append(missing)
-
-        pos_pairs = self.pos_pairs(st1, st2, self.num_pos_pairs)
-        for id, pair in enumerate(pos_pairs):
-            if pair[0] != 0:
-                ind.append(
-                    (self.num_feats - 2 * self.num_pos_pairs) + (2 * id))
-                data.append(pair[0])
-
-            if pair[1] != 0:
-                ind.append(
-                    (self.num_feats - 2 * self.num_pos_pairs) + (2 * id) + 1)
-                data.append(pair[1])
-
-        if sid1 is not None:
-            topgramss1 = self.topngram_idx[sid1]
-        else:
-            topgramss1 = self.get_top_ngrams_for(st1)
+                tail.append((self.missing_ngram_count_idx, missing))
 
-        if sid2 is not None:
-            topgramss2 = self.topngram_idx[sid2]
-        else:
-            topgramss2 = self.get_top_ngrams_for(st2)
-
-        merged = self.diffmerge(topgramss1, topgramss2)
-
-        for id, diff in merged:
-            # diffmat = abs(diff)
-            # don't take the absolute value, but encode the negative number in a 8 bit unsigned integer to keep information about the "direction" of missing qgrams (whether a qgram is missing on the left, or on the right)
-            # with the absolute value, the ngram part in the feature vector for
-            # e.g. "Hauptbahnhof Hbf" vs. "" is nearly the same as for
-            # "Hauptbahnhof" vs. "Hbf".
-            diffmat = diff % 256
-            diffmat = self.oflow(
-                diffmat, st1, st2, 255, "qgram difference count")
-
-            if diffmat != 0:
-                ind.append(self.num_feats +
-                           int(self.top_ngrams_map[id]))
-                data.append(diffmat)
-
-        if match:
-            ind.append(self.num_feats + len(self.top_ngrams))
-            data.append(1)
-
-        iptr.append(len(ind))
-
-        if sid1 is not None and sid2 is not None:
-            # write pair to store
-            if st1.spice_id is not None:
-                # the second station is a spiced one
-                self._pairs.append((st1.spice_id, sid2))
-            elif st2.spice_id is not None:
-                # the second station is a spiced one
-                self._pairs.append((sid1, st2.spice_id))
-            else:
-                self._pairs.append((sid1, sid2))
+        return lev_simi, bts, head, tail
+
+    def batch_ngram_diffs(self, sids1, sids2):
+        '''
+        Nonzero top n-gram count difference entries as (row, column, value)
+        arrays for the station pairs (sids1[i], sids2[i]). The differences
+        of a whole batch are computed by one sparse subtraction of rows of
+        the top n-gram matrix.
+        '''
+        diff = self.topngram_mat[sids1] - self.topngram_mat[sids2]
+        diff.sort_indices()
+
+        # don't take the absolute value, but encode negative differences in
+        # 8 bit to keep the "direction" of missing n-grams (whether an
+        # n-gram is missing on the left or on the right). With the absolute
+        # value, the n-gram part of e.g. "Hauptbahnhof Hbf" vs. "" would be
+        # nearly the same as for "Hauptbahnhof" vs. "Hbf".
+        vals = diff.data % 256
+        nonzero = vals != 0
+
+        rows = np.repeat(np.arange(len(sids1)), np.diff(diff.indptr))
+        cols = np.asarray(self.top_ngrams_map, dtype=np.int64)[diff.indices]
+
+        return (rows[nonzero], self.num_feats + cols[nonzero],
+                vals[nonzero])
+
+    def batch_name_features(self, sids1, sids2):
+        '''
+        Return the name features of the distinct name pairs of the station
+        pairs (sids1[i], sids2[i]) together with the index of the pair of
+        each row into them. Features are cached across batches.
+        '''
+        names = self._stats.col("name_id").astype(np.int64)
+        keys = (names[sids1] << 32) | names[sids2]
+        uniq, first, inv = np.unique(keys, return_index=True,
+                                     return_inverse=True)
+
+        # representative rows of the name pairs not seen before
+        new = np.array([key not in self._name_feats for key in uniq.tolist()],
+                       dtype=bool)
+        rows = first[new]
+
+        lev_simi, simis = self.string_simis(self._stats.packed_strings(),
+                                            names[sids1[rows]],
+                                            names[sids2[rows]])
+
+        for i, (key, row) in enumerate(zip(uniq[new].tolist(),
+                                           rows.tolist())):
+            sid1 = int(sids1[row])
+            sid2 = int(sids2[row])
+            self._name_feats[key] = self.name_features(
+                sid1, sid2, self._stats[sid1], self._stats[sid2], lev_simi,
+                simis, i)
+
+        feats = [self._name_feats[key] for key in uniq.tolist()]
+
+        return inv.reshape(-1), feats
+
+    def string_simis(self, packed, names1, names2):
+        '''
+        Compute the enabled string similarity features of the name pairs
+        (names1[i], names2[i]), given as ids into the strings packed by
+        util.pack_strings(), in one batch. Returns the raw edit distance
+        similarities (or None) and a dict from feature index to the
+        similarities quantized to 0..255.
+        '''
+        lev_simi = None
+        simis = {}
+
+        # the edit distance and the forward and backward prefix (suffix)
+        # edit distances are read off a single DP
+        for fw_idx, bw_idx, metric in (
+                (self.ped_simi_fw_idx, self.ped_simi_bw_idx, "prefix"),
+                (self.sed_simi_fw_idx, self.sed_simi_bw_idx, "suffix")):
+            if fw_idx is None and bw_idx is None:
+                continue
+
+            vals = simi_batch(metric, packed, names1, names2)
+
+            if self.lev_simi_idx is not None and lev_simi is None:
+                lev_simi = vals[:, 0]
+            if fw_idx is not None:
+                simis[fw_idx] = (vals[:, 1] * 255).astype(np.uint8)
+            if bw_idx is not None:
+                simis[bw_idx] = (vals[:, 2] * 255).astype(np.uint8)
+
+        if self.lev_simi_idx is not None:
+            if lev_simi is None:
+                lev_simi = simi_batch("ed", packed, names1, names2)
+            simis[self.lev_simi_idx] = (lev_simi * 255).astype(np.uint8)
+
+        # the jaro similarities compare the second name with the first one
+        for idx, metric in ((self.jaro_simi_idx, "jaro"),
+                            (self.jaro_winkler_simi_idx, "jaro_winkler")):
+            if idx is not None:
+                simis[idx] = simi_batch(metric, packed, names2, names1,
+                                        quantize=True)
+
+        return lev_simi, simis
 
     def get_feature_vec(self, st1, st2):
+        '''
+        Return the feature vector of the stations st1 and st2, which are
+        not part of the stations of this builder. The row is written by
+        write_rows() as a batch of one, on a shallow copy of the builder
+        holding only st1 and st2.
+        '''
+        fb = copy.copy(self)
+        fb._stats = StationTable()
+        fb._stats.append(st1)
+        fb._stats.append(st2)
+
+        # the missing n-gram count only needs the sizes of the n-gram sets,
+        # string sets also cover n-grams unknown to the n-gram index
+        fb.st_ngram_idx_set = [set(self.ngrams(st.name, self.ngram))
+                               for st in (st1, st2)]
+        fb.topngram_mat = fb.build_topngram_mat()
+
+        fb._name_feats = {}
+        fb._rows = [[], [], [], [], []]
+        fb._pairs = np.zeros((1, 2), dtype=np.int32)
+        fb._n_pairs = 0
+        fb.distr = None
+
         data = []
         ind = []
         iptr = [0]
-        self.write_row(None, None, st1, st2, False, data, ind, iptr)
+        fb.queue_row(0, 1, 0, 1, False, data, ind, iptr)
+        fb.flush_rows(data, ind, iptr)
         return csr_matrix(((data, ind, iptr)), shape=(
             1, self.num_feats + len(self.top_ngrams)), dtype=uint8).todense()
 
     def get_matrix(self):
         return self.matrix
 
-    def dist(self, s1, s2):
-        if s1.lat is not None and s2.lat is not None:
+    def dist(self, s1, s2, bound=-1):
+        '''
+        Distance between two stations in meters. With bound >= 0, a value
+        above bound may be returned for polygon stations whose bounding
+        boxes are already farther apart than bound.
+        '''
+        # in km, such that lower bounds are still above bound when rounded
+        # down to full meters
+        bound = (bound + 1) / 1000 if bound >= 0 else -1
+        lat1 = s1.lat
+        lat2 = s2.lat
+        if lat1 is not None and lat2 is not None:
             if self.cutoff < 500000:
                 mdist = int(min(1000 * 50000.0,
-                    1000 * hav_approx(s1.lon, s1.lat, s2.lon, s2.lat)))
+                    1000 * hav_approx(s1.lon, lat1, s2.lon, lat2)))
             else:
                 mdist = int(min(1000 * 50000.0,
-                    1000 * hav(s1.lon, s1.lat, s2.lon, s2.lat)))
-        elif s1.lat is not None:
+                    1000 * hav(s1.lon, lat1, s2.lon, lat2)))
+        elif lat1 is not None:
             mdist = int(min(1000 * 50000.0,
-                1000 * hav_approx_poly_stat(s2.poly, s1.lon, s1.lat)))
-        elif s2.lat is not None:
+                1000 * hav_approx_poly_stat(s2.poly, s1.lon, lat1, bound)))
+        elif lat2 is not None:
             mdist = int(min(1000 * 50000.0,
-                1000 * hav_approx_poly_stat(s1.poly, s2.lon, s2.lat)))
+                1000 * hav_approx_poly_stat(s1.poly, s2.lon, lat2, bound)))
         else:
             mdist = int(min(1000 * 50000.0,
-                1000 * hav_approx_poly_poly(s1.poly, s2.poly)))
+                1000 * hav_approx_poly_poly(s1.poly, s2.poly, bound)))
         return mdist
 
-    def diffmerge(self, l1, l2):
-        i = 0
-        j = 0
-        ret = []
-
-        while i < len(l1) and j < len(l2):
-            if l1[i][0] == l2[j][0]:
-                ret.append((l1[i][0], l1[i][1] - l2[j][1]))
-                i += 1
-                j += 1
-            elif l1[i][0] < l2[j][0]:
-                ret.append(l1[i])
-                i += 1
-            else:
-                ret.append((l2[j][0], -l2[j][1]))
-                j += 1
-
-        while i < len(l1):
-            ret.append(l1[i])
-            i += 1
-
-        while j < len(l2):
-            ret.append((l2[j][0], -l2[j][1]))
-            j += 1
-
+    def batch_dists(self, sids1, sids2):
+        '''
+        Distances in meters between the stations sids1[i] and sids2[i],
+        equal to those of dist()
+        '''
+        lons = self._stats.lon
+        lats = self._stats.lat
+        lat1 = lats[sids1]
+        lat2 = lats[sids2]
+        pts = ~(np.isnan(lat1) | np.isnan(lat2))
+
+        ret = np.empty(len(sids1), dtype=np.int64)
+        km = hav_batch(lons[sids1[pts]], lat1[pts], lons[sids2[pts]],
+                       lat2[pts], approx=self.cutoff < 500000)
+        ret[pts] = np.minimum(1000 * 50000.0, 1000 * km)
+
+        for i in np.flatnonzero(~pts).tolist():
+            ret[i] = self.dist(self._stats[int(sids1[i])],
+                               self._stats[int(sids2[i])])
         return ret
 
     def get_top_ngrams(self):
@@ -764,18 +981,16 @@ class FeatureBuilder(object):
         pairs = [None] * n
         numtiles = 256
 
-        if st1.lon is not None:
-            lon1 = st1.lon
-            lat1 = st1.lat
-        else:
+        lon1 = st1.lon
+        lat1 = st1.lat
+        if lon1 is None:
             c = centroid(st1.poly)
             lon1 = c[0]
             lat1 = c[1]
 
-        if st2.lon is not None:
-            lon2 = st2.lon
-            lat2 = st2.lat
-        else:
+        lon2 = st2.lon
+        lat2 = st2.lat
+        if lon2 is None:
             c = centroid(st2.poly)
             lon2 = c[0]
             lat2 = c[1]
@@ -799,6 +1014,61 @@ class FeatureBuilder(object):
 
         return pairs
 
+    def batch_positions(self, sids):
+        '''
+        Longitudes and latitudes of stations sids, the centroid is used for
+        polygon stations
+        '''
+        lon = self._stats.lon[sids]
+        lat = self._stats.lat[sids]
+        poly = np.isnan(lon)
+        if poly.any():
+            pids = self._stats.col("poly_id")[sids[poly]]
+            lon[poly] = self._stats.poly_centroids[pids, 0]
+            lat[poly] = self._stats.poly_centroids[pids, 1]
+        return lon, lat
+
+    def batch_pos_pairs(self, sids1, sids2, n):
+        '''
+        Nonzero position pair entries as (row, column, value) arrays for the
+        station pairs (sids1[i], sids2[i]), equal to those of pos_pairs()
+
+        >>> fb = FeatureBuilder()
+        >>> fb._stats = StationTable()
+        >>> fb._stats.add("A", lat=47.99, lon=7.84)
+        0
+        >>> fb._stats.add("B", lat=48.01, lon=7.86)
+        1
+        >>> fb.pos_pairs(fb._stats[0], fb._stats[1], 2)
+        [(133, 196), (133, 195)]
+        >>> [x.tolist() for x in fb.batch_pos_pairs(np.array([0, 1]),
+        ...     np.array([1, 1]), 2)]
+        [[0, 0, 0, 0, 1, 1, 1, 1], [2, 3, 4, 5, 2, 3, 4, 5], [133, 196, 133, 195, 133, 196, 133, 195]]
+        '''
+        numtiles = 256
+
+        lon1, lat1 = self.batch_positions(sids1)
+        lon2, lat2 = self.batch_positions(sids2)
+
+        lon = ((lon1 + lon2) / 2) + 180
+        lat = ((lat1 + lat2) / 2) + 90
+
+        tilelength_x = 360 / numtiles
+        tilelength_y = 180 / numtiles
+
+        tiles = np.empty((len(sids1), 2 * n), dtype=np.int64)
+        tiles[:, 0] = np.trunc(lon / tilelength_x)
+        tiles[:, 1] = np.trunc(lat / tilelength_y)
+
+        for i in range(n - 1):
+            tiles[:, 2 * i + 2] = np.trunc(
+                (lon - (i + 1) * (tilelength_x / n)) / tilelength_x)
+            tiles[:, 2 * i + 3] = np.trunc(
+                (lat - (i + 1) * (tilelength_y / n)) / tilelength_y)
+
+        rows, cols = np.nonzero(tiles)
+        return rows, cols + (self.num_feats - 2 * n), tiles[rows, cols]
+
     def oflow(self, val, st1, st2, cutoff, msg):
         if val > cutoff:
             self.log.warn("Warning: %s=%d between stations '%s' and '%s' does "
@@ -806,149 +1076,294 @@ class FeatureBuilder(object):
             val = 255
         return val
 
-    def build_pairs(self, sid1, wiggle, groups, matched, data, ind, iptr):
-        st1 = self._stats[sid1]
-        group1 = self._grps[st1.gid]
-        count = 0
-        for gid2 in groups:
-            group2 = self._grps[gid2]
-            if st1.gid == gid2:
-                continue
+    def pair_cols(self):
+        '''
+        Per station and per group arrays used by build_pairs() to filter
+        the candidate pairs: group ids, name and original node name ids
+        and lengths, whether a group has a relation and its meta relation
+        id (-1 if none)
+        '''
+        lens = np.array([len(s) for s in self._stats.strings] + [0],
+                        dtype=np.int64)
+        name_id = self._stats.col("name_id").copy()
+        orig_id = self._stats.col("orig_nd_name_id").copy()
+
+        return {
+            "gid": self._stats.gid.copy(),
+            "name_id": name_id,
+            "name_len": lens[name_id],
+            "orig_id": orig_id,
+            "orig_len": lens[orig_id],
+            "has_rel": np.array([bool(g.osm_rel_id) for g in self._grps],
+                                dtype=bool),
+            "meta": np.array([-1 if g.osm_meta_rel_id is None
+                              else g.osm_meta_rel_id for g in self._grps],
+                             dtype=np.int64),
+        }
 
-            if len(st1.name) == 0:
-                continue
+    def group_mask(self, sids1, sids2, cols):
+        '''
+        Mask of the station pairs (sids1[i], sids2[i]) whose groups may be
+        negative-matched, cols are the arrays of pair_cols()
+        '''
+        gids1 = cols["gid"][sids1]
+        gids2 = cols["gid"][sids2]
 
-            if not group2.osm_rel_id and not self.force_orphans:
-                # dont negative-match orphan groups with any other group, as
-                # this is a frequent mistake in OSM and would undermine
-                # the ground truth
-                continue
+        keep = gids1 != gids2
 
-            if self.clean_data and group1.osm_meta_rel_id is not None \
-                    and group2.osm_meta_rel_id is not None \
-                    and group1.osm_meta_rel_id == group2.osm_meta_rel_id:
-                # dont negative-match groups that share a common meta group
-                # these will be positive-matched to stations in their non-meta
-                # group, but when they are grouped with a station in a
-                # meta-group, we count their similarity as 'non decidable'
-                # and keep it out of the ground truth
-                continue
+        if not self.force_orphans:
+            # dont negative-match orphan groups with any other group, as
+            # this is a frequent mistake in OSM and would undermine
+            # the ground truth
+            keep &= cols["has_rel"][gids2]
 
-            for sid2 in group2.stats:
-                if wiggle:
-                    st2 = copy.copy(self._stats[sid2])
-                    st2.lon = st1.lon + random.gauss(0, 0.0005)
-                    st2.lat = st1.lat + random.gauss(0, 0.0005)
-                    st2.spice_id = len(self._stats)
-                    self._stats.append(st2)
-                else:
-                    st2 = self._stats[sid2]
+        if self.clean_data:
+            # dont negative-match groups that share a common meta group
+            # these will be positive-matched to stations in their non-meta
+            # group, but when they are grouped with a station in a
+            # meta-group, we count their similarity as 'non decidable'
+            # and keep it out of the ground truth
+            meta1 = cols["meta"][gids1]
+            keep &= (meta1 == -1) | (meta1 != cols["meta"][gids2])
 
-                if len(st2.name) == 0:
-                    continue
+        return keep
 
-                d = self.dist(st1, st2)
+    def pair_mask(self, sids1, sids2, dists, cols):
+        '''
+        Mask of the station pairs (sids1[i], sids2[i]) at distances dists
+        (meters) which may be written as negative pairs, regardless of
+        their groups
+        '''
+        keep = (cols["name_len"][sids1] > 0) & \
+            (cols["name_len"][sids2] > 0) & (dists <= self.cutoff)
 
-                # this also prevents spicing with pairs we already have
-                if sid2 in matched[sid1] or sid1 in matched[sid2] or \
-                        d > self.cutoff:
-                    continue
+        if self.clean_data:
+            # dont negative-match station with an equivalent name
+            # and a distance < 100 - this is obviously an OSM
+            # mapping mistake, but we don't use it as ground truth
+            same = ((cols["name_len"][sids1] > 2) &
+                    (cols["name_id"][sids1] == cols["name_id"][sids2])) | \
+                ((cols["orig_len"][sids1] > 3) &
+                 (cols["orig_id"][sids1] == cols["orig_id"][sids2]))
+            keep &= ~(same & (dists < 250))
+
+        return keep
+
+    def build_pairs(self, sid1, wiggle, sids, dists, cols, matched, data,
+                    ind, iptr):
+        '''
+        Write negative pairs between station sid1 and the distinct stations
+        sids (an int array), skipping pairs whose key is already in the
+        KeySet matched. cols are the arrays of pair_cols(). Without wiggle,
+        sids must already pass group_mask() and pair_mask(). With wiggle,
+        each station of sids is replaced by a copy moved near sid1, and the
+        masks are applied here, to the distances to the copies.
+        '''
+        if cols["name_len"][sid1] == 0:
+            return
 
-                if self.clean_data and d < 250 and \
-                        ((len(st1.name) > 2 and st1.name == st2.name) or
-                         (len(st1.orig_nd_name) > 3 and
-                          st1.orig_nd_name == st2.orig_nd_name)):
-                    # dont negative-match station with an equivalent name
-                    # and a distance < 100 - this is obviously an OSM
-                    # mapping mistake, but we don't use it as ground truth
-                    continue
+        if wiggle:
+            sids = sids[self.group_mask(sid1, sids, cols)]
 
-                matched[sid1].add(sid2)
+            st1 = self._stats[sid1]
+            gsids = np.empty(len(sids), dtype=np.int64)
+            dists = np.empty(len(sids), dtype=np.int64)
+            for i, sid2 in enumerate(sids.tolist()):
+                st2 = copy.copy(self._stats[sid2])
+                st2.lon = st1.lon + random.gauss(0, 0.0005)
+                st2.lat = st1.lat + random.gauss(0, 0.0005)
+                gsids[i] = len(self._stats)
+                st2.spice_id = gsids[i]
+                self._stats.append(st2)
+                dists[i] = self.dist(st1, st2, self.cutoff)
+
+            keep = self.pair_mask(sid1, sids, dists, cols)
+            sids = sids[keep]
+            gsids = gsids[keep]
+        else:
+            gsids = sids
+
+        if len(sids) == 0:
+            return
+
+        # sids are distinct, so a pair key can only have been written by
+        # an earlier batch. This also prevents spicing with pairs we
+        # already have
+        keys = pair_keys(sid1, sids)
+        new = np.flatnonzero(~matched.contains(keys))
+        matched.add(keys[new])
+
+        # the rows of a pair in both directions follow each other
+        n = len(new)
+        sids1 = np.full(2 * n, sid1, dtype=np.int64)
+        sids2 = np.full(2 * n, sid1, dtype=np.int64)
+        gsids1 = np.full(2 * n, sid1, dtype=np.int64)
+        gsids2 = np.full(2 * n, sid1, dtype=np.int64)
+        sids2[0::2] = sids[new]
+        sids1[1::2] = sids[new]
+        gsids2[0::2] = gsids[new]
+        gsids1[1::2] = gsids[new]
+
+        self.queue_rows(sids1, sids2, gsids1, gsids2,
+                        np.zeros(2 * n, dtype=bool), data, ind, iptr)
+
+    def queue_row(self, sid1, sid2, gsid1, gsid2, match, data, ind, iptr):
+        '''
+        Queue a row comparing the names of stations sid1 and sid2 and the
+        positions of stations gsid1 and gsid2, which differ from sid1 and
+        sid2 for spiced copies. Rows are written in batches of ROW_BATCH.
+        '''
+        rows = self._rows
+        rows[0].append(sid1)
+        rows[1].append(sid2)
+        rows[2].append(gsid1)
+        rows[3].append(gsid2)
+        rows[4].append(match)
+
+        if len(rows[0]) == ROW_BATCH:
+            self.flush_rows(data, ind, iptr)
+
+    def queue_rows(self, sids1, sids2, gsids1, gsids2, match, data, ind,
+                   iptr):
+        '''
+        Queue the rows of queue_row() for arrays of stations
+        '''
+        rows = self._rows
+        for col, vals in zip(rows, (sids1, sids2, gsids1, gsids2, match)):
+            col.extend(vals.tolist())
+
+        if len(rows[0]) >= ROW_BATCH:
+            self.flush_rows(data, ind, iptr)
+
+    def flush_rows(self, data, ind, iptr):
+        '''
+        Write all queued rows to the matrix
+        '''
+        rows = self._rows
+        self._rows = [[], [], [], [], []]
+        self.write_rows(*[np.array(c, dtype=np.int64) for c in rows],
+                        data, ind, iptr)
 
-                self.write_row(sid1, sid2, st1, st2, False, data, ind, iptr)
-                self.write_row(sid2, sid1, st2, st1, False, data, ind, iptr)
-                count += 1
+    def candidate_pairs(self):
+        '''
+        Return the stations within the cutoff distance of each station as
+        CSR-style offsets, station ids and distances in meters, the
+        neighbours of station sid are ids[offsets[sid]:offsets[sid + 1]]
+        '''
+        n = len(self._stats)
+        pairs, dists = station_pairs(self._stats.lon, self._stats.lat,
+                                     self._stats.col("poly_id"),
+                                     self._stats.polys, self.cutoff,
+                                     approx=self.cutoff < 500000,
+                                     with_dists=True)
+
+        # stations of groups dropped during data cleaning are not paired
+        active = np.zeros(n, dtype=bool)
+        for group in self._grps:
+            active[group.stats] = True
+        active = active[pairs[:, 0]] & active[pairs[:, 1]]
+        pairs = pairs[active]
+        dists = dists[active]
+
+        both = np.concatenate((pairs, pairs[:, ::-1]))
+        both_dists = np.concatenate((dists, dists))
+        order = np.lexsort((both[:, 1], both[:, 0]))
+        both = both[order]
+
+        self.log.info("Found %d station pairs within %d meters"
+                      % (len(pairs), self.cutoff))
+
+        return (np.searchsorted(both[:, 0], np.arange(n + 1)), both[:, 1],
+                both_dists[order])
 
     def prepare_features(self):
         if 'lev_simi' in self.features:
             self.lev_simi_idx = self.num_feats
             self.num_feats = self.num_feats + 1
             self.feature_idx['lev_simi'] = self.lev_simi_idx
-            if self.write_distr:
-                self.lev_simi_file = open("lev_simi.distr", 'w')
+            if self.distr:
+                self.distr.add_feature('lev_simi', 0, 1)
 
         if 'geodist' in self.features:
             self.geodist_idx = self.num_feats
             self.num_feats = self.num_feats + 1
             self.feature_idx['geodist'] = self.geodist_idx
-            if self.write_distr:
-                self.geodist_file = open("geodist.distr", 'w')
+            if self.distr:
+                # in meters, at the resolution of the matrix column
+                self.distr.add_feature('geodist', 0, 4 * 256, 256)
 
         if 'ped_simi_fw' in self.features:
             self.ped_simi_fw_idx = self.num_feats
             self.num_feats = self.num_feats + 1
             self.feature_idx['ped_simi_fw'] = self.ped_simi_fw_idx
-            if self.write_distr:
-                self.ped_simi_fw_file = open("ped_simi_fw.distr", 'w')
 
         if 'ped_simi_bw' in self.features:
             self.ped_simi_bw_idx = self.num_feats
             self.num_feats = self.num_feats + 1
             self.feature_idx['ped_simi_bw'] = self.ped_simi_bw_idx
-            if self.write_distr:
-                self.ped_simi_bw_file = open("ped_simi_bw.distr", 'w')
 
         if 'sed_simi_fw' in self.features:
             self.sed_simi_fw_idx = self.num_feats
             self.num_feats = self.num_feats + 1
             self.feature_idx['sed_simi_fw'] = self.sed_simi_fw_idx
-            if self.write_distr:
-                self.sed_simi_fw_file = open("sed_simi_fw.distr", 'w')
 
         if 'sed_simi_bw' in self.features:
             self.sed_simi_bw_idx = self.num_feats
             self.num_feats = self.num_feats + 1
             self.feature_idx['sed_simi_bw'] = self.sed_simi_bw_idx
-            if self.write_distr:
-                self.sed_simi_bw_file = open("sed_simi_bw.distr", 'w')
 
         if 'jaccard_simi' in self.features:
             self.jaccard_simi_idx = self.num_feats
             self.num_feats = self.num_feats + 1
             self.feature_idx['jaccard_simi'] = self.jaccard_simi_idx
-            if self.write_distr:
-                self.jaccard_simi_file = open("jaccard_simi.distr", 'w')
 
         if 'missing_ngram_count' in self.features:
             self.missing_ngram_count_idx = self.num_feats
             self.num_feats = self.num_feats + 1
             self.feature_idx[
                 'missing_ngram_count'] = self.missing_ngram_count_idx
-            if self.write_distr:
-                self.missing_ngram_count_file = open(
-                    "missing_ngram_count.distr", 'w')
 
         if 'bts_simi' in self.features:
             self.bts_simi_idx = self.num_feats
             self.num_feats = self.num_feats + 1
             self.feature_idx['bts_simi'] = self.bts_simi_idx
-            if self.write_distr:
-                self.bts_file = open("bts.distr", 'w')
+            if self.distr:
+                self.distr.add_feature('bts_simi', 0, 1)
 
         if 'jaro_simi' in self.features:
             self.jaro_simi_idx = self.num_feats
             self.num_feats = self.num_feats + 1
             self.feature_idx['jaro_simi'] = self.jaro_simi_idx
-            if self.write_distr:
-                self.jaro_simi_file = open("jaro_simi.distr", 'w')
 
         if 'jaro_winkler_simi' in self.features:
             self.jaro_winkler_simi_idx = self.num_feats
             self.num_feats = self.num_feats + 1
             self.feature_idx['jaro_winkler_simi'] = self.jaro_winkler_simi_idx
-            if self.write_distr:
-                self.jaro_winkler_simi_file = open(
-                    "jaro_winkler_simi.distr", 'w')
 
         # number of features we use besides the ngram index
         self.num_feats = self.num_feats + 2 * self.num_pos_pairs
+
+
+def row_entries(entries, inv):
+    '''
+    Return (row, column, value) arrays of the entries of a batch of rows,
+    row i has the (column, value) entries entries[inv[i]]
+
+    >>> [x.tolist() for x in row_entries([[(1, 5)], [], [(2, 6), (4, 7)]],
+    ...     np.array([2, 0, 1, 2]))]
+    [[0, 0, 1, 3, 3], [2, 4, 1, 2, 4], [6, 7, 5, 6, 7]]
+    '''
+    lens = np.array([len(e) for e in entries], dtype=np.int64)
+    offs = np.zeros(len(entries) + 1, dtype=np.int64)
+    np.cumsum(lens, out=offs[1:])
+    flat = np.array([x for e in entries for x in e],
+                    dtype=np.int64).reshape(-1, 2)
+
+    row_lens = lens[inv]
+    rows = np.repeat(np.arange(len(inv)), row_lens)
+    # position of each entry in flat
+    idx = np.arange(len(rows)) + np.repeat(
+        offs[inv] - (np.cumsum(row_lens) - row_lens), row_lens)
+
+    return rows, flat[idx, 0], flat[idx, 1]
+
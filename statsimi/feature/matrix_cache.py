@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright 2019, University of Freiburg.
+Chair of Algorithms and Data Structures.
+Patrick Brosi <brosi@informatik.uni-freiburg.de>
+'''
+
+import os
+import shutil
+import pickle
+import hashlib
+import logging
+import numpy as np
+from scipy.sparse import csr_matrix
+from statsimi.osm.osm_parser import OsmParser
+from statsimi.osm.snapshot import SnapshotCache
+from statsimi.osm.snapshot import StringPool
+from statsimi.osm.snapshot import read_snapshot
+from statsimi.osm.snapshot import write_snapshot
+from statsimi.feature.feature_builder import FeatureBuilder
+
+# bump this if the matrix cache layout or the features change
+MATRIX_VERSION = 2
+
+
+def write_matrix(fb, bounds, path):
+    '''
+    Write the feature matrix, the pairs, the stations and groups and the
+    n-gram vocabulary of the FeatureBuilder fb to the directory path. Every
+    array is stored as a separate .npy file, the stations and groups as a
+    snapshot in the sub directory "stations".
+    '''
+
+    # the snapshot is written from an otherwise empty parser
+    osmp = OsmParser()
+    osmp.stations = fb.stations
+    osmp.groups = fb.groups
+    osmp.ll = list(bounds[0])
+    osmp.ur = list(bounds[1])
+
+    ngram_id_idx, id_ngram_idx, top_ngrams = fb.get_ngram_idx()
+
+    pool = StringPool()
+    for gram, _ in id_ngram_idx:
+        pool.add(gram)
+    blob, offs = pool.arrays()
+
+    matrix = fb.get_matrix()
+
+    cols = {
+        "data": matrix.data,
+        "indices": matrix.indices,
+        "indptr": matrix.indptr,
+        "shape": np.array(matrix.shape, dtype=np.int64),
+        "pairs": fb.pairs,
+        "ngram_blob": blob,
+        "ngram_offs": offs,
+        "ngram_occs": np.array([occ for _, occ in id_ngram_idx],
+                               dtype=np.int64),
+        "top_ngrams": np.array(sorted(top_ngrams), dtype=np.int64),
+        "version": np.array([MATRIX_VERSION], dtype=np.int64),
+    }
+
+    # write to a temporary directory first, so that an interrupted write
+    # never leaves a broken cache entry behind
+    tmp = path + ".tmp%d" % os.getpid()
+    os.makedirs(tmp, exist_ok=True)
+    for col, arr in cols.items():
+        np.save(os.path.join(tmp, col + ".npy"), arr)
+    write_snapshot(osmp, os.path.join(tmp, "stations"))
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+
+
+def read_matrix(path, fbargs):
+    '''
+    Read a FeatureBuilder written by write_matrix from path. The matrix
+    arrays and the pairs are memory-mapped. Return None if the entry has an
+    outdated layout.
+
+    >>> import tempfile
+    >>> from statsimi.osm.osm_parser import OsmParser
+    >>> p = OsmParser()
+    >>> p.parse_xml("testdata/test.osm", False, True)
+    >>> fb = FeatureBuilder(bbox=p.bounds)
+    >>> fb.build_from_stat_grp(p.stations, p.groups)
+    >>> d = tempfile.TemporaryDirectory()
+    >>> write_matrix(fb, p.bounds, os.path.join(d.name, "mat"))
+    >>> fc = read_matrix(os.path.join(d.name, "mat"), {})
+    >>> (fc.get_matrix() != fb.get_matrix()).nnz
+    0
+    >>> np.array_equal(fc.pairs, fb.pairs)
+    True
+    >>> fc.get_ngram_idx() == fb.get_ngram_idx()
+    True
+    >>> [str(st) for st in fc.stations] == [str(st) for st in fb.stations]
+    True
+    >>> [g.stats for g in fc.groups] == [g.stats for g in fb.groups]
+    True
+    >>> d.cleanup()
+    '''
+
+    def col(name):
+        return np.load(os.path.join(path, name + ".npy"), mmap_mode='r')
+
+    if col("version")[0] != MATRIX_VERSION:
+        return None
+
+    osmp = OsmParser()
+    if not read_snapshot(osmp, os.path.join(path, "stations")):
+        return None
+
+    grams = StringPool.unpack(col("ngram_blob"), col("ngram_offs"))
+    id_ngram_idx = list(zip(grams, col("ngram_occs").tolist()))
+    ngram_id_idx = {gram: i for i, gram in enumerate(grams)}
+    top_ngrams = {y: x for x, y in enumerate(col("top_ngrams").tolist())}
+
+    matrix = csr_matrix((col("data"), col("indices"), col("indptr")),
+                        shape=tuple(col("shape").tolist()), dtype=np.uint8)
+
+    fb = FeatureBuilder(bbox=osmp.bounds, **fbargs)
+    fb.build_from_matrix(osmp.stations, osmp.groups, col("pairs"), matrix,
+                         [ngram_id_idx, id_ngram_idx, top_ngrams])
+    return fb
+
+
+class MatrixCache(SnapshotCache):
+    '''
+    Caches built feature matrices in a directory. Entries are keyed by the
+    content hash of the input files, the parse options, the normalization
+    rules and the feature builder arguments.
+    '''
+
+    def __init__(self, cache_dir):
+        SnapshotCache.__init__(self, cache_dir)
+        self.log = logging.getLogger('matcache')
+
+    def key(self, input_key, norm_rule_file=None, fbargs={}):
+        '''
+        The cache key for the input files with snapshot key input_key, the
+        normalization rules file and the feature builder arguments.
+        '''
+        h = hashlib.sha1()
+        h.update(("%s:%d" % (input_key, MATRIX_VERSION)).encode("utf-8"))
+        if norm_rule_file:
+            h.update(self.file_hash(norm_rule_file).encode("utf-8"))
+
+        # the order of the features does not matter
+        args = sorted((k, sorted(v) if k == "features" else v)
+                      for k, v in fbargs.items())
+        h.update(pickle.dumps(args, protocol=4))
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, "matrix-" + key)
+
+    def load(self, key, fbargs):
+        '''
+        Load the FeatureBuilder for key, return None on a cache miss.
+        '''
+        path = self.path(key)
+        if not os.path.isdir(path):
+            return None
+        self.log.info("Reading feature matrix from cache %s..." % path)
+        return read_matrix(path, fbargs)
+
+    def store(self, key, fb, bounds):
+        path = self.path(key)
+        self.log.info("Writing feature matrix to cache %s..." % path)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        write_matrix(fb, bounds, path)
@@ -6,12 +6,21 @@ Patrick Brosi <brosi@informatik.uni-freiburg.de>
 '''
 
 import logging
+import os
+import copy
+import multiprocessing as mp
 import numpy as np
 import math
 import pickle
 
 from statsimi.osm.osm_parser import OsmParser
+from statsimi.osm.snapshot import SnapshotCache
+from statsimi.osm.snapshot import read_snapshot
+from statsimi.osm.snapshot import write_snapshot
 from statsimi.feature.feature_builder import FeatureBuilder
+from statsimi.feature.matrix_cache import MatrixCache
+from statsimi.feature.station_idx import StationIdx
+from statsimi.feature.station_table import StationTable
 
 from statsimi.classifiers.geodist_classifier import GeoDistClassifier
 from statsimi.classifiers.ed_classifier import EditDistClassifier
@@ -52,23 +61,61 @@ meth_feats = {
 EPSILON = 0.0001
 
 
+def parse_osm_file(job):
+    '''
+    Parse a single OSM input file into a new OsmParser, used by the
+    worker processes parsing multiple input files
+    '''
+
+    path, ftype, unique, with_polygons, region, keep_tags, workers = job
+
+    osmp = OsmParser(region)
+    osmp.keep_tags = keep_tags
+
+    if ftype == "osm":
+        osmp.parse_xml(path, unique=unique, with_polygons=with_polygons)
+    elif ftype == "osm_bzip":
+        osmp.parse_bz2(path, unique=unique, with_polygons=with_polygons,
+                       workers=workers)
+    elif ftype == "osm_pbf":
+        osmp.parse_pbf(path, unique=unique, with_polygons=with_polygons,
+                       workers=workers)
+
+    return osmp
+
+
 class ModelBuilder(object):
     '''
     Build a model from parameters.
     '''
 
     def __init__(self, method="rf", norm_rule_file=None, voting='soft',
-                 unique_names=False, with_polygons=False):
+                 unique_names=False, with_polygons=False, workers=None,
+                 cache_dir=None, region=None):
         '''
         Constructor.
         '''
         self.log = logging.getLogger('modelbld')
         self.method = method
         self.normzer = None
+        self.norm_rule_file = norm_rule_file
         self.voting = voting
         self.unique_names = unique_names
         self.with_polygons = with_polygons
 
+        # number of worker processes used for parsing, None = all CPUs
+        self.workers = workers
+
+        # if set, only OSM stations inside of this region are parsed
+        self.region = region
+
+        # caches for parsed OSM files and built feature matrices
+        self.snapshots = None
+        self.matrices = None
+        if cache_dir:
+            self.snapshots = SnapshotCache(cache_dir)
+            self.matrices = MatrixCache(cache_dir)
+
         if norm_rule_file:
             self.normzer = Normalizer(norm_rule_file)
 
@@ -205,8 +252,7 @@ class ModelBuilder(object):
         with open(outfile, 'w') as f:
             for i, pid in enumerate(idx):
                 match = y[i]
-                sid1 = data.pairs[pid][0]
-                sid2 = data.pairs[pid][1]
+                sid1, sid2 = data.pairs[pid].tolist()
 
                 st1 = data.stations[sid1]
                 st2 = data.stations[sid2]
@@ -223,6 +269,8 @@ class ModelBuilder(object):
     def file_type(self, path):
         if path[-3:] == 'bz2':
             return "osm_bzip"
+        if path[-3:] == 'pbf':
+            return "osm_pbf"
         with open(path, 'r', encoding='utf-8') as f:
             line = f.readline()
             if len(line.split("\t")) == 9:
@@ -287,7 +335,12 @@ class ModelBuilder(object):
         bounds[0] = ll
         bounds[1] = ur
 
-    def build_from_file(self, files, fbargs={}):
+    def build_from_file(self, files, fbargs={}, station_db=None):
+        '''
+        Build the features for the input files. If station_db is given,
+        the parsed OSM stations are written to it, together with the raw
+        tags needed to later apply change files with build_from_osc.
+        '''
         self.log.info("Reading '%s'..." % ", ".join(files))
         meths = self.method.split(",")
         fbargs['features'] = list(
@@ -295,37 +348,63 @@ class ModelBuilder(object):
         self.log.info("Parsing station pairs...")
 
         # build dataset from OSM file
-        osmp = OsmParser()
+        osmp = OsmParser(self.region)
+        osmp.keep_tags = station_db is not None
         t = ""
 
         groups = []
-        stations = []
+        stations = StationTable()
         pairs = []
         simi = []
         bounds = [0, 0]
 
-        for filepath in files:
-            if self.file_type(filepath) == "osm":
-                if t == "pfile":
-                    self.log.error("Cannot mix OSM and pairs input files")
-                    exit(1)
-                osmp.parse_xml(filepath, unique=self.unique_names, with_polygons=self.with_polygons)
-                t = "osm"
-                bounds = osmp.bounds
-            if self.file_type(filepath) == "osm_bzip":
-                if t == "pfile":
-                    self.log.error("Cannot mix OSM and pairs input files")
-                    exit(1)
-                osmp.parse_bz2(filepath, unique=self.unique_names, with_polygons=self.with_polygons)
+        snapshot_key = None
+        matrix_key = None
+
+        if self.snapshots and station_db is None:
+            snapshot_key = self.snapshots.key(
+                files, self.unique_names, self.with_polygons, self.region)
+
+            # spiced features are random, never cache them, and only
+            # record feature distributions on a fresh build
+            if not fbargs.get("spice") and not fbargs.get("distr_out"):
+                matrix_key = self.matrices.key(
+                    snapshot_key, self.norm_rule_file, fbargs)
+                f = self.matrices.load(matrix_key, fbargs)
+                if f is not None:
+                    self.log.info("%d station pairs" % f.matrix.shape[0])
+                    return f
+
+            if any(self.file_type(fp) == "pfile" for fp in files):
+                snapshot_key = None
+            elif self.snapshots.load(snapshot_key, osmp):
                 t = "osm"
                 bounds = osmp.bounds
-            if self.file_type(filepath) == "pfile":
-                if t == "osm":
-                    self.log.error("Cannot mix OSM and pairs input files")
-                    exit(1)
+                files = []
+                snapshot_key = None
+
+        osm_files = [fp for fp in files if self.file_type(fp) != "pfile"]
+
+        if len(osm_files) and len(osm_files) != len(files):
+            self.log.error("Cannot mix OSM and pairs input files")
+            exit(1)
+
+        if len(osm_files):
+            self.parse_osm_files(osm_files, osmp)
+            t = "osm"
+            bounds = osmp.bounds
+        else:
+            for filepath in files:
                 self.parse_pairs(filepath, stations, pairs, simi, bounds)
                 t = "pfile"
 
+        if snapshot_key:
+            self.snapshots.store(snapshot_key, osmp)
+
+        if station_db and t == "osm":
+            self.log.info("Writing station database %s..." % station_db)
+            write_snapshot(osmp, station_db)
+
         self.log.info("Building features...")
 
         f = FeatureBuilder(bbox=bounds, **fbargs)
@@ -347,6 +426,157 @@ class ModelBuilder(object):
 
             f.build_from_pairs(stations, pairs, simi)
 
+        if matrix_key:
+            self.matrices.store(matrix_key, f, bounds)
+
+        self.log.info("%d station pairs" % f.matrix.shape[0])
+
+        return f
+
+    def parse_osm_files(self, files, osmp):
+        '''
+        Parse the OSM input files into osmp. Multiple files are parsed in
+        parallel, each in its own worker process, and merged in order.
+        '''
+
+        jobs = [(fp, self.file_type(fp), self.unique_names,
+                 self.with_polygons, self.region, osmp.keep_tags, 1)
+                for fp in files]
+
+        if len(files) == 1:
+            # a single file uses the workers itself
+            jobs[0] = jobs[0][:-1] + (self.workers,)
+            osmp.merge(parse_osm_file(jobs[0]))
+            return
+
+        workers = min(self.workers or mp.cpu_count(), len(files))
+
+        if workers == 1:
+            for job in jobs:
+                osmp.merge(parse_osm_file(job))
+            return
+
+        self.log.info("Parsing %d input files with %d workers..." % (
+            len(files), workers))
+
+        with mp.Pool(workers) as pool:
+            for res in pool.imap(parse_osm_file, jobs):
+                osmp.merge(res)
+
+    def build_from_osc(self, station_db, osc_files, fbargs={}):
+        '''
+        Apply the OSM change files osc_files to the station database
+        station_db written by build_from_file, and build the features only
+        for the neighbourhoods of the changed stations: the groups within
+        cutoffdist of a changed station (at its old or new position), plus
+        the groups within cutoffdist of those as context.
+        '''
+        meths = self.method.split(",")
+        fbargs['features'] = list(
+            set(sum([meth_feats.get(m.strip(), []) for m in meths], [])))
+
+        osmp = OsmParser(self.region)
+
+        if not os.path.isdir(station_db) or not read_snapshot(
+                osmp, station_db) or not osmp.keep_tags:
+            self.log.error("No valid station database at %s, build one "
+                           "from an OSM file first." % station_db)
+            exit(1)
+
+        old_stations = osmp.stations
+
+        changed = set()
+        for path in osc_files:
+            self.log.info("Applying change file %s..." % path)
+            changed.update(osmp.apply_osc(path, unique=self.unique_names))
+
+        self.log.info("Writing station database %s..." % station_db)
+        write_snapshot(osmp, station_db)
+
+        stations, groups, bounds = self.affected_stations(
+            osmp, old_stations, changed, fbargs.get("cutoffdist", 1000))
+
+        self.log.info("%d changed OSM stations, building features for %d "
+                      "stations in %d groups..." % (len(changed),
+                                                    len(stations),
+                                                    len(groups)))
+
+        if self.normzer:
+            self.log.info("Applying label normalization...")
+            self.normzer.normalize(groups, stations)
+
+        f = FeatureBuilder(bbox=bounds, **fbargs)
+        f.build_from_stat_grp(stations, groups)
+
         self.log.info("%d station pairs" % f.matrix.shape[0])
 
         return f
+
+    def affected_stations(self, osmp, old_stations, changed, d):
+        '''
+        Return the stations, groups and bounds of the sub-problem of osmp
+        affected by the changed OSM ids, with station and group ids
+        remapped to the sub-problem
+        '''
+
+        def points(st):
+            if st.lat is not None:
+                return [(st.lon, st.lat)]
+            return st.poly
+
+        def neighbors(st):
+            if st.lat is not None:
+                return idx.get_neighbors(st.lon, st.lat, d).tolist()
+            return idx.get_neighbors_poly(st.poly, d).tolist()
+
+        if len(osmp.stations) == 0:
+            return StationTable(), [], osmp.bounds
+
+        idx = StationIdx(d, osmp.bounds)
+        for st in osmp.stations:
+            if st.lat is not None:
+                idx.add_stat_group(st.gid, st.lon, st.lat)
+            else:
+                idx.add_stat_group_poly(st.gid, st.poly)
+
+        changed = np.array(sorted(changed), dtype=np.int64)
+
+        # groups near the changed stations, at the old and new positions
+        gids = set()
+        for stats in (old_stations, osmp.stations):
+            for sid in np.flatnonzero(np.isin(stats.osmnid, changed)):
+                st = stats[sid]
+                if stats is osmp.stations:
+                    gids.add(st.gid)
+                gids.update(neighbors(st))
+
+        # their neighbour groups, as the context of the changed groups
+        ctx = set()
+        for gid in gids:
+            for sid in osmp.groups[gid].stats:
+                ctx.update(neighbors(osmp.stations[sid]))
+        gids.update(ctx)
+
+        gid_map = np.full(len(osmp.groups), -1, dtype=np.int64)
+        stations = StationTable()
+        groups = []
+        ll = [float("inf"), float("inf")]
+        ur = [-float("inf"), -float("inf")]
+
+        for gid in sorted(gids):
+            gid_map[gid] = len(groups)
+            g = copy.copy(osmp.groups[gid])
+            g.stats = []
+            for sid in osmp.groups[gid].stats:
+                g.stats.append(len(stations))
+                stations.append(osmp.stations[sid])
+                for lon, lat in points(osmp.stations[sid]):
+                    ll = [min(ll[0], lat), min(ll[1], lon)]
+                    ur = [max(ur[0], lat), max(ur[1], lon)]
+            groups.append(g)
+
+        stations.gid[:] = gid_map[stations.gid]
+        orig_gid = gid_map[stations.orig_gid]
+        stations.orig_gid[:] = np.where(orig_gid < 0, stations.gid, orig_gid)
+
+        return stations, groups, [ll, ur]
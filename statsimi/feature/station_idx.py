@@ -6,11 +6,47 @@ Patrick Brosi <brosi@informatik.uni-freiburg.de>
 '''
 
 import math
+from array import array
+
+import numpy as np
+from scipy.spatial import cKDTree
+from statsimi.util import hav_approx_poly_stat, hav_approx_poly_poly
+from statsimi.util import hav_batch
+
+# earth radius in meters, as used by the haversine functions in cutil
+EARTH_RADIUS = 6371000.0
 
 
 class StationIdx(object):
     '''
-    TODO
+    Grid index of station group ids over web mercator cells. Only
+    non-empty cells are stored: entries are collected as (cell, id)
+    pairs and sorted into a CSR-style cell table on the first query,
+    so memory scales with the number of stations, not with the area
+    of the bounding box.
+
+    >>> idx = StationIdx(1000, [[47.9, 7.7], [48.1, 7.9]])
+    >>> idx.add_stat_group(0, 7.80, 48.00)
+    >>> idx.add_stat_group(1, 7.801, 48.001)
+    >>> idx.add_stat_group(2, 7.85, 48.05)
+    >>> idx.add_stat_group_poly(3, [(7.80, 48.0), (7.81, 48.0)])
+    >>> idx.get_neighbors(7.80, 48.00, 500).tolist()
+    [0, 1, 3]
+    >>> idx.get_neighbors(7.85, 48.05, 500).tolist()
+    [2]
+    >>> idx.get_neighbors_poly([(7.85, 48.05), (7.80, 48.0)], 500).tolist()
+    [0, 1, 2, 3]
+    >>> len(idx.cell_ids) < (idx.x_size + 1) * (idx.y_size + 1)
+    True
+
+    Polygons are indexed in all cells covered by their bounding box, a
+    long platform is found from a position next to its middle:
+
+    >>> idx.add_stat_group_poly(4, [(7.70, 47.95), (7.72, 47.95)])
+    >>> idx.get_neighbors(7.71, 47.95, 100).tolist()
+    [4]
+    >>> idx.get_neighbors_poly([(7.70, 47.95), (7.72, 47.95)], 100).tolist()
+    [4]
     '''
 
     def __init__(self, cell_size, bbox):
@@ -33,8 +69,15 @@ class StationIdx(object):
         self.x_size = math.ceil(self.width / self.cell_size)
         self.y_size = math.ceil(self.height / self.cell_size)
 
-        self.idx = [[set() for y in range(self.y_size + 1)]
-                    for x in range(self.x_size + 1)]
+        # (cell, id) entries added since the last build
+        self._cells = array("q")
+        self._ids = array("q")
+
+        # sorted distinct non-empty cell ids, the entries of cell_ids[i]
+        # are ids[offsets[i]:offsets[i + 1]]
+        self.cell_ids = np.zeros(0, dtype=np.int64)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.ids = np.zeros(0, dtype=np.int64)
 
     def get_cell(self, x, y):
         '''
@@ -51,6 +94,13 @@ class StationIdx(object):
                 dy /
                 self.cell_size))
 
+    def cell_id(self, x, y):
+        '''
+        Return the id of grid cell (x, y), cells are numbered column-wise
+        '''
+
+        return min(x, self.x_size) * (self.y_size + 1) + min(y, self.y_size)
+
     def add_stat_group(self, id, lon, lat):
         '''
         Add station to lon/lat position
@@ -59,17 +109,55 @@ class StationIdx(object):
         xy = self.lonlat_to_merc(lon, lat)
 
         coords = self.get_cell(xy[0], xy[1])
-        self.idx[coords[0]][coords[1]].add(id)
+        self._cells.append(self.cell_id(coords[0], coords[1]))
+        self._ids.append(id)
 
     def add_stat_group_poly(self, id, poly):
         '''
-        Add station based on polyon [lon, lat]
+        Add station based on polyon [lon, lat], to all cells covered by
+        the bounding box of the polygon
+        '''
+
+        box = self.merc_bbox(poly)
+        ll = self.get_cell(box[0], box[1])
+        ur = self.get_cell(box[2], box[3])
+
+        xs = np.arange(min(ll[0], self.x_size), min(ur[0], self.x_size) + 1)
+        ys = np.arange(min(ll[1], self.y_size), min(ur[1], self.y_size) + 1)
+        cells = (xs[:, None] * (self.y_size + 1) + ys[None, :]).ravel()
+
+        self._cells.extend(cells.tolist())
+        self._ids.extend([id] * len(cells))
+
+    def build(self):
+        '''
+        Merge the entries added since the last build into the cell table
         '''
 
-        # TODO! we have to check whether the polygon boundary crosses the grid cell
+        if len(self._ids) == 0:
+            return
+
+        cells = np.concatenate([
+            np.repeat(self.cell_ids, np.diff(self.offsets)),
+            np.frombuffer(self._cells, dtype=np.int64)])
+        ids = np.concatenate([
+            self.ids, np.frombuffer(self._ids, dtype=np.int64)])
+
+        self._cells = array("q")
+        self._ids = array("q")
 
-        for lon, lat in poly:
-            self.add_stat_group(id, lon, lat)
+        order = np.lexsort((ids, cells))
+        cells = cells[order]
+        ids = ids[order]
+
+        # an id is stored only once per cell
+        keep = np.ones(len(ids), dtype=bool)
+        keep[1:] = (cells[1:] != cells[:-1]) | (ids[1:] != ids[:-1])
+        cells = cells[keep]
+
+        self.ids = ids[keep]
+        self.cell_ids, starts = np.unique(cells, return_index=True)
+        self.offsets = np.append(starts, len(cells))
 
     def get_neighbors_poly(self, poly, d):
         '''
@@ -79,41 +167,172 @@ class StationIdx(object):
         included.
         '''
 
-        # TODO! we have to check whether the polygon boundary crosses the grid cell
-
-        ret = set()
+        box = self.merc_bbox(poly)
 
-        for lon, lat in poly:
-            ret.update(self.get_neighbors(lon, lat, d))
-
-        return ret
+        return np.unique(self.box_range(box[0] - d, box[1] - d,
+                                        box[2] + d, box[3] + d))
 
     def get_neighbors(self, lon, lat, d):
         '''
-        Return neighbors at distance d (meters) from lon/lat pair.
+        Return neighbors at distance d (meters) from lon/lat pair, as a
+        sorted numpy array.
         d is a lower bound: each station with distance d from the lon/lat pair
         is included, but additional stations with a distance > d may be
         included.
         '''
 
+        return np.unique(self.cell_range(lon, lat, d))
+
+    def cell_range(self, lon, lat, d):
+        '''
+        Return the ids in all cells intersecting the square of half side
+        length d around lon/lat, possibly with duplicates
+        '''
+
         xy = self.lonlat_to_merc(lon, lat)
 
-        ll = self.get_cell(xy[0] - d, xy[1] - d)
-        ur = self.get_cell(xy[0] + d, xy[1] + d)
+        return self.box_range(xy[0] - d, xy[1] - d, xy[0] + d, xy[1] + d)
 
-        ret = set()
+    def box_range(self, min_x, min_y, max_x, max_y):
+        '''
+        Return the ids in all cells intersecting the web mercator box,
+        possibly with duplicates
+        '''
 
-        for x in range(max(0, ll[0]), min(len(self.idx) - 1, ur[0]) + 1):
-            for y in range(max(0, ll[1]), min(
-                    len(self.idx[x]) - 1, ur[1]) + 1):
-                ret.update(self.idx[x][y])
+        self.build()
 
-        return ret
+        ll = self.get_cell(min_x, min_y)
+        ur = self.get_cell(max_x, max_y)
+
+        y0 = min(ll[1], self.y_size)
+        y1 = min(ur[1], self.y_size)
+
+        # the cells of each grid column are a contiguous range of cell ids
+        xs = np.arange(min(ll[0], self.x_size), min(ur[0], self.x_size) + 1)
+        lo = np.searchsorted(self.cell_ids, xs * (self.y_size + 1) + y0)
+        hi = np.searchsorted(self.cell_ids, xs * (self.y_size + 1) + y1,
+                             side="right")
+
+        return np.concatenate(
+            [self.ids[self.offsets[a]:self.offsets[b]]
+             for a, b in zip(lo.tolist(), hi.tolist())])
 
     def lonlat_to_merc(self, lon, lat):
         a = math.sin(lat * 0.017453292519943295)
         return (6378137.0 * lon * 0.017453292519943295,
                 3189068.5 * math.log((1.0 + a) / (1.0 - a)))
 
+    def merc_bbox(self, poly):
+        '''
+        Return the web mercator bounding box (min_x, min_y, max_x, max_y)
+        of a polygon [lon, lat]
+        '''
+
+        xys = [self.lonlat_to_merc(lon, lat) for lon, lat in poly]
+        xs = [xy[0] for xy in xys]
+        ys = [xy[1] for xy in xys]
+        return min(xs), min(ys), max(xs), max(ys)
+
     def webmerc_scale(self, y):
         return math.cos(2 * math.atan(math.exp(y / 6378137)) - 1.5707965)
+
+
+def to_ecef(lons, lats):
+    '''
+    Project lon/lat arrays onto 3D points on a sphere with EARTH_RADIUS,
+    the chord between two points is a lower bound for their distance
+    '''
+
+    lons = np.radians(lons)
+    lats = np.radians(lats)
+    return EARTH_RADIUS * np.column_stack((
+        np.cos(lats) * np.cos(lons),
+        np.cos(lats) * np.sin(lons),
+        np.sin(lats)))
+
+
+def station_pairs(lons, lats, poly_ids, polys, d, approx=True,
+                  with_dists=False):
+    '''
+    Return all pairs of stations at distance at most d (meters) as an
+    (n, 2) int32 array of (sid1, sid2) with sid1 < sid2, sorted. Stations
+    are given as lon/lat arrays, polygon stations have NaN coordinates
+    and poly_ids into the list polys. Distances are rounded down to full
+    meters, as in FeatureBuilder.dist(). With with_dists, the int64 array
+    of the distances of the pairs is returned as well.
+
+    >>> lons = np.array([7.8, 7.805, 7.9, np.nan])
+    >>> lats = np.array([48.0, 48.0, 48.0, np.nan])
+    >>> poly_ids = np.array([-1, -1, -1, 0])
+    >>> polys = [[(7.899, 48.001), (7.898, 48.001), (7.898, 48.002)]]
+    >>> station_pairs(lons, lats, poly_ids, polys, 400).tolist()
+    [[0, 1], [2, 3]]
+    >>> station_pairs(lons, lats, poly_ids, polys, 100).tolist()
+    []
+    >>> len(station_pairs(lons, lats, poly_ids, polys, 10000))
+    6
+    >>> station_pairs(lons, lats, poly_ids, polys, 400, with_dists=True)[1]
+    array([372, 133])
+    '''
+
+    n = len(lons)
+    if n == 0:
+        if with_dists:
+            return np.zeros((0, 2), dtype=np.int32), np.zeros(0, np.int64)
+        return np.zeros((0, 2), dtype=np.int32)
+
+    # stations are balls around a center, with radius 0 for points
+    is_poly = poly_ids >= 0
+    centers = np.zeros((n, 3))
+    radii = np.zeros(n)
+    centers[~is_poly] = to_ecef(lons[~is_poly], lats[~is_poly])
+
+    for sid in np.flatnonzero(is_poly).tolist():
+        verts = to_ecef(*np.array(polys[poly_ids[sid]], dtype=float).T)
+        centers[sid] = verts.mean(axis=0)
+        radii[sid] = np.sqrt(((verts - centers[sid]) ** 2).sum(axis=1)).max()
+
+    # chords are shorter than arcs, the slack covers the deviation of the
+    # approximations and the rounding to full meters
+    r = d * (1 + 1e-6) + 1
+    tree = cKDTree(centers)
+
+    cands = [tree.query_pairs(r, output_type="ndarray")]
+
+    max_radius = radii.max()
+    for sid in np.flatnonzero(is_poly).tolist():
+        near = np.array(tree.query_ball_point(
+            centers[sid], r + radii[sid] + max_radius), dtype=np.int64)
+        dists = np.sqrt(((centers[near] - centers[sid]) ** 2).sum(axis=1))
+        near = near[(dists <= r + radii[sid] + radii[near]) & (near != sid)]
+        cands.append(np.column_stack((np.minimum(near, sid),
+                                      np.maximum(near, sid))))
+
+    pairs = np.unique(np.concatenate(cands).astype(np.int32), axis=0)
+
+    # exact distance filter, vectorized for pairs of points
+    a = pairs[:, 0]
+    b = pairs[:, 1]
+    pts = ~is_poly[a] & ~is_poly[b]
+    dists = np.empty(len(pairs), dtype=np.int64)
+    dists[pts] = np.minimum(1000 * 50000.0, 1000 * hav_batch(
+        lons[a[pts]], lats[a[pts]], lons[b[pts]], lats[b[pts]], approx))
+
+    for i in np.flatnonzero(~pts).tolist():
+        sid1 = a[i]
+        sid2 = b[i]
+        if not is_poly[sid1]:
+            dist = hav_approx_poly_stat(polys[poly_ids[sid2]], lons[sid1],
+                                        lats[sid1], (d + 1) / 1000)
+        elif not is_poly[sid2]:
+            dist = hav_approx_poly_stat(polys[poly_ids[sid1]], lons[sid2],
+                                        lats[sid2], (d + 1) / 1000)
+        else:
+            dist = hav_approx_poly_poly(polys[poly_ids[sid1]],
+                                        polys[poly_ids[sid2]], (d + 1) / 1000)
+        dists[i] = min(1000 * 50000.0, 1000 * dist)
+
+    keep = dists <= d
+    if with_dists:
+        return pairs[keep], dists[keep]
+    return pairs[keep]
@@ -0,0 +1,657 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright 2019, University of Freiburg.
+Chair of Algorithms and Data Structures.
+Patrick Brosi <brosi@informatik.uni-freiburg.de>
+'''
+
+import copy
+import cutil
+import numpy as np
+from statsimi.util import pack_strings
+from statsimi.feature.stat_ident import StatIdent
+
+# initial capacity of the columns, doubled when full
+INIT_CAPACITY = 1024
+
+# numeric columns and their types, None values are stored as NaN for
+# floats and as the given null value for integers
+COLUMNS = [
+    ("lat", np.float64, np.nan),
+    ("lon", np.float64, np.nan),
+    ("osmnid", np.int64, 0),
+    ("gid", np.int64, -1),
+    ("orig_gid", np.int64, -1),
+    ("srctype", np.int8, -1),
+    ("spice_id", np.int64, -1),
+    ("poly_id", np.int64, -1),
+    ("name_id", np.int32, -1),
+    ("orig_nd_name_id", np.int32, -1),
+    ("name_attr_id", np.int32, -1),
+]
+
+
+class StationTable(object):
+    '''
+    Columnar store of station identifiers. Positions, ids and types are
+    kept in numpy arrays, names and name attributes as ids into an
+    interned string pool. Polygons are shared by all name variants of a
+    station and packed into one coordinate buffer with offsets, together
+    with their bounding boxes and centroids. Indexing returns a
+    lightweight StationView.
+
+    >>> t = StationTable()
+    >>> t.add("Hbf", lat=48.0, lon=7.8, osmnid=5, gid=0, srctype=1,
+    ...       name_attr="name", orig_nd_name="Hbf")
+    0
+    >>> poly = [(7.8, 48.0), (7.9, 48.0), (7.9, 48.1)]
+    >>> t.add("Hbf", poly=poly, osmnid=-1, gid=1)
+    1
+    >>> t.add("Bahnhof", poly=poly, osmnid=-1, gid=1)
+    2
+    >>> len(t), len(t.strings), len(t.polys)
+    (3, 4, 1)
+    >>> print(t[0])
+    "Hbf" (nid=5) @ (48.000000, 7.800000)
+    >>> t[1].lat, t[1].srctype, t[2].poly[1]
+    (None, None, (7.9, 48.0))
+    >>> t[2].poly == poly, t[2].poly.bbox
+    (True, (7.8, 48.0, 7.9, 48.1))
+    >>> t.add("Halt", srctype=0), t[3].srctype
+    (3, 0)
+    >>> t[0].gid = 3
+    >>> t.gid.tolist(), t[0].orig_gid
+    ([3, 1, 1, -1], 0)
+    >>> [st.name for st in t]
+    ['Hbf', 'Hbf', 'Bahnhof', 'Halt']
+    '''
+
+    def __init__(self):
+        self.n = 0
+        self.cap = INIT_CAPACITY
+        self.cols = {col: np.full(self.cap, null, dtype=dtype)
+                     for col, dtype, null in COLUMNS}
+
+        self.strings = []
+        self.string_idx = {}
+        self._packed = None
+
+        # size of the string pool after the last compaction
+        self._compacted = INIT_CAPACITY
+
+        # vertices of polygon i are coords[poly_offs[i]:poly_offs[i + 1]]
+        self.coords = np.zeros((INIT_CAPACITY, 2), dtype=np.float64)
+        self.n_coords = 0
+        self.poly_offs = np.zeros(INIT_CAPACITY + 1, dtype=np.int64)
+        self.poly_bboxes = np.zeros((INIT_CAPACITY, 4), dtype=np.float64)
+        self.poly_centroids = np.zeros((INIT_CAPACITY, 2), dtype=np.float64)
+        self.n_polys = 0
+        self._last_poly = None
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, sid):
+        if sid < 0:
+            sid += self.n
+        if sid < 0 or sid >= self.n:
+            raise IndexError("station id %d out of range" % sid)
+        return StationView(self, sid)
+
+    def __iter__(self):
+        for sid in range(self.n):
+            yield StationView(self, sid)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["cols"] = {col: arr[:self.n] for col, arr in self.cols.items()}
+        state["cap"] = self.n
+        state["coords"] = self.coords[:self.n_coords]
+        state["poly_offs"] = self.poly_offs[:self.n_polys + 1]
+        state["poly_bboxes"] = self.poly_bboxes[:self.n_polys]
+        state["poly_centroids"] = self.poly_centroids[:self.n_polys]
+        del state["string_idx"]
+        del state["_last_poly"]
+        del state["_packed"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.string_idx = {s: i for i, s in enumerate(self.strings)}
+        self._last_poly = None
+        self._packed = None
+
+    @property
+    def polys(self):
+        '''
+        Sequence of all polygons, as PackedPolys
+        '''
+        return PolyList(self)
+
+    @staticmethod
+    def wrap(stations):
+        '''
+        Return stations as a StationTable, copying them if they are given
+        as a list of StatIdents
+        '''
+        if isinstance(stations, StationTable):
+            return stations
+        ret = StationTable()
+        for st in stations:
+            ret.append(st)
+        return ret
+
+    def col(self, col):
+        '''
+        Return the numpy array of column col, only valid until the next
+        station is added
+        '''
+        return self.cols[col][:self.n]
+
+    @property
+    def lat(self):
+        return self.col("lat")
+
+    @property
+    def lon(self):
+        return self.col("lon")
+
+    @property
+    def osmnid(self):
+        return self.col("osmnid")
+
+    @property
+    def gid(self):
+        return self.col("gid")
+
+    @property
+    def orig_gid(self):
+        return self.col("orig_gid")
+
+    @property
+    def srctype(self):
+        return self.col("srctype")
+
+    def intern(self, s):
+        '''
+        Return the id of string s in the string pool, -1 for None
+        '''
+        if s is None:
+            return -1
+        sid = self.string_idx.get(s)
+        if sid is None:
+            sid = len(self.strings)
+            self.string_idx[s] = sid
+            self.strings.append(s)
+        return sid
+
+    def string(self, sid):
+        if sid < 0:
+            return None
+        return self.strings[sid]
+
+    def packed_strings(self):
+        '''
+        The string pool packed by util.pack_strings(), kept until new
+        strings are added
+        '''
+        if self._packed is None or \
+                len(self._packed[1]) != len(self.strings) + 1:
+            self._packed = pack_strings(self.strings)
+        return self._packed
+
+    def intern_poly(self, poly):
+        '''
+        Return the id of polygon poly, polygons shared by consecutive
+        stations (the name variants of a station) are only stored once
+        '''
+        if poly is None:
+            return -1
+        if isinstance(poly, PackedPoly) and poly.table is self:
+            return poly.pid
+        if self.n_polys and same_poly(self._last_poly, poly):
+            return self.n_polys - 1
+
+        verts = np.array(poly, dtype=np.float64).reshape(-1, 2)
+        self._last_poly = poly
+        return self.extend_polys(np.array([0, len(verts)]), verts)
+
+    def extend_polys(self, offs, coords):
+        '''
+        Append the packed polygons given by vertex offsets and coordinates,
+        return the id of the first one
+        '''
+
+        first = self.n_polys
+        n_new = len(offs) - 1
+        start = self.n_coords
+
+        self.coords = grown(self.coords, self.n_coords + len(coords))
+        self.poly_offs = grown(self.poly_offs, self.n_polys + n_new + 1)
+        self.poly_bboxes = grown(self.poly_bboxes, self.n_polys + n_new)
+        self.poly_centroids = grown(self.poly_centroids, self.n_polys + n_new)
+
+        self.coords[start:start + len(coords)] = coords
+        self.n_coords += len(coords)
+        self.poly_offs[first + 1:first + n_new + 1] = offs[1:] - offs[0] + \
+            start
+        self.n_polys += n_new
+
+        offs = self.poly_offs[:self.n_polys + 1]
+        for pid in range(first, self.n_polys):
+            verts = self.coords[offs[pid]:offs[pid + 1]]
+            if len(verts) == 0:
+                self.poly_bboxes[pid] = np.nan
+                self.poly_centroids[pid] = np.nan
+                continue
+            self.poly_bboxes[pid, :2] = verts.min(axis=0)
+            self.poly_bboxes[pid, 2:] = verts.max(axis=0)
+            self.poly_centroids[pid] = cutil.centroid_packed(
+                self.coords, offs, pid)
+
+        return first
+
+    def grow(self, n):
+        '''
+        Make room for at least n stations
+        '''
+        if n <= self.cap:
+            return
+        while self.cap < n:
+            self.cap = max(1, self.cap * 2)
+        for col, dtype, null in COLUMNS:
+            arr = np.full(self.cap, null, dtype=dtype)
+            arr[:self.n] = self.cols[col][:self.n]
+            self.cols[col] = arr
+
+    def add(self, name, osmnid=0, lat=None, lon=None, poly=None, gid=None,
+            srctype=None, name_attr=None, orig_nd_name="", spice_id=None,
+            orig_gid=None):
+        '''
+        Add a station, return its id
+        '''
+
+        self.grow(self.n + 1)
+        sid = self.n
+        cols = self.cols
+
+        if lat is not None:
+            cols["lat"][sid] = lat
+            cols["lon"][sid] = lon
+        cols["osmnid"][sid] = osmnid
+        if gid is not None:
+            cols["gid"][sid] = gid
+            cols["orig_gid"][sid] = gid if orig_gid is None else orig_gid
+        if srctype is not None:
+            cols["srctype"][sid] = srctype
+        if spice_id is not None:
+            cols["spice_id"][sid] = spice_id
+        cols["poly_id"][sid] = self.intern_poly(poly)
+        cols["name_id"][sid] = self.intern(name)
+        cols["orig_nd_name_id"][sid] = self.intern(orig_nd_name)
+        cols["name_attr_id"][sid] = self.intern(name_attr)
+
+        self.n += 1
+        return sid
+
+    def append(self, st):
+        '''
+        Add a copy of the station st (a StatIdent or a StationView)
+        '''
+        self.add(st.name, osmnid=st.osmnid, lat=st.lat, lon=st.lon,
+                 poly=st.poly, gid=st.gid, srctype=st.srctype,
+                 name_attr=st.name_attr, orig_nd_name=st.orig_nd_name,
+                 spice_id=st.spice_id, orig_gid=st.orig_gid)
+
+    def extend(self, other, gid_offset=0):
+        '''
+        Append all stations of the StationTable other, with their group
+        ids shifted by gid_offset
+
+        >>> a = StationTable()
+        >>> a.add("A", lat=1.0, lon=2.0, gid=0)
+        0
+        >>> b = StationTable()
+        >>> b.add("B", lat=3.0, lon=4.0, gid=0)
+        0
+        >>> b.add("A", poly=[(1.0, 2.0)], gid=1)
+        1
+        >>> a.extend(b, 1)
+        >>> [(st.name, st.gid, st.orig_gid) for st in a]
+        [('A', 0, 0), ('B', 1, 1), ('A', 2, 2)]
+        >>> a[2].poly
+        [(1.0, 2.0)]
+        '''
+
+        if other.n == 0:
+            return
+
+        # ids of the other string pool in this string pool, with -1 kept
+        str_map = np.array([self.intern(s) for s in other.strings] + [-1],
+                           dtype=np.int32)
+        poly_off = self.extend_polys(other.poly_offs[:other.n_polys + 1],
+                                     other.coords[:other.n_coords])
+
+        start = self.n
+        self.grow(self.n + other.n)
+        self.n += other.n
+
+        for col, dtype, null in COLUMNS:
+            self.cols[col][start:self.n] = other.col(col)
+
+        for col in ("name_id", "orig_nd_name_id", "name_attr_id"):
+            self.cols[col][start:self.n] = str_map[other.col(col)]
+
+        for col, off in (("gid", gid_offset), ("orig_gid", gid_offset),
+                         ("poly_id", poly_off)):
+            arr = self.cols[col][start:self.n]
+            arr[arr >= 0] += off
+
+    def map_names(self, func):
+        '''
+        Replace each station name by func(name), func is called only once
+        per distinct name
+
+        >>> t = StationTable()
+        >>> for name in ["a", "b", "a"]:
+        ...     _ = t.add(name, lat=0.0, lon=0.0, name_attr="name")
+        >>> calls = []
+        >>> t.map_names(lambda s: calls.append(s) or s.upper())
+        >>> [st.name for st in t], calls, t[0].name_attr
+        (['A', 'B', 'A'], ['a', 'b'], 'name')
+        '''
+
+        names = self.col("name_id")
+        ids = np.unique(names[names >= 0])
+        id_map = np.arange(len(self.strings), dtype=np.int32)
+        for i in ids.tolist():
+            id_map[i] = self.intern(func(self.strings[i]))
+        names[names >= 0] = id_map[names[names >= 0]]
+
+    def release(self, sids):
+        '''
+        Return standalone StatIdent copies of the stations sids and reset
+        their rows to null values. Station ids stay valid, the strings only
+        used by released rows are dropped from the pool once it has doubled
+        since the last compaction.
+
+        >>> t = StationTable()
+        >>> for name in ["a", "b", "c"]:
+        ...     _ = t.add(name, lat=1.0, lon=2.0, gid=0)
+        >>> for st in t.release([0, 2]):
+        ...     print(st)
+        "a" (nid=0) @ (1.000000, 2.000000)
+        "c" (nid=0) @ (1.000000, 2.000000)
+        >>> [st.name for st in t], t.gid.tolist()
+        ([None, 'b', None], [-1, 0, -1])
+        >>> t.compact_strings()
+        >>> t.strings, t[1].name
+        (['', 'b'], 'b')
+        '''
+
+        ret = []
+        for sid in sids:
+            st = copy.copy(StationView(self, sid))
+            if st.poly is not None:
+                st.poly = st.poly.tolist()
+            ret.append(st)
+
+        sids = np.asarray(sids, dtype=np.int64)
+        for col, dtype, null in COLUMNS:
+            self.cols[col][sids] = null
+
+        if len(self.strings) >= 2 * self._compacted:
+            self.compact_strings()
+
+        return ret
+
+    def compact_strings(self):
+        '''
+        Drop the strings not referenced by any station from the pool
+        '''
+
+        str_cols = ("name_id", "orig_nd_name_id", "name_attr_id")
+        used = np.unique(np.concatenate([self.col(c) for c in str_cols]))
+        used = used[used >= 0]
+
+        # new id of each old string id, -1 kept
+        id_map = np.full(len(self.strings) + 1, -1, dtype=np.int32)
+        id_map[used] = np.arange(len(used), dtype=np.int32)
+        for col in str_cols:
+            self.cols[col][:self.n] = id_map[self.col(col)]
+
+        self.strings = [self.strings[i] for i in used.tolist()]
+        self.string_idx = {s: i for i, s in enumerate(self.strings)}
+        self._packed = None
+        self._compacted = max(INIT_CAPACITY, len(self.strings))
+
+
+class StationView(object):
+    '''
+    View on a single station of a StationTable, with the attributes of a
+    StatIdent. Copying a view gives a detached StatIdent.
+    '''
+
+    __slots__ = ("table", "sid")
+
+    def __init__(self, table, sid):
+        self.table = table
+        self.sid = sid
+
+    def __copy__(self):
+        st = StatIdent(
+            name=self.name,
+            osmnid=self.osmnid,
+            lat=self.lat,
+            lon=self.lon,
+            poly=self.poly,
+            gid=self.gid,
+            srctype=self.srctype,
+            name_attr=self.name_attr,
+            orig_nd_name=self.orig_nd_name,
+            spice_id=self.spice_id)
+        st.orig_gid = self.orig_gid
+        return st
+
+    __str__ = StatIdent.__str__
+
+    @property
+    def lat(self):
+        v = self.table.cols["lat"].item(self.sid)
+        return None if v != v else v
+
+    @lat.setter
+    def lat(self, v):
+        self.table.cols["lat"][self.sid] = np.nan if v is None else v
+
+    @property
+    def lon(self):
+        v = self.table.cols["lon"].item(self.sid)
+        return None if v != v else v
+
+    @lon.setter
+    def lon(self, v):
+        self.table.cols["lon"][self.sid] = np.nan if v is None else v
+
+    @property
+    def poly(self):
+        pid = self.table.cols["poly_id"].item(self.sid)
+        return None if pid < 0 else PackedPoly(self.table, pid)
+
+    @property
+    def name(self):
+        return self.table.string(self.table.cols["name_id"].item(self.sid))
+
+    @name.setter
+    def name(self, v):
+        self.table.cols["name_id"][self.sid] = self.table.intern(v)
+
+    @property
+    def orig_nd_name(self):
+        return self.table.string(
+            self.table.cols["orig_nd_name_id"].item(self.sid))
+
+    @property
+    def name_attr(self):
+        return self.table.string(
+            self.table.cols["name_attr_id"].item(self.sid))
+
+    @property
+    def osmnid(self):
+        return self.table.cols["osmnid"].item(self.sid)
+
+    @property
+    def gid(self):
+        v = self.table.cols["gid"].item(self.sid)
+        return None if v < 0 else v
+
+    @gid.setter
+    def gid(self, v):
+        self.table.cols["gid"][self.sid] = -1 if v is None else v
+
+    @property
+    def orig_gid(self):
+        v = self.table.cols["orig_gid"].item(self.sid)
+        return None if v < 0 else v
+
+    @orig_gid.setter
+    def orig_gid(self, v):
+        self.table.cols["orig_gid"][self.sid] = -1 if v is None else v
+
+    @property
+    def srctype(self):
+        v = self.table.cols["srctype"].item(self.sid)
+        return None if v < 0 else v
+
+    @property
+    def spice_id(self):
+        v = self.table.cols["spice_id"].item(self.sid)
+        return None if v < 0 else v
+
+
+class PolyList(object):
+    '''
+    Sequence of the polygons of a StationTable
+    '''
+
+    __slots__ = ("table")
+
+    def __init__(self, table):
+        self.table = table
+
+    def __len__(self):
+        return self.table.n_polys
+
+    def __getitem__(self, pid):
+        if pid < 0 or pid >= self.table.n_polys:
+            raise IndexError("polygon id %d out of range" % pid)
+        return PackedPoly(self.table, pid)
+
+    def __iter__(self):
+        for pid in range(self.table.n_polys):
+            yield PackedPoly(self.table, pid)
+
+
+class PackedPoly(object):
+    '''
+    A polygon of a StationTable. Behaves like the list of (lon, lat)
+    tuples it was created from, the polygon functions in statsimi.util
+    use the packed buffers directly.
+
+    >>> t = StationTable()
+    >>> _ = t.add("A", poly=[(1.0, 2.0), (3.0, 2.0), (3.0, 4.0)])
+    >>> poly = t[0].poly
+    >>> len(poly), poly[2], list(poly) == [(1.0, 2.0), (3.0, 2.0), (3.0, 4.0)]
+    (3, (3.0, 4.0), True)
+    >>> poly[-1], poly[:2]
+    ((3.0, 4.0), [(1.0, 2.0), (3.0, 2.0)])
+    >>> poly.centroid, poly.bbox
+    ((2.3333333333333335, 2.6666666666666665), (1.0, 2.0, 3.0, 4.0))
+    '''
+
+    __slots__ = ("table", "pid")
+
+    def __init__(self, table, pid):
+        self.table = table
+        self.pid = pid
+
+    def coords(self):
+        '''
+        Return the vertices as an (n, 2) numpy view
+        '''
+        offs = self.table.poly_offs
+        return self.table.coords[offs[self.pid]:offs[self.pid + 1]]
+
+    def packed(self):
+        '''
+        Return the arguments identifying this polygon for the packed
+        polygon functions of cutil
+        '''
+        return (self.table.coords,
+                self.table.poly_offs[:self.table.n_polys + 1],
+                self.table.poly_bboxes, self.pid)
+
+    def tolist(self):
+        return [tuple(c) for c in self.coords().tolist()]
+
+    @property
+    def centroid(self):
+        return tuple(self.table.poly_centroids[self.pid].tolist())
+
+    @property
+    def bbox(self):
+        '''
+        Bounding box as (min lon, min lat, max lon, max lat)
+        '''
+        return tuple(self.table.poly_bboxes[self.pid].tolist())
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None:
+            return self.coords()
+        return self.coords().astype(dtype)
+
+    def __len__(self):
+        offs = self.table.poly_offs
+        return int(offs[self.pid + 1] - offs[self.pid])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [tuple(c) for c in self.coords()[i].tolist()]
+        return tuple(self.coords()[i].tolist())
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __eq__(self, other):
+        return self.tolist() == list(other)
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.tolist())
+
+
+def same_poly(a, b):
+    '''
+    Check whether a and b are the same polygon object, or views on the
+    same packed polygon
+    '''
+    if a is b:
+        return True
+    return isinstance(a, PackedPoly) and isinstance(b, PackedPoly) and \
+        a.table is b.table and a.pid == b.pid
+
+
+def grown(arr, n):
+    '''
+    Return arr, or a copy of arr with its first dimension doubled until
+    it holds at least n elements
+    '''
+    if n <= len(arr):
+        return arr
+    cap = max(len(arr), 1)
+    while cap < n:
+        cap *= 2
+    ret = np.zeros((cap,) + arr.shape[1:], dtype=arr.dtype)
+    ret[:len(arr)] = arr
+    return ret
@@ -7,6 +7,7 @@ Patrick Brosi <brosi@informatik.uni-freiburg.de>
 
 import re
 import logging
+from statsimi.feature.station_table import StationTable
 
 
 class Normalizer(object):
@@ -56,12 +57,19 @@ class Normalizer(object):
                 if len(normed) == 0:
                     self.log.warn("Normalization for '%s' is empty!" % n[0])
                 g.names[nid] = (normed, n[1])
+        if isinstance(stats, StationTable):
+            # each distinct name is only normalized once
+            stats.map_names(self.normalize_name)
+            return
         for sid, st in enumerate(stats):
             if st.name is not None:
-                normed = self.normalize_string(st.name)
-                if len(normed) == 0:
-                    self.log.warn("Normalization for '%s' is empty!" % st.name)
-                stats[sid].name = normed
+                stats[sid].name = self.normalize_name(st.name)
+
+    def normalize_name(self, name):
+        normed = self.normalize_string(name)
+        if len(normed) == 0:
+            self.log.warn("Normalization for '%s' is empty!" % name)
+        return normed
 
     def normalize_string(self, a):
         '''
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright 2019, University of Freiburg.
+Chair of Algorithms and Data Structures.
+Patrick Brosi <brosi@informatik.uni-freiburg.de>
+'''
+
+import bz2
+import os
+import mmap
+import re
+import multiprocessing as mp
+from collections import deque
+import logging
+
+# start of a bzip2 stream: stream header followed by the first block magic
+STREAM_MAGIC = re.compile(rb"BZh[1-9]1AY&SY")
+
+# compressed size of the units of work handed to the workers
+UNIT_SIZE = 1024 * 1024
+
+
+def stream_offsets(path):
+    '''
+    Return the offsets of all (candidate) bzip2 stream starts in path
+
+    >>> import tempfile, os
+    >>> d = tempfile.TemporaryDirectory()
+    >>> path = os.path.join(d.name, "a.bz2")
+    >>> a = bz2.compress(b"abc")
+    >>> with open(path, "wb") as f:
+    ...     f.write(a + bz2.compress(b"def")) > 0
+    True
+    >>> stream_offsets(path) == [0, len(a)]
+    True
+    >>> d.cleanup()
+    '''
+    if os.path.getsize(path) == 0:
+        return []
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return [match.start() for match in STREAM_MAGIC.finditer(m)]
+
+
+def _bz2_decompress(unit):
+    '''
+    Decompress the bzip2 streams in the file range given by unit, return
+    None if the range does not consist of complete streams
+    '''
+    path, offset, size = unit
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        buf = f.read(size)
+    try:
+        return bz2.decompress(buf)
+    except (OSError, EOFError, ValueError):
+        return None
+
+
+class ParallelBz2Reader(object):
+    '''
+    Binary file-like reader for multi-stream bzip2 files (as written by
+    pbzip2 or lbzip2, e.g. the Geofabrik and planet extracts). The streams
+    are decompressed in parallel by a pool of worker processes (as many as
+    CPUs if workers is None) and returned in order. Files consisting of a
+    single stream are decompressed sequentially.
+
+    >>> import tempfile, os
+    >>> d = tempfile.TemporaryDirectory()
+    >>> path = os.path.join(d.name, "a.bz2")
+    >>> with open(path, "wb") as f:
+    ...     f.write(b"".join(bz2.compress(b"stream %d;" % i)
+    ...                      for i in range(5))) > 0
+    True
+    >>> with ParallelBz2Reader(path, workers=2, unit_size=1) as f:
+    ...     f.read(9), f.read()
+    (b'stream 0;', b'stream 1;stream 2;stream 3;stream 4;')
+    >>> d.cleanup()
+    '''
+
+    def __init__(self, path, workers=None, unit_size=UNIT_SIZE):
+        self.log = logging.getLogger('bz2reader')
+        self.path = path
+        self.workers = workers or mp.cpu_count()
+        self.pool = None
+        self.single = None
+
+        offsets = stream_offsets(path)
+        fsize = os.path.getsize(path)
+
+        # group the streams into units of at least unit_size bytes
+        self.units = []
+        for i, offset in enumerate(offsets):
+            end = offsets[i + 1] if i + 1 < len(offsets) else fsize
+            if len(self.units) and self.units[-1][2] < unit_size:
+                u = self.units[-1]
+                self.units[-1] = (path, u[1], end - u[1])
+            else:
+                self.units.append((path, offset, end - offset))
+
+        if len(offsets) > 1 and offsets[0] == 0 and self.workers > 1:
+            self.log.info("Decompressing %d bzip2 streams in %d units "
+                          "with %d workers..." % (len(offsets),
+                                                  len(self.units),
+                                                  self.workers))
+            self.pool = mp.Pool(self.workers)
+
+        self.seek(0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.single:
+            self.single.close()
+            self.single = None
+        if self.pool:
+            self.pool.terminate()
+            self.pool = None
+
+    def seek(self, pos):
+        '''
+        Rewind the reader, only seeking to 0 is supported.
+        '''
+        if pos != 0:
+            raise ValueError("ParallelBz2Reader can only be rewound to 0")
+
+        if self.single:
+            self.single.close()
+            self.single = None
+
+        if self.pool is None:
+            self.single = bz2.open(self.path, 'rb')
+            return
+
+        self.next_unit = 0
+        self.carry = None
+        self.pending = deque()
+        self.buf = b''
+        self.buf_pos = 0
+
+    def read(self, size=-1):
+        if self.single:
+            return self.single.read(size)
+
+        ret = []
+        while size < 0 or size > 0:
+            if self.buf_pos == len(self.buf):
+                self.buf = self.next_data()
+                self.buf_pos = 0
+                if self.buf is None:
+                    self.buf = b''
+                    break
+            if size < 0:
+                ret.append(self.buf[self.buf_pos:])
+                self.buf_pos = len(self.buf)
+            else:
+                chunk = self.buf[self.buf_pos:self.buf_pos + size]
+                self.buf_pos += len(chunk)
+                size -= len(chunk)
+                ret.append(chunk)
+
+        return b''.join(ret)
+
+    def next_data(self):
+        '''
+        Return the decompressed data of the next unit, None at the end
+        '''
+
+        while True:
+            # keep a bounded number of units in flight, to not decompress
+            # the whole file into memory if the consumer is slower
+            while (self.next_unit < len(self.units) and
+                   len(self.pending) < 2 * self.workers):
+                unit = self.units[self.next_unit]
+                self.pending.append(
+                    (unit, self.pool.apply_async(_bz2_decompress, (unit,))))
+                self.next_unit += 1
+
+            if not len(self.pending):
+                break
+
+            unit, res = self.pending.popleft()
+            data = res.get()
+
+            if self.carry:
+                # the previous unit did not end at a stream boundary (the
+                # stream magic also occurred inside compressed data), merge
+                unit = (self.path, self.carry[1],
+                        unit[1] + unit[2] - self.carry[1])
+                data = _bz2_decompress(unit)
+
+            if data is None:
+                self.carry = unit
+                continue
+
+            self.carry = None
+            return data
+
+        if self.carry:
+            raise OSError("Invalid bzip2 data in %s" % self.path)
+
+        return None
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright 2019, University of Freiburg.
+Chair of Algorithms and Data Structures.
+Patrick Brosi <brosi@informatik.uni-freiburg.de>
+'''
+
+import re
+import numpy as np
+
+RD_CHUNK = 1024 * 1024 * 16
+
+# start of a top-level element, chunks are only cut in front of these
+ELEMENT_STARTS = [b"<node", b"<way", b"<relation", b"</osm>"]
+
+# end of the node section of an OSM file
+NODE_SECTION_END = re.compile(rb"<way[\s>]|<relation[\s>]|</osm>")
+
+# id, lat and lon of a node in the layout written by all common OSM tools,
+# with a literal prefix, which is much faster to match
+NODE_ID = re.compile(rb'<node id="(-?\d+)"')
+NODE_LATLON = re.compile(rb' lat="([^"]+)" lon="([^"]+)"')
+
+# any node head and its attributes, used for all other layouts
+NODE_HEAD = re.compile(rb'<node\s([^>]*)>')
+ATTR = re.compile(rb'([\w:]+)\s*=\s*(["\'])(.*?)\2')
+
+
+def tag_regex(fil):
+    '''
+    Build a regex matching the <tag> elements which match the (key, value)
+    filter list fil. Values are checked with the filter afterwards, see
+    tag_kv().
+
+    >>> r = tag_regex([("railway", "stop"), ("tram", "*")])
+    >>> tag_kv(r.search(b'<tag k="railway" v="stop"/>'))
+    (b'railway', b'stop')
+    >>> tag_kv(r.search(b"<tag v='yes' k='tram'/>"))
+    (b'tram', b'yes')
+    >>> tag_kv(r.search(b'<tag k = "railway" v= "stop"/>'))
+    (b'railway', b'stop')
+    '''
+    keys = b"|".join(sorted(set(re.escape(k.encode("utf-8"))
+                                for k, v in fil)))
+    # k before v, or v before k, quoted with ' or "
+    return re.compile(rb'<tag\s+(?:k\s*=\s*(["\'])(' + keys +
+                      rb')\1\s+v\s*=\s*(["\'])(.*?)\3|'
+                      rb'v\s*=\s*(["\'])(.*?)\5\s+k\s*=\s*(["\'])(' +
+                      keys + rb')\7)')
+
+
+def tag_kv(m):
+    '''
+    The (key, value) of a match of a regex built by tag_regex()
+    '''
+    if m.group(2) is not None:
+        return m.group(2), m.group(4)
+    return m.group(8), m.group(6)
+
+
+class NodeFilter(object):
+    '''
+    File-like wrapper around a binary OSM XML file which removes all nodes
+    that cannot be a station (according to the tag filter fil) from the
+    byte stream before it reaches the XML parser.
+
+    The bounds of all nodes (inside of region, if given) are collected in
+    ll and ur while the node section is read. If keep is set to a sorted array of node ids, the
+    positions of these nodes are collected as (ids, lons, lats) arrays
+    in nd_pos.
+
+    Attributes may be quoted with ' or " and come in any order. Nodes
+    written with double quotes and the id, lat, lon attribute order of all
+    common OSM tools are scanned fastest.
+
+    >>> import io
+    >>> f = NodeFilter(io.BytesIO(b"""<osm>
+    ...  <node id="1" lat="1.5" lon="2"/>
+    ...  <node id="2" lat="-1" lon="3"><tag k="highway" v="bus_stop"/></node>
+    ...  <node id="3" lat="0" lon="4"><tag k="highway" v="path"/></node>
+    ...  <way id="4"><nd ref="1"/></way>
+    ... </osm>"""), [("highway", "bus_stop")], chunk_size=32)
+    >>> f.keep = np.array([1], dtype=np.int64)
+    >>> print(f.read().decode("utf-8"))
+    <osm>
+     <node id="2" lat="-1" lon="3"><tag k="highway" v="bus_stop"/></node>
+    <way id="4"><nd ref="1"/></way>
+    </osm>
+    >>> f.ll, f.ur
+    ([-1.0, 2.0], [1.5, 4.0])
+    >>> [(i.tolist(), lo.tolist(), la.tolist()) for i, lo, la in f.nd_pos]
+    [([1], [2.0], [1.5])]
+    >>> f = NodeFilter(io.BytesIO(b"""<osm>
+    ...  <node id='1' lat='1.5' lon='2'/>
+    ...  <node lon='3' lat='-1' id='2'><tag k='highway' v='bus_stop'/></node>
+    ...  <node id='3' lat='0' lon='4'><tag k='highway' v='path'/></node>
+    ... </osm>"""), [("highway", "bus_stop")])
+    >>> f.keep = np.array([2], dtype=np.int64)
+    >>> print(f.read().decode("utf-8"))
+    <osm>
+     <node lon='3' lat='-1' id='2'><tag k='highway' v='bus_stop'/></node>
+    </osm>
+    >>> f.ll, f.ur
+    ([-1.0, 2.0], [1.5, 4.0])
+    >>> [(i.tolist(), lo.tolist(), la.tolist()) for i, lo, la in f.nd_pos]
+    [([2], [3.0], [-1.0])]
+    '''
+
+    def __init__(self, f, fil, region=None, chunk_size=RD_CHUNK):
+        self.f = f
+        self.region = region
+        self.fil = set(fil)
+        self.tag_re = tag_regex(fil)
+        self.chunk_size = chunk_size
+
+        self.ll = [float("inf"), float("inf")]
+        self.ur = [-float("inf"), -float("inf")]
+
+        self.keep = None
+        self.nd_pos = []
+
+        self.reset()
+
+    def reset(self):
+        self.rest = b''
+        self.out = []
+        self.out_len = 0
+        self.eof = False
+        self.in_nodes = True
+
+    def seek(self, pos):
+        '''
+        Rewind the underlying file, only seeking to 0 is supported.
+        '''
+        if pos != 0:
+            raise ValueError("NodeFilter can only be rewound to 0")
+        self.f.seek(0)
+        self.reset()
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or self.out_len < size):
+            self.fill()
+
+        data = b''.join(self.out)
+
+        if size < 0 or size >= len(data):
+            self.out = []
+            self.out_len = 0
+            return data
+
+        self.out = [data[size:]]
+        self.out_len = len(data) - size
+        return data[:size]
+
+    def scan_nodes(self):
+        '''
+        Read through the node section without producing any output, only
+        the bounds and the positions of the nodes in keep are collected
+        '''
+        while self.in_nodes and not self.eof:
+            self.fill()
+            self.out = []
+            self.out_len = 0
+
+    def fill(self):
+        '''
+        Read the next chunk from the underlying file into the output buffer
+        '''
+
+        data = self.f.read(self.chunk_size)
+
+        if not self.in_nodes:
+            if not data:
+                self.eof = True
+            self.append(data)
+            return
+
+        if not data:
+            self.eof = True
+            data = self.rest
+            self.rest = b''
+        else:
+            data = self.rest + data
+            # cut in front of the last element start, everything before
+            # consists of complete elements
+            cut = max(data.rfind(s) for s in ELEMENT_STARTS)
+            if cut <= 0:
+                self.rest = data
+                return
+            self.rest = data[cut:]
+            data = data[:cut]
+
+        self.append(self.filter(data))
+
+        if not self.in_nodes:
+            self.append(self.rest)
+            self.rest = b''
+
+    def append(self, data):
+        if data:
+            self.out.append(data)
+            self.out_len += len(data)
+
+    def filter(self, data):
+        '''
+        Filter the nodes in data, which consists of complete elements only
+        '''
+
+        start = data.find(b"<node")
+        if start < 0:
+            start = len(data)
+
+        m = NODE_SECTION_END.search(data, start)
+        if m:
+            end = m.start()
+            self.in_nodes = False
+        else:
+            end = len(data)
+
+        if start >= end:
+            return data
+
+        self.scan_heads(data, start, end)
+
+        ret = [data[:start]]
+        last = -1
+
+        for m in self.tag_re.finditer(data, start, end):
+            k, v = (x.decode("utf-8") for x in tag_kv(m))
+            if (k, v) not in self.fil and (k, "*") not in self.fil:
+                continue
+            nd_start = data.rfind(b"<node", start, m.start())
+            if nd_start == last:
+                # multiple matching tags in the same node
+                continue
+            last = nd_start
+            nd_end = data.find(b"</node>", m.end(), end) + len(b"</node>")
+            ret.append(data[nd_start:nd_end])
+            ret.append(b"\n")
+
+        ret.append(data[end:])
+
+        return b''.join(ret)
+
+    def scan_heads(self, data, start, end):
+        '''
+        Update the bounds with the nodes in data[start:end] and collect the
+        positions of the nodes in keep
+        '''
+
+        want_ids = self.keep is not None and len(self.keep)
+
+        n = data.count(b"<node", start, end)
+        latlons = NODE_LATLON.findall(data, start, end)
+        ids = None
+        if want_ids:
+            ids = NODE_ID.findall(data, start, end)
+
+        if len(latlons) != n or (want_ids and len(ids) != n):
+            # unusual attribute layout, parse the attributes of each head
+            ids = []
+            latlons = []
+            for head in NODE_HEAD.findall(data, start, end):
+                attrs = {m[0]: m[2] for m in ATTR.findall(head)}
+                if b"lat" not in attrs or b"lon" not in attrs:
+                    continue
+                ids.append(attrs.get(b"id", b"0"))
+                latlons.append((attrs[b"lat"], attrs[b"lon"]))
+            if not want_ids:
+                ids = None
+
+        if not len(latlons):
+            return
+
+        latlons = np.array(latlons)
+        lats = latlons[:, 0].astype(np.float64)
+        lons = latlons[:, 1].astype(np.float64)
+
+        if self.region is not None:
+            inside = self.region.contains_arr(lats, lons)
+        else:
+            inside = slice(None)
+
+        if len(lats[inside]):
+            self.ll[0] = min(self.ll[0], float(lats[inside].min()))
+            self.ll[1] = min(self.ll[1], float(lons[inside].min()))
+            self.ur[0] = max(self.ur[0], float(lats[inside].max()))
+            self.ur[1] = max(self.ur[1], float(lons[inside].max()))
+
+        if ids is not None:
+            ids = np.array(ids).astype(np.int64)
+            m = np.isin(ids, self.keep)
+            if m.any():
+                self.nd_pos.append((ids[m], lons[m], lats[m]))
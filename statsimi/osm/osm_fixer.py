@@ -507,6 +507,13 @@ class OsmFixer(object):
 
         in_group_dismatches = [0] * len(self.features.stations)
         in_group_dismatches_conf = [0] * len(self.features.stations)
+        pairs = self.features.pairs
+
+        # pairs where exactly one station name is an alt_name
+        stations = self.features.stations
+        alt_id = stations.string_idx.get("alt_name", -2)
+        is_alt = stations.col("name_attr_id") == alt_id
+        alt_mismatch = is_alt[pairs[:, 0]] != is_alt[pairs[:, 1]]
 
         for id, (input, (nomatch_p, match_p)) in enumerate(
                 zip(y_input, y_proba)):
@@ -515,13 +522,11 @@ class OsmFixer(object):
                 if self.test_idx is not None:
                     lid = self.test_idx[id]
 
-                stid1 = self.features.pairs[lid][0]
-                stid2 = self.features.pairs[lid][1]
-
-                if (self.features.stations[stid1].name_attr == "alt_name") != (
-                        self.features.stations[stid2].name_attr == "alt_name"):
+                if alt_mismatch[lid]:
                     continue
 
+                stid1, stid2 = pairs[lid].tolist()
+
                 # wrongly grouped as similar according to our model!
                 in_group_dismatches[stid1] += 1
                 in_group_dismatches[stid2] += 1
@@ -572,6 +577,7 @@ class OsmFixer(object):
 
     def build_simi_index(self, model, y_proba):
         self.simi_idx = [[] for i in range(len(self.features.stations))]
+        pairs = self.features.pairs
         for id, (nomatch_p, match_p) in enumerate(y_proba):
             lid = id
             if self.test_idx is not None:
@@ -581,11 +587,7 @@ class OsmFixer(object):
                 # skip irrelevant stations
                 continue
 
-            stid1 = self.features.pairs[lid][0]
-            stid2 = self.features.pairs[lid][1]
-
-            gid1 = self.get_station(stid1).gid
-            gid2 = self.get_station(stid2).gid
+            stid1, stid2 = pairs[lid].tolist()
 
             self.simi_idx[stid1].append((stid2, match_p))
             self.simi_idx[stid2].append((stid1, match_p))
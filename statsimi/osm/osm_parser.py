@@ -9,8 +9,17 @@ import xml.etree.ElementTree as ET
 import math
 import os
 import bz2
-from statsimi.feature.stat_ident import StatIdent
+import gzip
+import multiprocessing as mp
+import numpy as np
+from array import array
+from statsimi.feature.station_table import StationTable
 from statsimi.feature.stat_group import StatGroup
+from statsimi.osm.pbf import PrimitiveBlock
+from statsimi.osm.pbf import blob_index
+from statsimi.osm.pbf import read_blob
+from statsimi.osm.node_filter import NodeFilter
+from statsimi.osm.bz2_reader import ParallelBz2Reader
 import logging
 
 RD_BUFFER = 1024 * 1000 * 1000
@@ -110,30 +119,45 @@ class OsmParser(object):
     '''
     Parses an OSM file into a list of groups (generated from relations)
     and nodes. After parsing, they are available as members of this
-    class.
+    class. If a Region is given, only stations inside of it are kept.
     '''
 
-    def __init__(self):
+    def __init__(self, region=None):
         '''
         Constructor
         '''
 
         self.log = logging.getLogger('osmp')
+        self.region = region
         self.nd_group_idx = {}
         self.way_group_idx = {}
         self.rel_meta_group_idx = {}
         self.groups = []
-        self.stations = []
+        self.stations = StationTable()
 
         self.num_osm_stats = 0
         self.num_osm_stat_orphans = 0
         self.num_osm_groups = 0
         self.num_osm_way_polys = 0
 
-        self.way_kept_nds = set()
-        self.way_nds = {}
-        self.way_nd_pos = {}
-        self.way_names = {}
+        # if set, the raw tags of station nodes and group relations are
+        # kept, which is needed to later apply OSM change files
+        self.keep_tags = False
+        self.nd_tags = {}
+        self.rel_tags = {}
+
+        # station ways, their node refs are stored in a flat array, the
+        # refs of the i-th way are way_refs[way_offs[i]:way_offs[i + 1]]
+        self.way_ids = array('q')
+        self.way_names = []
+        self.way_refs = array('q')
+        self.way_offs = array('q', [0])
+
+        # sorted ids of the nodes referenced by station ways, and their
+        # positions (NaN if unknown)
+        self.way_kept_nds = np.zeros(0, dtype=np.int64)
+        self.way_nd_lons = np.zeros(0)
+        self.way_nd_lats = np.zeros(0)
 
         self.ll = [float("inf"), float("inf")]
         self.ur = [-float("inf"), -float("inf")]
@@ -163,18 +187,44 @@ class OsmParser(object):
     def is_grp_exl(self, attr):
         return self.filter_match(attr, grp_rel_ex_filter)
 
-    def parse_bz2(self, path, unique=False, with_polygons=False):
+    def parse_bz2(self, path, unique=False, with_polygons=False,
+                  single_pass=True, prefilter=True, workers=None):
         '''
-        Parse a bziped OSM XML path.
+        Parse a bziped OSM XML path. Multi-stream files are decompressed
+        in parallel by a pool of worker processes (as many as CPUs if
+        workers is None).
+
+        >>> import tempfile
+        >>> d = tempfile.TemporaryDirectory()
+        >>> path = os.path.join(d.name, "test.osm.bz2")
+        >>> with open("testdata/test.osm", "rb") as f:
+        ...     lines = f.readlines()
+        >>> with open(path, "wb") as f:
+        ...     f.write(b"".join(bz2.compress(b"".join(lines[i:i + 20]))
+        ...                      for i in range(0, len(lines), 20))) > 0
+        True
+        >>> p = OsmParser()
+        >>> p.parse_bz2(path, False, True, workers=2)
+        >>> x = OsmParser()
+        >>> x.parse_xml("testdata/test.osm", False, True)
+        >>> [str(st) for st in p.stations] == [str(st) for st in x.stations]
+        True
+        >>> [str(grp) for grp in p.groups] == [str(grp) for grp in x.groups]
+        True
+        >>> d.cleanup()
         '''
 
-        with bz2.open(path, 'rt', encoding="utf-8") as f:
-            return self.parse(f, unique, with_polygons)
+        with ParallelBz2Reader(path, workers) as f:
+            if prefilter:
+                f = NodeFilter(f, st_filter, self.region)
+            return self.parse(f, unique, with_polygons, single_pass)
 
 
-    def parse_xml(self, path, unique=False, with_polygons=False):
+    def parse_xml(self, path, unique=False, with_polygons=False,
+                  single_pass=True, prefilter=True):
         '''
-        Parse a raw OSM XML path.
+        Parse a raw OSM XML path. If prefilter is set, nodes which cannot
+        be stations are removed from the raw bytes before XML parsing.
 
         >>> p = OsmParser()
         >>> p.parse_xml("testdata/test.osm")
@@ -212,36 +262,529 @@ class OsmParser(object):
         248609028, 248609028, 248609028, 507039988, 507039988, 507039988, \
         2496897172, 2496897172, 2496897172, 2496897173, 2496897173, \
         2496897173, 4984926391]
+
+        Attributes quoted with ' are parsed the same way.
+
+        >>> import tempfile
+        >>> d = tempfile.TemporaryDirectory()
+        >>> path = os.path.join(d.name, "test.osm")
+        >>> with open("testdata/test.osm", "rb") as f:
+        ...     with open(path, "wb") as g:
+        ...         g.write(f.read().replace(b'"', b"'")) > 0
+        True
+        >>> q = OsmParser()
+        >>> q.parse_xml(path, False, True)
+        >>> [str(st) for st in q.stations] == [str(st) for st in p.stations]
+        True
+        >>> q.bounds == p.bounds
+        True
+        >>> d.cleanup()
         '''
 
-        with open(path, 'r', encoding="utf-8", buffering=RD_BUFFER) as f:
-            return self.parse(f, unique, with_polygons)
+        with open(path, 'rb', buffering=RD_BUFFER) as f:
+            if prefilter:
+                f = NodeFilter(f, st_filter, self.region)
+            return self.parse(f, unique, with_polygons, single_pass)
 
-    def parse(self, osm_file, unique=False, with_polygons=False):
+    def parse(self, osm_file, unique=False, with_polygons=False,
+              single_pass=True):
         '''
         Parse an OSM XML file.
+
+        If single_pass is set, the file is read only once (twice if polygons
+        are requested, as the positions of way nodes are only known after
+        the ways have been read). Candidate station nodes are buffered
+        until their relation membership is known at the end of the file.
+        Otherwise, relations, ways and nodes are read in separate passes.
+
+        >>> a = OsmParser()
+        >>> a.parse_xml("testdata/test.osm", False, True, single_pass=True)
+        >>> b = OsmParser()
+        >>> b.parse_xml("testdata/test.osm", False, True, single_pass=False)
+        >>> [str(st) for st in a.stations] == [str(st) for st in b.stations]
+        True
+        >>> [str(grp) for grp in a.groups] == [str(grp) for grp in b.groups]
+        True
+        >>> a.bounds == b.bounds
+        True
+        >>> c = OsmParser()
+        >>> c.parse_xml("testdata/test.osm", False, True, prefilter=False)
+        >>> [str(st) for st in a.stations] == [str(st) for st in c.stations]
+        True
+        >>> [st.poly for st in a.stations] == [st.poly for st in c.stations]
+        True
+        >>> a.bounds == c.bounds
+        True
         '''
 
-        self.parse_relations(osm_file, unique);
+        if single_pass:
+            self.parse_single_pass(osm_file, unique, with_polygons)
+        else:
+            self.parse_relations(osm_file, unique);
 
-        for gid, g in enumerate(self.groups):
-            if g.osm_rel_id in self.rel_meta_group_idx:
-                g.set_meta_group(self.rel_meta_group_idx[g.osm_rel_id])
+            self.set_meta_groups()
+
+            if with_polygons:
+                self.parse_ways(osm_file, unique);
+                self.index_way_nds()
+
+            self.parse_nodes(osm_file, unique);
+
+        if isinstance(osm_file, NodeFilter):
+            # bounds of the nodes removed by the pre-filter
+            self.merge_bounds(osm_file.ll, osm_file.ur)
+
+        self.finish(unique)
+
+    def iter_groups(self, path, unique=False, with_polygons=False,
+                    prefilter=True, workers=None):
+        '''
+        Parse the OSM XML path (optionally bzip2 compressed) and yield each
+        station group as a (group, stations) tuple as soon as it is
+        finished, instead of collecting all stations first. Station ids
+        are the ids they would have after a full parse. Group ids are the
+        ids before finish(): with a region, a full parse drops the empty
+        groups afterwards, the final id of a group is then the rank of its
+        id among the ids of all yielded groups.
+
+        Relations (and station ways) are read first, a group is finished
+        once all of its node members have been read as station nodes.
+        Groups with other node members or with station way members are
+        finished at the end. Empty groups are not yielded. The bounds are
+        only known after the last group.
+
+        The yielded stations are standalone StatIdents. Once a group is
+        yielded, its rows in self.stations are reset and its entry in
+        self.groups is replaced by an empty StatGroup, so the parser only
+        holds the stations of unfinished groups.
+
+        >>> p = OsmParser()
+        >>> grps = list(p.iter_groups("testdata/test.osm", False, True))
+        >>> [(str(g), len(stats)) for g, stats in grps]
+        ... # doctest: +NORMALIZE_WHITESPACE
+        [('Group (rel_id=None) with 1 stations', 1),
+         ('Group (rel_id=3271923) with 18 stations', 18),
+         ('Group (rel_id=None) with 1 stations', 1)]
+        >>> x = OsmParser()
+        >>> x.parse_xml("testdata/test.osm", False, True)
+        >>> sorted(str(st) for g, stats in grps for st in stats) == sorted(
+        ...     str(st) for st in x.stations)
+        True
+        >>> p.bounds == x.bounds
+        True
+        >>> sorted((st.gid, str(st)) for g, stats in grps for st in stats) == (
+        ...     sorted((st.gid, str(st)) for st in x.stations))
+        True
+        >>> [len(g.stats) for g in p.groups]
+        [0, 0, 0]
+
+        With a region, the group ids are mapped to their ranks:
+
+        >>> from statsimi.osm.region import Region
+        >>> for bbox in [(47.99, 7.854, 47.991, 7.855),
+        ...              (47.9906, 7.8544, 47.99068, 7.8546)]:
+        ...     p = OsmParser(Region(bbox=bbox))
+        ...     grps = list(p.iter_groups("testdata/test.osm", False, True))
+        ...     x = OsmParser(Region(bbox=bbox))
+        ...     x.parse_xml("testdata/test.osm", False, True)
+        ...     rank = {gid: i for i, gid in enumerate(
+        ...         sorted(set(st.gid for g, stats in grps for st in stats)))}
+        ...     print(sorted((rank[st.gid], str(st))
+        ...                  for g, stats in grps for st in stats) ==
+        ...           sorted((st.gid, str(st)) for st in x.stations),
+        ...           sorted(str(g) for g, stats in grps) ==
+        ...           sorted(str(g) for g in x.groups), len(rank))
+        True True 3
+        True True 2
+        '''
+
+        if path.endswith(".bz2"):
+            f = ParallelBz2Reader(path, workers)
+        else:
+            f = open(path, 'rb', buffering=RD_BUFFER)
+
+        with f:
+            if prefilter:
+                f = NodeFilter(f, st_filter, self.region)
+            yield from self.iter_parse(f, unique, with_polygons)
+
+    def iter_parse(self, f, unique=False, with_polygons=False):
+        '''
+        Parse an OSM XML file in separate passes, yield the finished
+        station groups as (group, stations) tuples, see iter_groups
+        '''
+
+        self.parse_relations(f, unique)
+
+        self.set_meta_groups()
 
         if with_polygons:
-            self.parse_ways(osm_file, unique);
+            self.parse_ways(f, unique)
+            self.index_way_nds()
+
+        # groups with station way members are finished after all nodes
+        way_grps = set(self.way_group_idx.values()) if with_polygons else ()
+
+        # number of node members not read yet, per relation group
+        pending = {}
+        for nid, gid in self.nd_group_idx.items():
+            if gid not in way_grps:
+                pending[gid] = pending.get(gid, 0) + 1
+
+        num_rel_grps = len(self.groups)
+        emitted = set()
+
+        for nid in self.iter_station_nodes(f, unique):
+            gid = self.nd_group_idx.get(nid)
+            if gid is None:
+                continue
+
+            if gid >= num_rel_grps:
+                # orphan station, its group is finished
+                yield from self.release_group(gid, emitted)
+            elif gid in pending:
+                pending[gid] -= 1
+                if pending[gid] == 0:
+                    yield from self.release_group(gid, emitted)
+
+        if isinstance(f, NodeFilter):
+            self.merge_bounds(f.ll, f.ur)
+
+        if with_polygons:
+            self.build_station_polys(unique)
+
+        for gid in range(len(self.groups)):
+            yield from self.release_group(gid, emitted)
+
+        self.log.info("Parsed %d stations, %d station polygons, %s groups, "
+                      "%s orphan stats." % (self.num_osm_stats,
+                                            self.num_osm_way_polys,
+                                            self.num_osm_groups,
+                                            self.num_osm_stat_orphans))
+
+    def release_group(self, gid, emitted):
+        '''
+        Yield group gid with its stations if it is not empty and was not
+        yielded before, and release its stations
+        '''
+
+        if gid in emitted:
+            return
+
+        g = self.groups[gid]
+        if len(g.stats) == 0:
+            return
+
+        emitted.add(gid)
+        stats = self.stations.release(g.stats)
+        self.groups[gid] = StatGroup()
+        yield g, stats
+
+    def apply_osc(self, path, unique=False):
+        '''
+        Apply the OSM change file path (optionally gzip or bzip2
+        compressed) to the stations parsed before with keep_tags set,
+        and rebuild the stations and groups. Return the set of OSM ids
+        (node ids, negated way ids) of the stations which changed.
+
+        >>> p = OsmParser()
+        >>> p.keep_tags = True
+        >>> p.parse_xml("testdata/test.osm", False, True)
+        >>> sorted(p.apply_osc("testdata/test.osc"))
+        [-1, 5, 507039988, 4984926391]
+        >>> [str(st) for st in p.stations if st.osmnid in (5, 4984926391)]
+        ... # doctest: +NORMALIZE_WHITESPACE
+        ['"Schwabentor" (nid=4984926391) @ (47.990671, 7.854497)',
+         '"Neue Haltestelle" (nid=5) @ (47.991100, 7.855100)']
+        >>> len(p.groups), len(p.stations)
+        (4, 18)
+        '''
+
+        if path.endswith(".bz2"):
+            f = bz2.open(path, 'rb')
+        elif path.endswith(".gz"):
+            f = gzip.open(path, 'rb')
+        else:
+            f = open(path, 'rb')
+
+        changed = set()
+        changed_rels = set()
+
+        # the station ways, by id
+        ways = self.ways()
+
+        # positions of all nodes in the change file
+        nd_pos = ([], [], [])
+
+        action = None
+
+        with f:
+            for event, c1 in ET.iterparse(f, events=("start", "end")):
+                if event == "start":
+                    if c1.tag in ("create", "modify", "delete"):
+                        action = c1.tag
+                    continue
+
+                if c1.tag == "node":
+                    nid = int(c1.attrib["id"], 10)
+                    tags = [c2.attrib for c2 in c1 if c2.tag == "tag"]
+                    is_st = any(self.is_st(attr) for attr in tags)
+
+                    if nid in self.nd_tags:
+                        changed.add(nid)
+                        if action == "delete" or not is_st:
+                            del self.nd_tags[nid]
+
+                    if action != "delete":
+                        lat = float(c1.attrib["lat"])
+                        lon = float(c1.attrib["lon"])
+                        self.update_bounds(lat, lon)
+                        nd_pos[0].append(nid)
+                        nd_pos[1].append(lon)
+                        nd_pos[2].append(lat)
+                        if is_st:
+                            self.nd_tags[nid] = (lat, lon, tags)
+                            changed.add(nid)
+                elif c1.tag == "way":
+                    wid = int(c1.attrib["id"], 10)
+                    tags = [c2.attrib for c2 in c1 if c2.tag == "tag"]
+                    is_st_poly = any(self.is_st_poly(attr) for attr in tags)
+
+                    if wid in ways:
+                        changed.add(-wid)
+                        if action == "delete" or not is_st_poly:
+                            del ways[wid]
+
+                    if action != "delete" and is_st_poly:
+                        names = [(name, attr["k"]) for attr in tags
+                                 if attr["k"] in st_name_attrs
+                                 for name in attr["v"].split(";")]
+                        ways[wid] = ([int(c2.attrib["ref"], 10) for c2 in c1
+                                      if c2.tag == "nd"], names)
+                        changed.add(-wid)
+                elif c1.tag == "relation":
+                    rid = int(c1.attrib["id"], 10)
+                    tags = [c2.attrib for c2 in c1 if c2.tag == "tag"]
+                    members = [{"type": c2.attrib["type"],
+                                "ref": int(c2.attrib["ref"], 10)}
+                               for c2 in c1 if c2.tag == "member"]
+
+                    if rid in self.rel_tags:
+                        # the old members changed
+                        changed_rels.add(rid)
+                        changed_rels.update(self.member_ids(
+                            self.rel_tags[rid][1], changed))
+                        del self.rel_tags[rid]
+
+                    if action != "delete" and any(
+                            self.is_grp(attr) or self.is_meta_grp(attr)
+                            for attr in tags):
+                        self.rel_tags[rid] = (tags, members)
+                        changed_rels.add(rid)
+                        changed_rels.update(self.member_ids(members, changed))
+                else:
+                    continue
+
+                c1.clear()
+
+        # station ways with moved nodes changed
+        moved = np.intersect1d(np.array(nd_pos[0], dtype=np.int64),
+                               self.way_kept_nds)
+        if len(moved):
+            for wid, (refs, names) in ways.items():
+                if np.isin(refs, moved).any():
+                    changed.add(-wid)
+
+        changed.update(self.group_station_ids(changed_rels))
+
+        self.rebuild(unique, ways, nd_pos)
+
+        changed.update(self.group_station_ids(changed_rels))
+
+        return changed
+
+    def member_ids(self, members, changed):
+        '''
+        Add the OSM ids of the node and way members to changed, return the
+        ids of the relation members
+        '''
+
+        rels = []
+        for m in members:
+            if m["type"] == "node":
+                changed.add(m["ref"])
+            elif m["type"] == "way":
+                changed.add(-m["ref"])
+            elif m["type"] == "relation":
+                rels.append(m["ref"])
+        return rels
+
+    def group_station_ids(self, rel_ids):
+        '''
+        Return the OSM ids of the stations in the groups of relations rel_ids
+        '''
+
+        return set(self.stations[sid].osmnid for g in self.groups
+                   if g.osm_rel_id in rel_ids for sid in g.stats)
+
+    def rebuild(self, unique, ways, nd_pos=([], [], [])):
+        '''
+        Rebuild the stations and groups from the kept tags, the station
+        ways (a dict of id -> (refs, names)) and the known way node
+        positions, plus the way node positions nd_pos given as
+        (ids, lons, lats)
+
+        >>> p = OsmParser()
+        >>> p.keep_tags = True
+        >>> p.parse_xml("testdata/test.osm", False, True)
+        >>> stats = [str(st) for st in p.stations]
+        >>> p.rebuild(False, p.ways())
+        >>> stats == [str(st) for st in p.stations]
+        True
+        '''
+
+        kept = self.way_kept_nds
+        lons = self.way_nd_lons
+        lats = self.way_nd_lats
+
+        self.nd_group_idx = {}
+        self.way_group_idx = {}
+        self.rel_meta_group_idx = {}
+        self.groups = []
+        self.stations = StationTable()
+
+        self.num_osm_stats = 0
+        self.num_osm_stat_orphans = 0
+        self.num_osm_groups = 0
+        self.num_osm_way_polys = 0
+
+        self.way_ids = array('q')
+        self.way_names = []
+        self.way_refs = array('q')
+        self.way_offs = array('q', [0])
+
+        for rid, (tags, members) in list(self.rel_tags.items()):
+            self.add_relation(rid, tags, members, unique)
+
+        self.set_meta_groups()
 
-        self.parse_nodes(osm_file, unique);
+        for wid, (refs, names) in ways.items():
+            self.add_way_names(wid, refs, names)
+
+        self.index_way_nds()
+        self.set_way_nd_pos(kept, lons, lats)
+        self.set_way_nd_pos(*nd_pos)
+
+        for nid, (lat, lon, tags) in list(self.nd_tags.items()):
+            self.add_station_node(nid, lat, lon, tags, unique)
+
+        self.finish(unique)
+
+    def ways(self):
+        '''
+        Return the station ways as a dict of id -> (refs, names)
+        '''
+
+        return {wid: (self.way_refs[self.way_offs[i]:self.way_offs[i + 1]],
+                      self.way_names[i])
+                for i, wid in enumerate(self.way_ids)}
+
+    def finish(self, unique=False):
+        '''
+        Build the station polygons after all nodes have been parsed.
+        '''
 
         self.log.info("Building station polygons")
         self.build_station_polys(unique)
 
+        if self.region is not None:
+            self.drop_empty_groups()
+
         self.log.info("Parsed %d stations, %d station polygons, %s groups, %s orphan stats."
                       % (self.num_osm_stats, self.num_osm_way_polys, self.num_osm_groups, self.num_osm_stat_orphans))
 
-    def parse_relations(self, f, unique=False):
+    def parse_pbf(self, path, unique=False, with_polygons=False, workers=None):
         '''
-        Parse the relations in an OSM file
+        Parse an OSM PBF path. The blobs of the file are decoded in parallel
+        by a pool of workers processes (as many as CPUs if workers is None).
+
+        >>> p = OsmParser()
+        >>> p.parse_pbf("testdata/test.osm.pbf", False, True, workers=1)
+        >>> x = OsmParser()
+        >>> x.parse_xml("testdata/test.osm", False, True)
+        >>> [str(st) for st in p.stations] == [str(st) for st in x.stations]
+        True
+        >>> [str(grp) for grp in p.groups] == [str(grp) for grp in x.groups]
+        True
+        >>> p.bounds == x.bounds
+        True
+        >>> p = OsmParser()
+        >>> p.parse_pbf("testdata/test.osm.pbf", unique=True, workers=2)
+        >>> sorted([str(grp) for grp in p.groups])
+        ... # doctest: +NORMALIZE_WHITESPACE
+        ['Group (rel_id=3271923) with 12 stations',\
+        'Group (rel_id=None) with 1 stations']
+        '''
+
+        blobs = [(path, offset, size, with_polygons, self.region)
+                 for btype, offset, size in blob_index(path)
+                 if btype == "OSMData"]
+
+        self.log.info("Decoding %d PBF blobs..." % len(blobs))
+
+        # candidate station nodes, buffered until the relations are known
+        st_nds = []
+
+        for bounds, blob_st_nds, ways, rels in self.pbf_map(
+                _pbf_decode_blob, blobs, workers):
+            if bounds is not None:
+                self.merge_bounds(bounds[0:2], bounds[2:4])
+
+            st_nds.extend(blob_st_nds)
+
+            for wid, nds, tags in ways:
+                self.add_way(wid, nds, tags)
+
+            for rid, members, tags in rels:
+                self.add_relation(rid, tags, members, unique)
+
+        self.set_meta_groups()
+
+        self.index_way_nds()
+
+        if len(self.way_kept_nds):
+            blobs = [(path, offset, size, False, None)
+                     for path, offset, size, _, _ in blobs]
+            for nids, lons, lats in self.pbf_map(
+                    _pbf_decode_nd_pos, blobs, workers, _pbf_init,
+                    (self.way_kept_nds,)):
+                self.set_way_nd_pos(nids, lons, lats)
+
+        for nid, lat, lon, tags in st_nds:
+            self.add_station_node(nid, lat, lon, tags, unique)
+
+        self.finish(unique)
+
+    def pbf_map(self, func, blobs, workers=None, initializer=None,
+                initargs=()):
+        '''
+        Map func over blobs (in order), using a pool of worker processes
+        '''
+
+        if workers == 1:
+            if initializer is not None:
+                initializer(*initargs)
+            for blob in blobs:
+                yield func(blob)
+            return
+
+        with mp.Pool(workers, initializer, initargs) as pool:
+            for res in pool.imap(func, blobs):
+                yield res
+
+    def parse_single_pass(self, f, unique=False, with_polygons=False):
+        '''
+        Parse nodes, ways and relations of an OSM file in a single pass.
         '''
 
         f.seek(0)
@@ -251,79 +794,284 @@ class OsmParser(object):
 
         i = 0
 
+        # candidate station nodes, buffered until the relations are known
+        st_nds = []
+
         for event, c1 in context:
             if event == "start":
                 continue
 
+            if c1.tag == "node":
+                nid = int(c1.attrib["id"], 10)
+                lat = float(c1.attrib["lat"])
+                lon = float(c1.attrib["lon"])
+
+                self.update_bounds(lat, lon)
+
+                tags = [c2.attrib for c2 in c1 if c2.tag == "tag"]
+
+                for attr in tags:
+                    if self.is_st(attr):
+                        st_nds.append((nid, lat, lon, tags))
+                        break
+            elif c1.tag == "way":
+                if with_polygons:
+                    self.parse_way(c1)
+            elif c1.tag == "relation":
+                self.parse_relation(c1, unique)
+            else:
+                continue
+
             i = i + 1
 
-            if c1.tag != "relation":
-                if i % BUFFER == 0:
-                    root.clear()
-                continue
+            if i % BUFFER == 0:
+                root.clear()
 
-            is_st_area = 2  # 2 == undecided
-            is_meta_st_area = 2  # 2 == undecided
-            curGroup = StatGroup(osm_rel_id=int(c1.attrib["id"], 10))
+        self.set_meta_groups()
 
-            for c2 in c1:
-                if c2.tag != "tag":
-                    continue
-                if is_st_area == 2 and self.is_grp(c2.attrib):
-                    is_st_area = 1
-                if self.is_grp_exl(c2.attrib):
-                    is_st_area = 0
-
-                if is_meta_st_area == 2 and self.is_meta_grp(c2.attrib):
-                    is_meta_st_area = 1
-
-                # collect attrs for group
-                if c2.attrib["k"] in st_name_attrs:
-                    for name in c2.attrib["v"].split(";"):
-                        name = " ".join(name.replace('\r', ' ').replace('\n', ' ').split())
-                        if len(name) == 0:
-                            continue
-                        if not unique or not curGroup.has_name(name):
-                            curGroup.add_name(name, c2.attrib["k"])
-
-            if not is_st_area == 1 and not is_meta_st_area == 1:
-                if i % BUFFER == 0:
-                    root.clear()
+        if with_polygons:
+            self.index_way_nds()
+            self.parse_way_nd_pos(f)
+
+        for nid, lat, lon, tags in st_nds:
+            self.add_station_node(nid, lat, lon, tags, unique)
+
+    def set_meta_groups(self):
+        '''
+        Assign the parsed meta groups (stop_area_groups) to their groups
+        '''
+
+        for gid, g in enumerate(self.groups):
+            if g.osm_rel_id in self.rel_meta_group_idx:
+                g.set_meta_group(self.rel_meta_group_idx[g.osm_rel_id])
+
+    def drop_empty_groups(self):
+        '''
+        Drop the groups without any stations (e.g. stop areas outside of
+        the parsed region) and update the group ids of the stations
+
+        >>> from statsimi.osm.region import Region
+        >>> p = OsmParser(Region(bbox=(47.99, 7.854, 47.991, 7.855)))
+        >>> p.parse_xml("testdata/test.osm", False, True)
+        >>> [str(grp) for grp in p.groups]
+        ... # doctest: +NORMALIZE_WHITESPACE
+        ['Group (rel_id=3271923) with 6 stations',
+        'Group (rel_id=None) with 1 stations',
+        'Group (rel_id=None) with 1 stations']
+        >>> sorted(set(st.osmnid for st in p.stations))
+        [-1, 248609020, 248609028, 4984926391]
+        >>> p.bounds
+        [[47.9905784, 7.8542707], [47.9907312, 7.8548107]]
+        >>> p = OsmParser(Region(bbox=(47.9906, 7.8544, 47.99068, 7.8546)))
+        >>> p.parse_xml("testdata/test.osm")
+        >>> [str(grp) for grp in p.groups], [st.gid for st in p.stations]
+        (['Group (rel_id=None) with 1 stations'], [0])
+        '''
+
+        gid_map = {}
+        groups = []
+
+        for gid, g in enumerate(self.groups):
+            if len(g.stats) == 0:
                 continue
+            gid_map[gid] = len(groups)
+            groups.append(g)
 
-            if is_st_area == 1:
-                # add new group
-                self.groups.append(curGroup)
+        gid_arr = np.full(len(self.groups), -1, dtype=np.int64)
+        gid_arr[list(gid_map.keys())] = list(gid_map.values())
 
-                self.num_osm_groups += 1
+        self.num_osm_groups -= len(self.groups) - len(groups)
+        self.groups = groups
 
-                for c2 in c1:
-                    if c2.tag != "member":
-                        continue
-                    if c2.attrib["type"] == "node":
-                        self.nd_group_idx[int(c2.attrib["ref"], 10)] = len(
-                            self.groups) - 1
-                    if c2.attrib["type"] == "way":
-                        self.way_group_idx[int(c2.attrib["ref"], 10)] = len(
-                            self.groups) - 1
-
-            if is_meta_st_area == 1:
-                for c2 in c1:
-                    if c2.tag != "member":
-                        continue
-                    if c2.attrib["type"] != "relation":
-                        continue
-                    self.rel_meta_group_idx[int(
-                        c2.attrib["ref"], 10)] = c1.attrib["id"]
+        self.stations.gid[:] = gid_arr[self.stations.gid]
+        self.stations.orig_gid[:] = gid_arr[self.stations.orig_gid]
+
+        self.nd_group_idx = {nid: gid_map[gid] for nid, gid in
+                             self.nd_group_idx.items() if gid in gid_map}
+        self.way_group_idx = {wid: gid_map[gid] for wid, gid in
+                              self.way_group_idx.items() if gid in gid_map}
+
+    def merge(self, other):
+        '''
+        Append the stations and groups parsed by the OsmParser other (e.g.
+        from another input file), with their group and station ids remapped
+
+        >>> p = OsmParser()
+        >>> p.parse_xml("testdata/test.osm", False, True)
+        >>> q = OsmParser()
+        >>> q.parse_xml("testdata/test.osm", False, True)
+        >>> p.merge(q)
+        >>> [str(grp) for grp in p.groups]
+        ... # doctest: +NORMALIZE_WHITESPACE
+        ['Group (rel_id=3271923) with 18 stations',
+         'Group (rel_id=None) with 1 stations',
+         'Group (rel_id=None) with 1 stations',
+         'Group (rel_id=3271923) with 18 stations',
+         'Group (rel_id=None) with 1 stations',
+         'Group (rel_id=None) with 1 stations']
+        >>> len(p.stations), p.stations[20].gid, p.groups[3].stats[0]
+        (40, 3, 20)
+        '''
+
+        goff = len(self.groups)
+        soff = len(self.stations)
+
+        self.stations.extend(other.stations, goff)
+
+        for g in other.groups:
+            g.stats = [sid + soff for sid in g.stats]
+            self.groups.append(g)
+
+        self.merge_bounds(other.ll, other.ur)
+
+        self.num_osm_stats += other.num_osm_stats
+        self.num_osm_stat_orphans += other.num_osm_stat_orphans
+        self.num_osm_groups += other.num_osm_groups
+        self.num_osm_way_polys += other.num_osm_way_polys
+
+        if not (self.keep_tags and other.keep_tags):
+            return
+
+        # the raw tags, needed to later apply change files
+        self.nd_tags.update(other.nd_tags)
+        self.rel_tags.update(other.rel_tags)
+
+        kept = [(self.way_kept_nds, self.way_nd_lons, self.way_nd_lats),
+                (other.way_kept_nds, other.way_nd_lons, other.way_nd_lats)]
+
+        roff = len(self.way_refs)
+        self.way_ids.extend(other.way_ids)
+        self.way_names.extend(other.way_names)
+        self.way_refs.extend(other.way_refs)
+        self.way_offs.extend(off + roff for off in other.way_offs[1:])
+
+        self.index_way_nds()
+        for ids, lons, lats in kept:
+            m = ~np.isnan(lons)
+            self.set_way_nd_pos(ids[m], lons[m], lats[m])
+
+    def merge_bounds(self, ll, ur):
+        '''
+        Extend the bounds by the bounds [ll, ur]
+        '''
+
+        self.ll = [min(self.ll[0], ll[0]), min(self.ll[1], ll[1])]
+        self.ur = [max(self.ur[0], ur[0]), max(self.ur[1], ur[1])]
+
+    def update_bounds(self, lat, lon):
+        if self.region is not None and not self.region.contains(lat, lon):
+            return
+        if lat < self.ll[0]:
+            self.ll[0] = lat
+        if lon < self.ll[1]:
+            self.ll[1] = lon
+        if lat > self.ur[0]:
+            self.ur[0] = lat
+        if lon > self.ur[1]:
+            self.ur[1] = lon
+
+    def parse_relations(self, f, unique=False):
+        '''
+        Parse the relations in an OSM file
+        '''
+
+        f.seek(0)
+        context = ET.iterparse(f, events=("start", "end"))
+        context = iter(context)
+        event, root = next(context)
+
+        i = 0
+
+        for event, c1 in context:
+            if event == "start":
+                continue
+
+            i = i + 1
+
+            if c1.tag == "relation":
+                self.parse_relation(c1, unique)
 
             if i % BUFFER == 0:
                 root.clear()
 
+    def parse_relation(self, c1, unique=False):
+        '''
+        Parse a single relation element
+        '''
+
+        self.add_relation(
+            int(c1.attrib["id"], 10),
+            [c2.attrib for c2 in c1 if c2.tag == "tag"],
+            [{"type": c2.attrib["type"], "ref": int(c2.attrib["ref"], 10)}
+             for c2 in c1 if c2.tag == "member"],
+            unique)
+
+    def add_relation(self, rid, tags, members, unique=False):
+        '''
+        Add a relation with tag attributes tags and members (a list of
+        dicts with "type" and integer "ref")
+        '''
+
+        is_st_area = 2  # 2 == undecided
+        is_meta_st_area = 2  # 2 == undecided
+        curGroup = StatGroup(osm_rel_id=rid)
+
+        for attr in tags:
+            if is_st_area == 2 and self.is_grp(attr):
+                is_st_area = 1
+            if self.is_grp_exl(attr):
+                is_st_area = 0
+
+            if is_meta_st_area == 2 and self.is_meta_grp(attr):
+                is_meta_st_area = 1
+
+            # collect attrs for group
+            if attr["k"] in st_name_attrs:
+                for name in attr["v"].split(";"):
+                    name = " ".join(name.replace('\r', ' ').replace('\n', ' ').split())
+                    if len(name) == 0:
+                        continue
+                    if not unique or not curGroup.has_name(name):
+                        curGroup.add_name(name, attr["k"])
+
+        if self.keep_tags and (is_st_area == 1 or is_meta_st_area == 1):
+            self.rel_tags[rid] = (tags, members)
+
+        if is_st_area == 1:
+            # add new group
+            self.groups.append(curGroup)
+
+            self.num_osm_groups += 1
+
+            for m in members:
+                if m["type"] == "node":
+                    self.nd_group_idx[m["ref"]] = len(self.groups) - 1
+                if m["type"] == "way":
+                    self.way_group_idx[m["ref"]] = len(self.groups) - 1
+
+        if is_meta_st_area == 1:
+            for m in members:
+                if m["type"] != "relation":
+                    continue
+                self.rel_meta_group_idx[m["ref"]] = str(rid)
+
     def parse_nodes(self, f, unique=False):
         '''
         Parse the nodes in an OSM file
         '''
 
+        for nid in self.iter_station_nodes(f, unique):
+            pass
+
+    def iter_station_nodes(self, f, unique=False):
+        '''
+        Parse the nodes in an OSM file, yield the id of each station node
+        after it has been added
+        '''
+
+        if isinstance(f, NodeFilter):
+            f.keep = self.way_kept_nds
+
         f.seek(0)
         context = ET.iterparse(f, events=("start", "end"))
         context = iter(context)
@@ -331,6 +1079,10 @@ class OsmParser(object):
 
         i = 0
 
+        # positions of possible way nodes, looked up in batches
+        with_way_nds = len(self.way_kept_nds) > 0
+        nd_pos = ([], [], [])
+
         for event, c1 in context:
             if event == "start":
                 continue
@@ -349,100 +1101,196 @@ class OsmParser(object):
             lat = float(c1.attrib["lat"])
             lon = float(c1.attrib["lon"])
 
-            if lat < self.ll[0]:
-                self.ll[0] = lat
-            if lon < self.ll[1]:
-                self.ll[1] = lon
-            if lat > self.ur[0]:
-                self.ur[0] = lat
-            if lon > self.ur[1]:
-                self.ur[1] = lon
-
-            if nid in self.way_kept_nds:
-                self.way_nd_pos[nid] = (lon, lat)
-
-            is_station = False
-            for c2 in c1:
-                if c2.tag != "tag":
-                    continue
-                if self.is_st(c2.attrib):
-                    is_station = True
+            self.update_bounds(lat, lon)
 
-            if not is_station:
-                if i % BUFFER == 0:
-                    root.clear()
-                continue
+            if with_way_nds:
+                nd_pos[0].append(nid)
+                nd_pos[1].append(lon)
+                nd_pos[2].append(lat)
 
-            self.num_osm_stats += 1
+            tags = [c2.attrib for c2 in c1 if c2.tag == "tag"]
 
-            if nid not in self.nd_group_idx:
-                self.num_osm_stat_orphans += 1
-                # this node has its own group, possible with multiple
-                # entries because it has multiple names!
+            for attr in tags:
+                if self.is_st(attr):
+                    self.add_station_node(nid, lat, lon, tags, unique)
+                    yield nid
+                    break
 
-                # add new orphan group
-                self.groups.append(StatGroup())
+            if i % BUFFER == 0:
+                root.clear()
+                self.flush_way_nd_pos(nd_pos)
 
-                self.nd_group_idx[nid] = len(self.groups) - 1
+        self.flush_way_nd_pos(nd_pos)
 
-            unique_st_names = set()
-            cur_st_names = []
+        if isinstance(f, NodeFilter):
+            for ids, lons, lats in f.nd_pos:
+                self.set_way_nd_pos(ids, lons, lats)
 
-            orig_nd_name = ""
+    def parse_way_nd_pos(self, f):
+        '''
+        Parse the positions of the nodes referenced by station ways
+        '''
 
-            # collect unique station names
-            for c2 in c1:
-                if c2.attrib["k"] in st_name_attrs:
-                    for name in c2.attrib["v"].split(";"):
-                        name = " ".join(name.replace('\r', ' ').replace('\n', ' ').split())
-                        if len(name) == 0:
-                            continue
-                        if unique and name in unique_st_names:
-                            continue
-
-                        unique_st_names.add(name)
-                        cur_st_names.append((name, c2.attrib["k"]))
-                if c2.attrib["k"] == "name":
-                    orig_nd_name = c2.attrib["v"]
+        if isinstance(f, NodeFilter):
+            # the positions are collected by the filter, the nodes
+            # themselves are not needed
+            f.keep = self.way_kept_nds
+            f.seek(0)
+            f.scan_nodes()
+            for ids, lons, lats in f.nd_pos:
+                self.set_way_nd_pos(ids, lons, lats)
+            return
 
-            for name, attr in cur_st_names:
-                self.stations.append(
-                    StatIdent(
-                        lat=lat,
-                        lon=lon,
-                        name=name,
-                        orig_nd_name=orig_nd_name,
-                        osmnid=nid,
-                        gid=self.nd_group_idx[nid],
-                        srctype=1,
-                        name_attr=attr))
-                self.groups[self.nd_group_idx[nid]].add_station(
-                    len(self.stations) - 1)
-
-            for grp_name in self.groups[self.nd_group_idx[nid]].names:
-                # we count each name of the group as a synonym for
-                # the included stations and treat them as instances
-                # of this node
-                if unique:
-                    if grp_name[0] in unique_st_names:
-                        continue
-                    unique_st_names.add(grp_name[0])
+        f.seek(0)
+        context = ET.iterparse(f, events=("start", "end"))
+        context = iter(context)
+        event, root = next(context)
+
+        i = 0
 
-                self.stations.append(
-                    StatIdent(
-                        lat=lat,
-                        lon=lon,
-                        name=grp_name[0],
-                        orig_nd_name=orig_nd_name,
-                        osmnid=nid,
-                        gid=self.nd_group_idx[nid],
-                        srctype=2,
-                        name_attr=grp_name[1]))
-                self.groups[self.nd_group_idx[nid]].add_station(
-                    len(self.stations) - 1)
+        nd_pos = ([], [], [])
+
+        for event, c1 in context:
+            if event == "start":
+                continue
+
+            i = i + 1
+
+            if c1.tag == "way" or c1.tag == "relation":
+                break
+
+            if c1.tag == "node":
+                nd_pos[0].append(int(c1.attrib["id"], 10))
+                nd_pos[1].append(float(c1.attrib["lon"]))
+                nd_pos[2].append(float(c1.attrib["lat"]))
 
             if i % BUFFER == 0:
                 root.clear()
+                self.flush_way_nd_pos(nd_pos)
+
+        self.flush_way_nd_pos(nd_pos)
+
+    def index_way_nds(self):
+        '''
+        Build the sorted array of the nodes referenced by station ways,
+        must be called after all ways have been parsed
+        '''
+
+        self.way_kept_nds = np.unique(
+            np.frombuffer(self.way_refs, dtype=np.int64))
+        self.way_nd_lons = np.full(len(self.way_kept_nds), np.nan)
+        self.way_nd_lats = np.full(len(self.way_kept_nds), np.nan)
+
+    def set_way_nd_pos(self, ids, lons, lats):
+        '''
+        Set the positions of the nodes ids, ids not referenced by a station
+        way are ignored
+
+        >>> p = OsmParser()
+        >>> p.add_way(1, [5, 3, 5], [{"k": "name", "v": "a"}])
+        >>> p.index_way_nds()
+        >>> p.set_way_nd_pos([1, 3, 5, 7], [1.0, 3.0, 5.0, 7.0],
+        ...                  [0.1, 0.3, 0.5, 0.7])
+        >>> p.way_kept_nds.tolist(), p.way_nd_lons.tolist()
+        ([3, 5], [3.0, 5.0])
+        '''
+
+        if len(self.way_kept_nds) == 0 or len(ids) == 0:
+            return
+
+        ids = np.asarray(ids, dtype=np.int64)
+        idx = np.searchsorted(self.way_kept_nds, ids)
+        idx[idx == len(self.way_kept_nds)] = 0
+        m = self.way_kept_nds[idx] == ids
+
+        self.way_nd_lons[idx[m]] = np.asarray(lons, dtype=np.float64)[m]
+        self.way_nd_lats[idx[m]] = np.asarray(lats, dtype=np.float64)[m]
+
+    def flush_way_nd_pos(self, nd_pos):
+        '''
+        Set the positions from a batch of (ids, lons, lats) lists, and
+        empty the batch
+        '''
+
+        self.set_way_nd_pos(*nd_pos)
+        for col in nd_pos:
+            del col[:]
+
+    def add_station_node(self, nid, lat, lon, tags, unique=False):
+        '''
+        Add the station identifiers for a station node with tag
+        attributes tags
+        '''
+
+        if self.region is not None and not self.region.contains(lat, lon):
+            return
+
+        if self.keep_tags:
+            self.nd_tags[nid] = (lat, lon, tags)
+
+        self.num_osm_stats += 1
+
+        if nid not in self.nd_group_idx:
+            self.num_osm_stat_orphans += 1
+            # this node has its own group, possible with multiple
+            # entries because it has multiple names!
+
+            # add new orphan group
+            self.groups.append(StatGroup())
+
+            self.nd_group_idx[nid] = len(self.groups) - 1
+
+        unique_st_names = set()
+        cur_st_names = []
+
+        orig_nd_name = ""
+
+        # collect unique station names
+        for attr in tags:
+            if attr["k"] in st_name_attrs:
+                for name in attr["v"].split(";"):
+                    name = " ".join(name.replace('\r', ' ').replace('\n', ' ').split())
+                    if len(name) == 0:
+                        continue
+                    if unique and name in unique_st_names:
+                        continue
+
+                    unique_st_names.add(name)
+                    cur_st_names.append((name, attr["k"]))
+            if attr["k"] == "name":
+                orig_nd_name = attr["v"]
+
+        for name, attr in cur_st_names:
+            sid = self.stations.add(
+                lat=lat,
+                lon=lon,
+                name=name,
+                orig_nd_name=orig_nd_name,
+                osmnid=nid,
+                gid=self.nd_group_idx[nid],
+                srctype=1,
+                name_attr=attr)
+            self.groups[self.nd_group_idx[nid]].add_station(sid)
+
+        for grp_name in self.groups[self.nd_group_idx[nid]].names:
+            # we count each name of the group as a synonym for
+            # the included stations and treat them as instances
+            # of this node
+            if unique:
+                if grp_name[0] in unique_st_names:
+                    continue
+                unique_st_names.add(grp_name[0])
+
+            sid = self.stations.add(
+                lat=lat,
+                lon=lon,
+                name=grp_name[0],
+                orig_nd_name=orig_nd_name,
+                osmnid=nid,
+                gid=self.nd_group_idx[nid],
+                srctype=2,
+                name_attr=grp_name[1])
+            self.groups[self.nd_group_idx[nid]].add_station(sid)
 
     def parse_ways(self, f, unique=False):
         '''
@@ -465,49 +1313,77 @@ class OsmParser(object):
             if c1.tag == "relation":
                 break
 
-            if c1.tag != "way":
-                if i % BUFFER == 0:
-                    root.clear()
-                continue
+            if c1.tag == "way":
+                self.parse_way(c1)
 
-            wid = int(c1.attrib["id"], 10)
-            self.way_nds[wid] = []
+            if i % BUFFER == 0:
+                root.clear()
 
-            is_station = False
-            for c2 in c1:
-                if c2.tag == "nd":
-                    nid = int(c2.attrib["ref"], 10)
-                    self.way_kept_nds.add(nid)
-                    self.way_nds[wid].append(nid)
-                if c2.tag != "tag":
-                    continue
-                if self.is_st_poly(c2.attrib):
-                    is_station = True
+    def parse_way(self, c1):
+        '''
+        Parse a single way element, only station ways are kept
+        '''
 
-            if not is_station:
-                if i % BUFFER == 0:
-                    root.clear()
-                continue
+        tags = [c2.attrib for c2 in c1 if c2.tag == "tag"]
 
-            self.num_osm_way_polys += 1
+        for attr in tags:
+            if self.is_st_poly(attr):
+                self.add_way(
+                    int(c1.attrib["id"], 10),
+                    [int(c2.attrib["ref"], 10) for c2 in c1 if c2.tag == "nd"],
+                    tags)
+                break
 
-            cur_st_names = []
+    def add_way(self, wid, nds, tags):
+        '''
+        Add a station way with node refs nds and tag attributes tags
+        '''
 
-            # collect unique station names
-            for c2 in c1:
-                if c2.tag != "tag":
-                    continue
-                if c2.attrib["k"] in st_name_attrs:
-                    for name in c2.attrib["v"].split(";"):
-                        cur_st_names.append((name, c2.attrib["k"]))
+        cur_st_names = []
 
-            self.way_names[wid] = cur_st_names
+        # collect unique station names
+        for attr in tags:
+            if attr["k"] in st_name_attrs:
+                for name in attr["v"].split(";"):
+                    cur_st_names.append((name, attr["k"]))
 
-            if i % BUFFER == 0:
-                root.clear()
+        self.add_way_names(wid, nds, cur_st_names)
+
+    def add_way_names(self, wid, nds, names):
+        '''
+        Add a station way with node refs nds and (name, attr) pairs names
+        '''
+
+        self.way_ids.append(wid)
+        self.way_refs.extend(nds)
+        self.way_offs.append(len(self.way_refs))
+        self.way_names.append(names)
+
+        self.num_osm_way_polys += 1
 
     def build_station_polys(self, unique):
-        for wid, names in self.way_names.items():
+        # position of each way node ref in the way node arrays
+        nd_idx = np.searchsorted(self.way_kept_nds,
+                                 np.frombuffer(self.way_refs, dtype=np.int64))
+
+        for i, wid in enumerate(self.way_ids):
+            names = self.way_names[i]
+
+            idx = nd_idx[self.way_offs[i]:self.way_offs[i + 1]]
+            lons = self.way_nd_lons[idx]
+            lats = self.way_nd_lats[idx]
+
+            # skip nodes missing in the input, e.g. cut off at its border
+            m = ~np.isnan(lons)
+            poly = list(zip(lons[m].tolist(), lats[m].tolist()))
+
+            if len(poly) == 0:
+                continue
+
+            if self.region is not None and not self.region.contains_arr(
+                    lats[m], lons[m]).any():
+                continue
+
             if wid not in self.way_group_idx:
                 self.num_osm_stat_orphans += 1
                 # this node has its own group, possible with multiple
@@ -537,22 +1413,16 @@ class OsmParser(object):
                 if key == "name":
                     orig_nd_name = name
 
-            poly = []
-            for nid in self.way_nds[wid]:
-                poly.append(self.way_nd_pos[nid])
-
             for name, attr in cur_st_names:
-                self.stations.append(
-                    StatIdent(
-                        poly=poly,
-                        name=name,
-                        orig_nd_name=orig_nd_name,
-                        osmnid=-wid,
-                        gid=self.way_group_idx[wid],
-                        srctype=1,
-                        name_attr=attr))
-                self.groups[self.way_group_idx[wid]].add_station(
-                    len(self.stations) - 1)
+                sid = self.stations.add(
+                    poly=poly,
+                    name=name,
+                    orig_nd_name=orig_nd_name,
+                    osmnid=-wid,
+                    gid=self.way_group_idx[wid],
+                    srctype=1,
+                    name_attr=attr)
+                self.groups[self.way_group_idx[wid]].add_station(sid)
 
             for grp_name in self.groups[self.way_group_idx[wid]].names:
                 # we count each name of the group as a synonym for
@@ -563,15 +1433,79 @@ class OsmParser(object):
                         continue
                     unique_st_names.add(grp_name[0])
 
-                self.stations.append(
-                    StatIdent(
-                        poly=poly,
-                        name=grp_name[0],
-                        orig_nd_name=orig_nd_name,
-                        osmnid=-wid,
-                        gid=self.way_group_idx[wid],
-                        srctype=2,
-                        name_attr=grp_name[1]))
-                self.groups[self.way_group_idx[wid]].add_station(
-                    len(self.stations) - 1)
+                sid = self.stations.add(
+                    poly=poly,
+                    name=grp_name[0],
+                    orig_nd_name=orig_nd_name,
+                    osmnid=-wid,
+                    gid=self.way_group_idx[wid],
+                    srctype=2,
+                    name_attr=grp_name[1])
+                self.groups[self.way_group_idx[wid]].add_station(sid)
+
+
+# node ids whose positions are needed by the PBF node position workers
+_pbf_kept_nds = None
+
+
+def _pbf_init(kept):
+    global _pbf_kept_nds
+    _pbf_kept_nds = kept
+
+
+def _pbf_decode_blob(blob):
+    '''
+    Decode a single PBF data blob, return the bounds of its nodes, the
+    candidate station nodes, the station ways and the group relations
+    '''
+
+    path, offset, size, with_polygons, region = blob
+    block = PrimitiveBlock(read_blob(path, offset, size))
+    fil = OsmParser()
+
+    ids, lats, lons, tagged = block.nodes()
+
+    inside = None
+    if region is not None:
+        inside = region.contains_arr(lats, lons)
+
+    bounds = None
+    if inside is not None:
+        if inside.any():
+            bounds = (float(lats[inside].min()), float(lons[inside].min()),
+                      float(lats[inside].max()), float(lons[inside].max()))
+    elif len(ids):
+        bounds = (float(lats.min()), float(lons.min()), float(lats.max()),
+                  float(lons.max()))
+
+    st_nds = []
+    for i, tags in tagged:
+        if inside is not None and not inside[i]:
+            continue
+        for attr in tags:
+            if fil.is_st(attr):
+                st_nds.append((int(ids[i]), float(lats[i]), float(lons[i]),
+                               tags))
+                break
+
+    ways = []
+    if with_polygons:
+        ways = list(block.ways(
+            lambda tags: any(fil.is_st_poly(attr) for attr in tags)))
+
+    rels = list(block.relations(
+        lambda tags: any(fil.is_grp(attr) or fil.is_meta_grp(attr)
+                         for attr in tags)))
+
+    return bounds, st_nds, ways, rels
+
+
+def _pbf_decode_nd_pos(blob):
+    '''
+    Decode the positions of the nodes in _pbf_kept_nds from a PBF data blob
+    '''
 
+    path, offset, size, _, _ = blob
+    ids, lats, lons, _ = PrimitiveBlock(read_blob(path, offset, size)).nodes()
+    m = np.isin(ids, _pbf_kept_nds)
+    return ids[m], lons[m], lats[m]
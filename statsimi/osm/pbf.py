@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright 2019, University of Freiburg.
+Chair of Algorithms and Data Structures.
+Patrick Brosi <brosi@informatik.uni-freiburg.de>
+'''
+
+import zlib
+import lzma
+import numpy as np
+
+# Minimal decoder for the OSM PBF format, see
+# https://wiki.openstreetmap.org/wiki/PBF_Format
+# Only the parts of the format needed to extract stations are decoded.
+
+MEMBER_TYPES = ["node", "way", "relation"]
+
+
+def read_varint(buf, pos):
+    '''
+    Read a single varint from buf at pos, return the value and the new pos
+
+    >>> read_varint(b'\\x96\\x01', 0)
+    (150, 2)
+    >>> read_varint(b'\\x01\\x7f', 1)
+    (127, 2)
+    '''
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def to_int64(v):
+    '''
+    Interpret an unsigned varint value as a (two's complement) int64
+
+    >>> to_int64(5)
+    5
+    >>> to_int64(2**64 - 3)
+    -3
+    '''
+    if v >= 1 << 63:
+        return v - (1 << 64)
+    return v
+
+
+def zigzag(v):
+    '''
+    Decode a zigzag-encoded signed value
+
+    >>> [zigzag(v) for v in [0, 1, 2, 3, 4]]
+    [0, -1, 1, -2, 2]
+    '''
+    return (v >> 1) ^ -(v & 1)
+
+
+def fields(buf):
+    '''
+    Iterate over the (field number, value) pairs of a protobuf message.
+    Varints are returned as (unsigned) integers, length-delimited fields
+    as memoryviews.
+
+    >>> [(n, bytes(v) if isinstance(v, memoryview) else v)
+    ...     for n, v in fields(b'\\x08\\x96\\x01\\x12\\x02ab')]
+    [(1, 150), (2, b'ab')]
+    '''
+    buf = memoryview(buf)
+    pos = 0
+    n = len(buf)
+    while pos < n:
+        key, pos = read_varint(buf, pos)
+        wt = key & 7
+        if wt == 0:
+            val, pos = read_varint(buf, pos)
+        elif wt == 2:
+            length, pos = read_varint(buf, pos)
+            val = buf[pos:pos + length]
+            pos += length
+        elif wt == 1:
+            val = buf[pos:pos + 8]
+            pos += 8
+        elif wt == 5:
+            val = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type %d" % wt)
+        yield key >> 3, val
+
+
+def packed_varints(buf):
+    '''
+    Decode a packed array of varints into an uint64 numpy array, without
+    a Python-level loop over the values.
+
+    >>> packed_varints(b'\\x03\\x8e\\x02\\x9e\\xa7\\x05').tolist()
+    [3, 270, 86942]
+    >>> packed_varints(b'').tolist()
+    []
+    '''
+    b = np.frombuffer(buf, dtype=np.uint8)
+    if len(b) == 0:
+        return np.zeros(0, dtype=np.uint64)
+
+    ends = np.flatnonzero(b < 0x80)
+    starts = np.empty(len(ends), dtype=np.int64)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+
+    # the position of each byte inside its varint
+    pos = np.arange(len(b), dtype=np.int64) - \
+        np.repeat(starts, ends - starts + 1)
+
+    vals = (b & 0x7f).astype(np.uint64) << (7 * pos).astype(np.uint64)
+    return np.add.reduceat(vals, starts)
+
+
+def packed_sint64(buf, delta=False):
+    '''
+    Decode a packed array of (zigzag encoded) sint64 values, optionally
+    delta coded.
+
+    >>> packed_sint64(b'\\x02\\x04\\x03').tolist()
+    [1, 2, -2]
+    >>> packed_sint64(b'\\x02\\x04\\x03', delta=True).tolist()
+    [1, 3, 1]
+    '''
+    v = packed_varints(buf)
+    ret = (v >> np.uint64(1)).astype(np.int64) ^ \
+        -(v & np.uint64(1)).astype(np.int64)
+    if delta:
+        return np.cumsum(ret)
+    return ret
+
+
+def packed_int64(buf):
+    '''
+    Decode a packed array of (non-zigzag) int32/int64 values.
+
+    >>> packed_int64(b'\\x01\\x02').tolist()
+    [1, 2]
+    '''
+    return packed_varints(buf).astype(np.int64)
+
+
+def blob_index(path):
+    '''
+    Return a list of (type, offset, size) for each blob in a PBF file, where
+    offset and size describe the serialized Blob message.
+    '''
+    ret = []
+    with open(path, 'rb') as f:
+        while True:
+            lbytes = f.read(4)
+            if len(lbytes) < 4:
+                break
+            hlen = int.from_bytes(lbytes, byteorder='big')
+            header = f.read(hlen)
+
+            btype = None
+            size = 0
+            for num, val in fields(header):
+                if num == 1:
+                    btype = bytes(val).decode("utf-8")
+                elif num == 3:
+                    size = val
+
+            ret.append((btype, f.tell(), size))
+            f.seek(size, 1)
+    return ret
+
+
+def read_blob(path, offset, size):
+    '''
+    Read and decompress the blob at offset with serialized size
+    '''
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        buf = f.read(size)
+
+    for num, val in fields(buf):
+        if num == 1:
+            return bytes(val)
+        if num == 3:
+            return zlib.decompress(val)
+        if num == 4:
+            return lzma.decompress(val)
+        if num in (5, 6, 7):
+            raise ValueError("Unsupported PBF blob compression (field %d)"
+                             % num)
+
+    return b''
+
+
+class PrimitiveBlock(object):
+    '''
+    A decoded OSM PBF PrimitiveBlock.
+    '''
+
+    def __init__(self, data):
+        self.strings = []
+        self.granularity = 100
+        self.lat_offset = 0
+        self.lon_offset = 0
+        self.prim_groups = []
+
+        for num, val in fields(data):
+            if num == 1:
+                self.strings = [bytes(s).decode("utf-8")
+                                for n, s in fields(val) if n == 1]
+            elif num == 2:
+                self.prim_groups.append(val)
+            elif num == 17:
+                self.granularity = val
+            elif num == 19:
+                self.lat_offset = to_int64(val)
+            elif num == 20:
+                self.lon_offset = to_int64(val)
+
+    def coord(self, offset, raw):
+        # dividing the exact integer nanodegrees gives the same float as
+        # parsing the decimal degrees of the corresponding XML attribute
+        return (offset + self.granularity * raw) / 1e9
+
+    def tags(self, keys, vals):
+        return [{"k": self.strings[k], "v": self.strings[v]}
+                for k, v in zip(keys, vals)]
+
+    def nodes(self):
+        '''
+        Return (ids, lats, lons, tagged) for all nodes in this block, where
+        tagged is a list of (i, tags) for every node i which has tags
+        '''
+        ids = []
+        lats = []
+        lons = []
+        tagged = []
+        n = 0
+
+        for grp in self.prim_groups:
+            for num, val in fields(grp):
+                if num == 1:
+                    nid, lat, lon, tags = self.plain_node(val)
+                    ids.append(np.array([nid], dtype=np.int64))
+                    lats.append(np.array([lat], dtype=np.float64))
+                    lons.append(np.array([lon], dtype=np.float64))
+                    if len(tags):
+                        tagged.append((n, tags))
+                    n += 1
+                elif num == 2:
+                    d_ids, d_lats, d_lons, d_tagged = self.dense_nodes(val)
+                    ids.append(d_ids)
+                    lats.append(d_lats)
+                    lons.append(d_lons)
+                    tagged.extend((n + i, tags) for i, tags in d_tagged)
+                    n += len(d_ids)
+
+        if n == 0:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0),
+                    tagged)
+
+        return (np.concatenate(ids), np.concatenate(lats),
+                np.concatenate(lons), tagged)
+
+    def plain_node(self, buf):
+        nid = 0
+        lat = 0
+        lon = 0
+        keys = []
+        vals = []
+        for num, val in fields(buf):
+            if num == 1:
+                nid = zigzag(val)
+            elif num == 2:
+                keys = packed_int64(val).tolist()
+            elif num == 3:
+                vals = packed_int64(val).tolist()
+            elif num == 8:
+                lat = zigzag(val)
+            elif num == 9:
+                lon = zigzag(val)
+        return (nid, self.coord(self.lat_offset, lat),
+                self.coord(self.lon_offset, lon), self.tags(keys, vals))
+
+    def dense_nodes(self, buf):
+        ids = np.zeros(0, dtype=np.int64)
+        lats = np.zeros(0, dtype=np.int64)
+        lons = np.zeros(0, dtype=np.int64)
+        kv = None
+
+        for num, val in fields(buf):
+            if num == 1:
+                ids = packed_sint64(val, delta=True)
+            elif num == 8:
+                lats = packed_sint64(val, delta=True)
+            elif num == 9:
+                lons = packed_sint64(val, delta=True)
+            elif num == 10:
+                kv = packed_int64(val)
+
+        tagged = []
+
+        if kv is not None and len(kv) > len(ids):
+            # keys_vals is a list of ((key, val)*, 0) per node, nodes without
+            # tags only have the delimiting 0
+            delims = np.flatnonzero(kv == 0)
+            starts = np.empty(len(delims), dtype=np.int64)
+            starts[0] = 0
+            starts[1:] = delims[:-1] + 1
+            kvl = kv.tolist()
+            for i in np.flatnonzero(delims > starts).tolist():
+                s = int(starts[i])
+                e = int(delims[i])
+                tagged.append((i, self.tags(kvl[s:e:2], kvl[s + 1:e:2])))
+
+        return (ids, (self.lat_offset + self.granularity * lats) / 1e9,
+                (self.lon_offset + self.granularity * lons) / 1e9, tagged)
+
+    def ways(self, fil=None):
+        '''
+        Iterate over (id, refs, tags) of the ways in this block. If fil is
+        given, only ways whose tags match fil are returned.
+        '''
+        for grp in self.prim_groups:
+            for num, val in fields(grp):
+                if num != 3:
+                    continue
+                wid = 0
+                keys = []
+                vals = []
+                refs = None
+                for wnum, wval in fields(val):
+                    if wnum == 1:
+                        wid = to_int64(wval)
+                    elif wnum == 2:
+                        keys = packed_int64(wval).tolist()
+                    elif wnum == 3:
+                        vals = packed_int64(wval).tolist()
+                    elif wnum == 8:
+                        refs = wval
+                tags = self.tags(keys, vals)
+                if fil is not None and not fil(tags):
+                    continue
+                if refs is None:
+                    yield wid, [], tags
+                else:
+                    yield wid, packed_sint64(refs, delta=True).tolist(), tags
+
+    def relations(self, fil=None):
+        '''
+        Iterate over (id, members, tags) of the relations in this block. If
+        fil is given, only relations whose tags match fil are returned.
+        '''
+        for grp in self.prim_groups:
+            for num, val in fields(grp):
+                if num != 4:
+                    continue
+                rid = 0
+                keys = []
+                vals = []
+                roles = []
+                memids = []
+                types = []
+                for rnum, rval in fields(val):
+                    if rnum == 1:
+                        rid = to_int64(rval)
+                    elif rnum == 2:
+                        keys = packed_int64(rval).tolist()
+                    elif rnum == 3:
+                        vals = packed_int64(rval).tolist()
+                    elif rnum == 8:
+                        roles = packed_int64(rval).tolist()
+                    elif rnum == 9:
+                        memids = packed_sint64(rval, delta=True).tolist()
+                    elif rnum == 10:
+                        types = packed_int64(rval).tolist()
+                tags = self.tags(keys, vals)
+                if fil is not None and not fil(tags):
+                    continue
+                members = [{"type": MEMBER_TYPES[t], "ref": ref,
+                            "role": self.strings[r]}
+                           for t, ref, r in zip(types, memids, roles)]
+                yield rid, members, tags
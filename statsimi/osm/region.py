@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright 2019, University of Freiburg.
+Chair of Algorithms and Data Structures.
+Patrick Brosi <brosi@informatik.uni-freiburg.de>
+'''
+
+import hashlib
+import math
+import numpy as np
+
+# meters per degree of latitude
+M_PER_DEG = 111319.49
+
+# maximum number of points tested against the polygon at once
+PIP_BATCH = 4096
+
+# maximum number of (point, polygon edge) pairs tested at once, bounds the
+# size of the temporary arrays of contains_exact()
+PIP_CELLS = 1 << 20
+
+
+class Region(object):
+    '''
+    A geographic region given by a bounding box or a polygon (with holes),
+    plus a halo of halo meters around it. Used to restrict parsing to a
+    part of an OSM file.
+
+    >>> r = Region(bbox=(47.9, 7.8, 48.1, 7.9))
+    >>> r.contains(48.0, 7.85), r.contains(48.0, 7.95)
+    (True, False)
+    >>> r = Region(bbox=(47.9, 7.8, 48.1, 7.9), halo=5000)
+    >>> r.contains(48.0, 7.95), r.contains(48.0, 8.0)
+    (True, False)
+    >>> r = Region(rings=[([(0, 0), (2, 0), (2, 2), (0, 2)], False),
+    ...                   ([(0.5, 0.5), (1, 0.5), (1, 1), (0.5, 1)], True)])
+    >>> r.contains_arr(np.array([1.5, 0.75, 3]), np.array([1.5, 0.75, 3]))
+    array([ True, False, False])
+    '''
+
+    def __init__(self, bbox=None, rings=None, halo=0):
+        '''
+        bbox is given as (minlat, minlon, maxlat, maxlon), rings as a list
+        of ([(lon, lat), ...], is_hole).
+        '''
+
+        self.halo = halo
+        self.rings = None
+
+        if rings is not None:
+            self.rings = [(np.array(ring, dtype=np.float64), hole)
+                          for ring, hole in rings if len(ring)]
+            outer = np.concatenate([r for r, hole in self.rings if not hole])
+            bbox = (outer[:, 1].min(), outer[:, 0].min(),
+                    outer[:, 1].max(), outer[:, 0].max())
+
+        self.bbox = tuple(float(c) for c in bbox)
+
+        # the bounding box including the halo, used as a quick check
+        lat = max(abs(self.bbox[0]), abs(self.bbox[2]))
+        dlat = halo / M_PER_DEG
+        dlon = halo / (M_PER_DEG * max(math.cos(math.radians(lat)), 0.01))
+        self.outer_bbox = (self.bbox[0] - dlat, self.bbox[1] - dlon,
+                           self.bbox[2] + dlat, self.bbox[3] + dlon)
+
+        # scale of longitudes to get an equirectangular projection in
+        # meters around the region center
+        self.lon_scale = M_PER_DEG * math.cos(
+            math.radians((self.bbox[0] + self.bbox[2]) / 2))
+
+    @staticmethod
+    def from_bbox_str(s, halo=0):
+        '''
+        Build a region from a string "minlat,minlon,maxlat,maxlon"
+
+        >>> Region.from_bbox_str("47.9,7.8,48.1,7.9").bbox
+        (47.9, 7.8, 48.1, 7.9)
+        '''
+        return Region(bbox=tuple(float(c) for c in s.split(",")), halo=halo)
+
+    @staticmethod
+    def from_poly_file(path, halo=0):
+        '''
+        Build a region from a polygon file in the Osmosis .poly format.
+        '''
+
+        rings = []
+        with open(path, 'r', encoding="utf-8") as f:
+            lines = [l.strip() for l in f]
+
+        # the first line is the name of the polygon
+        i = 1
+        while i < len(lines):
+            if lines[i] == "END" or lines[i] == "":
+                i += 1
+                continue
+            hole = lines[i].startswith("!")
+            ring = []
+            i += 1
+            while i < len(lines) and lines[i] != "END":
+                coords = lines[i].split()
+                if len(coords) >= 2:
+                    ring.append((float(coords[0]), float(coords[1])))
+                i += 1
+            rings.append((ring, hole))
+            i += 1
+
+        return Region(rings=rings, halo=halo)
+
+    def key(self):
+        '''
+        A string identifying this region, used for cache keys
+        '''
+
+        h = hashlib.sha1(("%r:%r" % (self.bbox, self.halo)).encode("utf-8"))
+        if self.rings is not None:
+            for ring, hole in self.rings:
+                h.update(b"!" if hole else b"+")
+                h.update(ring.tobytes())
+        return h.hexdigest()
+
+    def contains(self, lat, lon):
+        '''
+        Check whether (lat, lon) lies in this region (including the halo)
+        '''
+
+        if (lat < self.outer_bbox[0] or lat > self.outer_bbox[2] or
+                lon < self.outer_bbox[1] or lon > self.outer_bbox[3]):
+            return False
+
+        if self.rings is None and self.halo == 0:
+            return True
+
+        return bool(self.contains_arr(np.array([lat]), np.array([lon]))[0])
+
+    def contains_arr(self, lats, lons):
+        '''
+        Check for arrays of lats and lons whether they lie in this region
+        (including the halo), return a boolean array
+        '''
+
+        ret = ((lats >= self.outer_bbox[0]) & (lats <= self.outer_bbox[2]) &
+               (lons >= self.outer_bbox[1]) & (lons <= self.outer_bbox[3]))
+
+        if self.rings is None and self.halo == 0:
+            return ret
+
+        cand = np.flatnonzero(ret)
+
+        # fewer points per batch for polygons with many vertices
+        n_verts = 4 if self.rings is None else sum(
+            len(ring) for ring, _ in self.rings)
+        batch = min(PIP_BATCH, max(64, PIP_CELLS // n_verts))
+
+        for i in range(0, len(cand), batch):
+            idx = cand[i:i + batch]
+            ret[idx] = self.contains_exact(lats[idx], lons[idx])
+
+        return ret
+
+    def contains_exact(self, lats, lons):
+        '''
+        Check for arrays of lats and lons whether they lie in the polygon
+        or within the halo around it. The edges are tested in chunks, such
+        that at most PIP_CELLS (point, edge) pairs are held at once.
+
+        >>> r = Region(rings=[([(0, 0), (2, 0), (2, 2), (0, 2)], False)],
+        ...            halo=1000)
+        >>> import statsimi.osm.region as region
+        >>> cells = region.PIP_CELLS
+        >>> region.PIP_CELLS = 2
+        >>> r.contains_exact(np.array([1, 1, 2.005, 2.05]),
+        ...                  np.array([1, 3, 1, 1]))
+        array([ True, False,  True, False])
+        >>> region.PIP_CELLS = cells
+        '''
+        if self.rings is None:
+            rings = [(np.array([(self.bbox[1], self.bbox[0]),
+                                (self.bbox[3], self.bbox[0]),
+                                (self.bbox[3], self.bbox[2]),
+                                (self.bbox[1], self.bbox[2])]), False)]
+        else:
+            rings = self.rings
+
+        inside = np.zeros(len(lats), dtype=bool)
+        hole = np.zeros(len(lats), dtype=bool)
+        dist = np.full(len(lats), np.inf)
+
+        px = lons[:, None]
+        py = lats[:, None]
+        chunk = max(1, PIP_CELLS // max(len(lats), 1))
+
+        for ring, is_hole in rings:
+            nxt = np.roll(ring, -1, axis=0)
+
+            # even-odd rule, the parity of the crossings is accumulated
+            # over the edge chunks
+            odd = np.zeros(len(lats), dtype=bool)
+
+            for i in range(0, len(ring), chunk):
+                ax = ring[i:i + chunk, 0][None, :]
+                ay = ring[i:i + chunk, 1][None, :]
+                bx = nxt[i:i + chunk, 0][None, :]
+                by = nxt[i:i + chunk, 1][None, :]
+
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    cross = ((ay > py) != (by > py)) & \
+                        (px < (bx - ax) * (py - ay) / (by - ay) + ax)
+                odd ^= np.count_nonzero(cross, axis=1) % 2 == 1
+
+                if self.halo > 0:
+                    dist = np.minimum(dist,
+                                      self.seg_dist(ax, ay, bx, by, px, py))
+
+            if is_hole:
+                hole |= odd
+            else:
+                inside |= odd
+
+        return (inside & ~hole) | (dist <= self.halo)
+
+    def seg_dist(self, ax, ay, bx, by, px, py):
+        '''
+        Approximate distance in meters of the points (px, py) to the
+        nearest of the segments (ax, ay) -> (bx, by)
+        '''
+
+        s = self.lon_scale
+        ax, bx, px = ax * s, bx * s, px * s
+        ay, by, py = ay * M_PER_DEG, by * M_PER_DEG, py * M_PER_DEG
+
+        dx = bx - ax
+        dy = by - ay
+        l2 = dx * dx + dy * dy
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.clip(((px - ax) * dx + (py - ay) * dy) / l2, 0, 1)
+        t = np.where(l2 == 0, 0, t)
+
+        ex = ax + t * dx - px
+        ey = ay + t * dy - py
+
+        return np.sqrt(ex * ex + ey * ey).min(axis=1)
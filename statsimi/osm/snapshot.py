@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright 2019, University of Freiburg.
+Chair of Algorithms and Data Structures.
+Patrick Brosi <brosi@informatik.uni-freiburg.de>
+'''
+
+import os
+import shutil
+import hashlib
+import logging
+import numpy as np
+from array import array
+from statsimi.feature.station_table import StationTable
+from statsimi.feature.stat_group import StatGroup
+
+# bump this if the snapshot layout changes
+SNAPSHOT_VERSION = 5
+
+# relation member types, as stored in the raw columns
+MEMBER_TYPES = ["node", "way", "relation"]
+
+
+class StringPool(object):
+    '''
+    Interns strings and stores them as a single UTF-8 blob with offsets.
+
+    >>> p = StringPool()
+    >>> p.add("a"), p.add("Zürich"), p.add("a"), p.add(None)
+    (0, 1, 0, -1)
+    >>> blob, offs = p.arrays()
+    >>> StringPool.unpack(blob, offs)
+    ['a', 'Zürich']
+    '''
+
+    def __init__(self):
+        self.idx = {}
+        self.strings = []
+
+    def add(self, s):
+        if s is None:
+            return -1
+        if s not in self.idx:
+            self.idx[s] = len(self.strings)
+            self.strings.append(s)
+        return self.idx[s]
+
+    def arrays(self):
+        encoded = [s.encode("utf-8") for s in self.strings]
+        offs = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(e) for e in encoded], out=offs[1:])
+        blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        return blob, offs
+
+    @staticmethod
+    def unpack(blob, offs):
+        data = bytes(blob)
+        offs = offs.tolist()
+        return [data[offs[i]:offs[i + 1]].decode("utf-8")
+                for i in range(len(offs) - 1)]
+
+
+def write_snapshot(osmp, path):
+    '''
+    Write the parse result of an OsmParser to the snapshot directory path.
+    Every column is stored as a separate .npy file in the layout of the
+    StationTable columns, so that it can later be memory-mapped.
+    '''
+
+    pool = StringPool()
+
+    stats = osmp.stations
+
+    # the string ids of the station table in the snapshot pool
+    str_map = np.array([pool.add(st) for st in stats.strings] + [-1],
+                       dtype=np.int32)
+
+    grps = osmp.groups
+    m = len(grps)
+
+    rel_id = np.zeros(m, dtype=np.int64)
+    meta_rel_id = np.zeros(m, dtype=np.int64)
+    stats_offs = np.zeros(m + 1, dtype=np.int64)
+    names_offs = np.zeros(m + 1, dtype=np.int64)
+    grp_stats = []
+    grp_names = []
+
+    for i, g in enumerate(grps):
+        rel_id[i] = g.osm_rel_id or 0
+        meta_rel_id[i] = int(g.osm_meta_rel_id or 0)
+        grp_stats.extend(g.stats)
+        grp_names.extend((pool.add(nm), pool.add(attr)) for nm, attr in g.names)
+        stats_offs[i + 1] = len(grp_stats)
+        names_offs[i + 1] = len(grp_names)
+
+    cols = {}
+
+    if osmp.keep_tags:
+        cols.update(raw_columns(osmp, pool))
+
+    blob, str_offs = pool.arrays()
+
+    cols.update({
+        "st_lat": stats.lat,
+        "st_lon": stats.lon,
+        "st_osmnid": stats.osmnid,
+        "st_gid": stats.gid,
+        "st_srctype": stats.srctype,
+        "st_name": str_map[stats.col("name_id")],
+        "st_orig_nd_name": str_map[stats.col("orig_nd_name_id")],
+        "st_name_attr": str_map[stats.col("name_attr_id")],
+        "st_poly_id": stats.col("poly_id"),
+        "poly_offs": stats.poly_offs[:stats.n_polys + 1],
+        "poly_coords": stats.coords[:stats.n_coords],
+        "poly_bboxes": stats.poly_bboxes[:stats.n_polys],
+        "poly_centroids": stats.poly_centroids[:stats.n_polys],
+        "grp_rel_id": rel_id,
+        "grp_meta_rel_id": meta_rel_id,
+        "grp_stats_offs": stats_offs,
+        "grp_stats": np.array(grp_stats, dtype=np.int64),
+        "grp_names_offs": names_offs,
+        "grp_names": np.array(grp_names, dtype=np.int64).reshape((-1, 2)),
+        "str_blob": blob,
+        "str_offs": str_offs,
+        "bounds": np.array(osmp.bounds, dtype=np.float64),
+        "counts": np.array([osmp.num_osm_stats, osmp.num_osm_stat_orphans,
+                            osmp.num_osm_groups, osmp.num_osm_way_polys],
+                           dtype=np.int64),
+        "version": np.array([SNAPSHOT_VERSION], dtype=np.int64),
+        "raw": np.array([osmp.keep_tags], dtype=np.int8),
+    })
+
+    # write to a temporary directory first, so that an interrupted write
+    # never leaves a broken snapshot behind
+    tmp = path + ".tmp%d" % os.getpid()
+    os.makedirs(tmp, exist_ok=True)
+    for col, arr in cols.items():
+        np.save(os.path.join(tmp, col + ".npy"), arr)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+
+
+def tag_columns(prefix, items, pool):
+    '''
+    Columns for a list of (id, tags) items, tags are stored as pairs of
+    string ids
+    '''
+
+    ids = np.zeros(len(items), dtype=np.int64)
+    offs = np.zeros(len(items) + 1, dtype=np.int64)
+    tags = []
+
+    for i, (oid, tgs) in enumerate(items):
+        ids[i] = oid
+        tags.extend((pool.add(attr["k"]), pool.add(attr["v"]))
+                    for attr in tgs)
+        offs[i + 1] = len(tags)
+
+    return {
+        prefix + "_ids": ids,
+        prefix + "_tag_offs": offs,
+        prefix + "_tags": np.array(tags, dtype=np.int64).reshape((-1, 2)),
+    }
+
+
+def raw_columns(osmp, pool):
+    '''
+    Columns for the raw station nodes, group relations and station ways
+    kept by an OsmParser with keep_tags set, needed to apply change files
+    to a snapshot
+    '''
+
+    nds = list(osmp.nd_tags.items())
+    cols = tag_columns("nd", [(nid, t[2]) for nid, t in nds], pool)
+    cols["nd_lat"] = np.array([t[0] for nid, t in nds], dtype=np.float64)
+    cols["nd_lon"] = np.array([t[1] for nid, t in nds], dtype=np.float64)
+
+    rels = list(osmp.rel_tags.items())
+    cols.update(tag_columns("rel", [(rid, t[0]) for rid, t in rels], pool))
+    mem_offs = np.zeros(len(rels) + 1, dtype=np.int64)
+    mem_types = []
+    mem_refs = []
+    for i, (rid, (tags, members)) in enumerate(rels):
+        mem_types.extend(MEMBER_TYPES.index(m["type"]) for m in members)
+        mem_refs.extend(m["ref"] for m in members)
+        mem_offs[i + 1] = len(mem_refs)
+    cols["rel_mem_offs"] = mem_offs
+    cols["rel_mem_types"] = np.array(mem_types, dtype=np.int8)
+    cols["rel_mem_refs"] = np.array(mem_refs, dtype=np.int64)
+
+    names_offs = np.zeros(len(osmp.way_ids) + 1, dtype=np.int64)
+    names = []
+    for i, way_names in enumerate(osmp.way_names):
+        names.extend((pool.add(nm), pool.add(attr)) for nm, attr in way_names)
+        names_offs[i + 1] = len(names)
+    cols["way_ids"] = np.frombuffer(osmp.way_ids, dtype=np.int64)
+    cols["way_offs"] = np.frombuffer(osmp.way_offs, dtype=np.int64)
+    cols["way_refs"] = np.frombuffer(osmp.way_refs, dtype=np.int64)
+    cols["way_names_offs"] = names_offs
+    cols["way_names"] = np.array(names, dtype=np.int64).reshape((-1, 2))
+    cols["way_kept_nds"] = osmp.way_kept_nds
+    cols["way_nd_lons"] = osmp.way_nd_lons
+    cols["way_nd_lats"] = osmp.way_nd_lats
+
+    return cols
+
+
+def read_raw_columns(osmp, col, string):
+    '''
+    Read the raw columns written by raw_columns into osmp
+    '''
+
+    def tags(prefix):
+        offs = col(prefix + "_tag_offs").tolist()
+        tgs = col(prefix + "_tags").tolist()
+        return [[{"k": string(k), "v": string(v)}
+                 for k, v in tgs[offs[i]:offs[i + 1]]]
+                for i in range(len(offs) - 1)]
+
+    nd_tags = tags("nd")
+    for nid, lat, lon, tgs in zip(col("nd_ids").tolist(),
+                                  col("nd_lat").tolist(),
+                                  col("nd_lon").tolist(), nd_tags):
+        osmp.nd_tags[nid] = (lat, lon, tgs)
+
+    rel_tags = tags("rel")
+    mem_offs = col("rel_mem_offs").tolist()
+    mem_types = col("rel_mem_types").tolist()
+    mem_refs = col("rel_mem_refs").tolist()
+    for i, rid in enumerate(col("rel_ids").tolist()):
+        members = [{"type": MEMBER_TYPES[t], "ref": ref} for t, ref in
+                   zip(mem_types[mem_offs[i]:mem_offs[i + 1]],
+                       mem_refs[mem_offs[i]:mem_offs[i + 1]])]
+        osmp.rel_tags[rid] = (rel_tags[i], members)
+
+    names_offs = col("way_names_offs").tolist()
+    names = col("way_names").tolist()
+    osmp.way_ids = array('q', col("way_ids").tolist())
+    osmp.way_offs = array('q', col("way_offs").tolist())
+    osmp.way_refs = array('q', col("way_refs").tolist())
+    osmp.way_names = [[(string(nm), string(attr)) for nm, attr in
+                       names[names_offs[i]:names_offs[i + 1]]]
+                      for i in range(len(names_offs) - 1)]
+    osmp.way_kept_nds = np.array(col("way_kept_nds"))
+    osmp.way_nd_lons = np.array(col("way_nd_lons"))
+    osmp.way_nd_lats = np.array(col("way_nd_lats"))
+
+    osmp.keep_tags = True
+
+
+def read_snapshot(osmp, path):
+    '''
+    Read a snapshot written by write_snapshot into the OsmParser osmp.
+    The columns of the station table and the packed polygons are
+    memory-mapped copy-on-write, pages are only read when used and only
+    copied when written. If osmp already holds stations or groups, the
+    snapshot is read into a new parser and appended by OsmParser.merge(),
+    which remaps the station and group ids.
+
+    >>> import tempfile
+    >>> from statsimi.osm.osm_parser import OsmParser
+    >>> p = OsmParser()
+    >>> p.parse_xml("testdata/test.osm", False, True)
+    >>> d = tempfile.TemporaryDirectory()
+    >>> write_snapshot(p, os.path.join(d.name, "snap"))
+    >>> q = OsmParser()
+    >>> read_snapshot(q, os.path.join(d.name, "snap"))
+    True
+    >>> [str(st) for st in p.stations] == [str(st) for st in q.stations]
+    True
+    >>> [st.poly for st in p.stations] == [st.poly for st in q.stations]
+    True
+    >>> [(g.osm_rel_id, g.osm_meta_rel_id, g.names, g.stats)
+    ...     for g in p.groups] == [(g.osm_rel_id, g.osm_meta_rel_id,
+    ...     g.names, g.stats) for g in q.groups]
+    True
+    >>> p.bounds == q.bounds
+    True
+    >>> p = OsmParser()
+    >>> p.keep_tags = True
+    >>> p.parse_xml("testdata/test.osm", False, True)
+    >>> write_snapshot(p, os.path.join(d.name, "snap"))
+    >>> q = OsmParser()
+    >>> read_snapshot(q, os.path.join(d.name, "snap"))
+    True
+    >>> q.keep_tags, q.nd_tags == p.nd_tags, q.rel_tags == p.rel_tags
+    (True, True, True)
+    >>> q.ways() == p.ways()
+    True
+    >>> r = OsmParser()
+    >>> r.parse_xml("testdata/test.osm", False, True)
+    >>> read_snapshot(r, os.path.join(d.name, "snap"))
+    True
+    >>> [str(g) for g in r.groups] == [str(g) for g in p.groups] * 2
+    True
+    >>> [st.gid for st in r.stations] == [st.gid for st in p.stations] + [
+    ...     st.gid + len(p.groups) for st in p.stations]
+    True
+    >>> r.groups[3].stats[0] == len(p.stations), r.bounds == p.bounds
+    (True, True)
+    >>> r.stations[len(p.stations)].poly == p.stations[0].poly
+    True
+    >>> d.cleanup()
+    '''
+
+    def col(name):
+        return np.load(os.path.join(path, name + ".npy"), mmap_mode='r')
+
+    if col("version")[0] != SNAPSHOT_VERSION:
+        return False
+
+    strings = StringPool.unpack(col("str_blob"), col("str_offs"))
+
+    def string(sid):
+        if sid < 0:
+            return None
+        return strings[sid]
+
+    if len(osmp.stations) or len(osmp.groups):
+        other = type(osmp)(osmp.region)
+        if not read_snapshot(other, path):
+            return False
+        osmp.merge(other)
+        return True
+
+    def cow(name):
+        return np.load(os.path.join(path, name + ".npy"), mmap_mode='c')
+
+    stats = StationTable()
+
+    n = len(col("st_lat"))
+    stats.n = n
+    stats.cap = n
+    stats.strings = strings
+    stats.string_idx = {s: i for i, s in enumerate(strings)}
+
+    stats.cols = {
+        "lat": cow("st_lat"),
+        "lon": cow("st_lon"),
+        "osmnid": cow("st_osmnid"),
+        "gid": cow("st_gid"),
+        "orig_gid": cow("st_gid"),
+        "srctype": cow("st_srctype"),
+        "spice_id": np.full(n, -1, dtype=np.int64),
+        "poly_id": cow("st_poly_id"),
+        "name_id": cow("st_name"),
+        "orig_nd_name_id": cow("st_orig_nd_name"),
+        "name_attr_id": cow("st_name_attr"),
+    }
+
+    stats.poly_offs = cow("poly_offs")
+    stats.coords = cow("poly_coords")
+    stats.poly_bboxes = cow("poly_bboxes")
+    stats.poly_centroids = cow("poly_centroids")
+    stats.n_polys = len(stats.poly_bboxes)
+    stats.n_coords = len(stats.coords)
+
+    osmp.stations = stats
+
+    rel_id = col("grp_rel_id").tolist()
+    meta_rel_id = col("grp_meta_rel_id").tolist()
+    stats_offs = col("grp_stats_offs").tolist()
+    grp_stats = col("grp_stats").tolist()
+    names_offs = col("grp_names_offs").tolist()
+    grp_names = col("grp_names").tolist()
+
+    for i in range(len(rel_id)):
+        g = StatGroup(stations=grp_stats[stats_offs[i]:stats_offs[i + 1]],
+                      osm_rel_id=rel_id[i] or None)
+        if meta_rel_id[i]:
+            g.set_meta_group(str(meta_rel_id[i]))
+        for nm, attr in grp_names[names_offs[i]:names_offs[i + 1]]:
+            g.add_name(string(nm), string(attr))
+        osmp.groups.append(g)
+
+    bounds = col("bounds").tolist()
+    osmp.merge_bounds(bounds[0], bounds[1])
+
+    counts = col("counts").tolist()
+    osmp.num_osm_stats += counts[0]
+    osmp.num_osm_stat_orphans += counts[1]
+    osmp.num_osm_groups += counts[2]
+    osmp.num_osm_way_polys += counts[3]
+
+    if col("raw")[0]:
+        read_raw_columns(osmp, col, string)
+
+    return True
+
+
+class SnapshotCache(object):
+    '''
+    Caches the parse results of OSM input files in a directory. Snapshots are
+    keyed by the content hash of the input files and the parse options.
+    '''
+
+    def __init__(self, cache_dir):
+        self.log = logging.getLogger('snapshot')
+        self.cache_dir = cache_dir
+
+    def file_hash(self, path):
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            while True:
+                buf = f.read(1024 * 1024 * 16)
+                if not buf:
+                    break
+                h.update(buf)
+        return h.hexdigest()
+
+    def key(self, paths, unique=False, with_polygons=False, region=None):
+        '''
+        The snapshot key for the input files paths and the parse options.
+        '''
+        h = hashlib.sha1()
+        for path in paths:
+            h.update(self.file_hash(path).encode("utf-8"))
+        h.update(("%d:%d:%d" % (SNAPSHOT_VERSION, unique,
+                                with_polygons)).encode("utf-8"))
+        if region is not None:
+            h.update(region.key().encode("utf-8"))
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, "osm-" + key)
+
+    def load(self, key, osmp):
+        '''
+        Load the snapshot for key into osmp, return True on a cache hit.
+        '''
+        path = self.path(key)
+        if not os.path.isdir(path):
+            return False
+        self.log.info("Reading parsed stations from snapshot %s..." % path)
+        return read_snapshot(osmp, path)
+
+    def store(self, key, osmp):
+        path = self.path(key)
+        self.log.info("Writing parsed stations to snapshot %s..." % path)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        write_snapshot(osmp, path)
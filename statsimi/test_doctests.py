@@ -1,13 +1,31 @@
 import doctest
 import statsimi.util
 import statsimi.feature.feature_builder
+import statsimi.feature.station_table
+import statsimi.feature.station_idx
+import statsimi.feature.matrix_cache
+import statsimi.feature.distr_recorder
 import statsimi.osm.osm_parser
+import statsimi.osm.pbf
+import statsimi.osm.node_filter
+import statsimi.osm.bz2_reader
+import statsimi.osm.region
+import statsimi.osm.snapshot
 
 
 def load_tests(loader, tests, ignore):
     tests.addTests(doctest.DocTestSuite(statsimi.util))
     tests.addTests(doctest.DocTestSuite(statsimi.feature.feature_builder))
+    tests.addTests(doctest.DocTestSuite(statsimi.feature.station_table))
+    tests.addTests(doctest.DocTestSuite(statsimi.feature.station_idx))
+    tests.addTests(doctest.DocTestSuite(statsimi.feature.matrix_cache))
+    tests.addTests(doctest.DocTestSuite(statsimi.feature.distr_recorder))
     tests.addTests(doctest.DocTestSuite(statsimi.osm.osm_parser))
+    tests.addTests(doctest.DocTestSuite(statsimi.osm.pbf))
+    tests.addTests(doctest.DocTestSuite(statsimi.osm.node_filter))
+    tests.addTests(doctest.DocTestSuite(statsimi.osm.bz2_reader))
+    tests.addTests(doctest.DocTestSuite(statsimi.osm.region))
+    tests.addTests(doctest.DocTestSuite(statsimi.osm.snapshot))
     tests.addTests(doctest.DocTestSuite(statsimi.osm.osm_fixer))
     tests.addTests(doctest.DocTestSuite(statsimi.normalization.normalizer))
     return tests
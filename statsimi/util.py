@@ -9,7 +9,6 @@ import os
 import itertools
 import inspect
 import re
-import sys
 import cutil
 import numpy as np
 from sklearn.metrics import confusion_matrix
@@ -47,7 +46,32 @@ def hav_approx(lon1, lat1, lon2, lat2):
     '''
     return cutil.haversine_approx(lat1, lon1, lat2, lon2)
 
-def hav_approx_poly_stat(poly, lon2, lat2):
+def hav_batch(lons1, lats1, lons2, lats2, approx=True):
+    '''
+    Calculate the great-circle distances in km between arrays of lat/lon
+    pairs, element-wise equal to hav_approx() or, with approx=False, hav()
+
+    >>> import math
+    >>> import numpy as np
+    >>> d = hav_batch(np.array([47.994775, 1.0]), np.array([7.849889, 2.0]),
+    ...     np.array([47.998165, 1.0]), np.array([7.852861, 2.0]))
+    >>> [math.floor(x * 1000) for x in d]
+    [498, 0]
+    >>> bool(d[0] == hav_approx(47.994775, 7.849889, 47.998165, 7.852861))
+    True
+    >>> hav_batch(d[:1] * 0, d[:1] * 0, d[:1] * 0, d[:1] * 0, False).tolist()
+    [0.0]
+    '''
+    out = np.empty(len(lons1), dtype=np.float64)
+    cutil.haversine_batch(
+        np.ascontiguousarray(lats1, dtype=np.float64),
+        np.ascontiguousarray(lons1, dtype=np.float64),
+        np.ascontiguousarray(lats2, dtype=np.float64),
+        np.ascontiguousarray(lons2, dtype=np.float64), out, approx)
+    return out
+
+
+def hav_approx_poly_stat(poly, lon2, lat2, bound=-1):
     '''
     Calculate the great-circle distance in km between two lat/lon pairs
     using the haversine formula, but as an approximation which uses less
@@ -62,10 +86,26 @@ def hav_approx_poly_stat(poly, lon2, lat2):
     >>> import math
     >>> math.floor(hav_approx_poly_stat([(7.828454, 47.997987), (7.829583, 47.997604), (7.830205, 47.998403), ( 7.828977, 47.998751)], 7.830728, 47.997624) * 1000)
     74
+
+    Packed polygons of a StationTable are read from their buffers. With
+    bound >= 0, a lower bound above bound may be returned instead of the
+    distance if the bounding box of the polygon is already that far away.
+
+    >>> from statsimi.feature.station_table import StationTable
+    >>> t = StationTable()
+    >>> _ = t.add("A", poly=[(7.828454, 47.997987), (7.829583, 47.997604), (7.830205, 47.998403), ( 7.828977, 47.998751)])
+    >>> math.floor(hav_approx_poly_stat(t[0].poly, 7.830728, 47.997624) * 1000)
+    74
+    >>> math.floor(hav_approx_poly_stat(t[0].poly, 7.840728, 47.997624) * 1000)
+    787
+    >>> math.floor(hav_approx_poly_stat(t[0].poly, 7.840728, 47.997624, 0.1) * 1000)
+    782
     '''
-    return cutil.hav_approx_poly_stat(lon2, lat2, poly)
+    if isinstance(poly, list):
+        return cutil.hav_approx_poly_stat(lon2, lat2, poly)
+    return cutil.hav_approx_poly_stat_packed(lon2, lat2, *poly.packed(), bound)
 
-def hav_approx_poly_poly(polyA, polyB):
+def hav_approx_poly_poly(polyA, polyB, bound=-1):
     '''
     Calculate the great-circle distance in km between two lat/lon pairs
     using the haversine formula, but as an approximation which uses less
@@ -81,8 +121,19 @@ def hav_approx_poly_poly(polyA, polyB):
     >>> import math
     >>> math.floor(hav_approx_poly_poly([(7.828454, 47.997987), (7.829583, 47.997604), (7.830205, 47.998403), ( 7.828977, 47.998751)], [(7.829726, 47.997436)]) * 1000)
     21
+    >>> from statsimi.feature.station_table import StationTable
+    >>> t = StationTable()
+    >>> _ = t.add("A", poly=[(7.828454, 47.997987), (7.829583, 47.997604), (7.830205, 47.998403), ( 7.828977, 47.998751)])
+    >>> _ = t.add("B", poly=[(7.829726, 47.997436)])
+    >>> math.floor(hav_approx_poly_poly(t[0].poly, t[1].poly) * 1000)
+    21
     '''
-    return cutil.hav_approx_poly_poly(polyA, polyB)
+    if not isinstance(polyA, list) and not isinstance(polyB, list) and \
+            polyA.table is polyB.table:
+        coords, offs, bboxes, pid_a = polyA.packed()
+        return cutil.hav_approx_poly_poly_packed(coords, offs, bboxes, pid_a,
+                                                 polyB.pid, bound)
+    return cutil.hav_approx_poly_poly(list(polyA), list(polyB))
 
 def centroid(poly):
     '''
@@ -90,7 +141,9 @@ def centroid(poly):
     >>> centroid([(7.828454, 47.997987), (7.829583, 47.997604), (7.830205, 47.998403), ( 7.828977, 47.998751)])
     (7.82930475, 47.99818625)
     '''
-    return cutil.centroid(poly)
+    if isinstance(poly, list):
+        return cutil.centroid(poly)
+    return poly.centroid
 
 def poly_contains_point(poly, lon, lat):
     '''
@@ -105,7 +158,7 @@ def poly_contains_point(poly, lon, lat):
     >>> poly_contains_point([(0.0, 0.0), (1.0, 0.0), (1.0, 1.0), (0.0, 1.0)], 0.1, 0)
     True
     '''
-    return cutil.poly_contains_point(lon, lat, poly);
+    return cutil.poly_contains_point(lon, lat, list(poly))
 
 def point_to_segment_hav(lon1, lat1, lon2, lat2, lonP, latP):
     '''
@@ -219,6 +272,12 @@ def ed(s, t):
     0
     >>> ed("", "")
     0
+    >>> ed("a" * 100, "a" * 99 + "b")
+    1
+    >>> ed("ab" * 70, "ba" * 70)
+    2
+    >>> ed("Hauptbahnhof " * 6, "Hbf " * 20)
+    60
     '''
     return cutil.ed(s, t)
 
@@ -285,6 +344,63 @@ def ped(s, t):
     return cutil.ped(s, t)
 
 
+def pack_strings(strings):
+    '''
+    Pack a list of strings into one array of their UCS4 code points and an
+    array of offsets, string i is chars[offs[i]:offs[i + 1]]
+
+    >>> chars, offs = pack_strings(["Hbf", "", "Ü"])
+    >>> chars.tolist(), offs.tolist()
+    ([72, 98, 102, 220], [0, 3, 3, 4])
+    '''
+    buf = "".join(strings).encode("utf-32-le", "surrogatepass")
+    chars = np.frombuffer(buf, dtype="<u4")
+    offs = np.zeros(len(strings) + 1, dtype=np.int64)
+    np.cumsum([len(s) for s in strings], out=offs[1:])
+    return chars, offs
+
+
+def simi_batch(metric, packed, idx1, idx2, out=None, quantize=False):
+    '''
+    Compute the similarities metric ("ed", "ped", "sed", "jaro" or
+    "jaro_winkler") of the string pairs (idx1[i], idx2[i]) of the strings
+    packed by pack_strings(). The edit distances are normalized to
+    similarities in [0, 1] by the length of the longer string (ed) or of the
+    first string (ped, sed). The result is written into out if given,
+    quantized to 0..255 if it is a uint8 array. Otherwise a new float64
+    array is returned, or a uint8 array with quantize=True.
+
+    The metrics "prefix" and "suffix" compute the ed, ped/sed(idx1, idx2)
+    and ped/sed(idx2, idx1) similarities from a single DP and give a row of
+    three values per pair.
+
+    >>> packed = pack_strings(["Hallo", "Hlloa", "Freiburg Hbf", "Hbf"])
+    >>> simi_batch("ed", packed, [0, 2], [1, 3]).tolist()
+    [0.6, 0.25]
+    >>> simi_batch("ed", packed, [0, 2], [1, 3], quantize=True).tolist()
+    [153, 63]
+    >>> out = np.zeros(2, dtype=np.float32)
+    >>> _ = simi_batch("sed", packed, [3, 2], [2, 3], out)
+    >>> out.tolist()
+    [1.0, 0.25]
+    >>> x = simi_batch("jaro_winkler", packed, [0], [1])
+    >>> bool(x[0] == jaro_winkler_simi("Hallo", "Hlloa"))
+    True
+    >>> simi_batch("prefix", packed, [3], [2]).tolist()
+    [[0.25, 0.0, 0.25]]
+    >>> simi_batch("suffix", packed, [3], [2]).tolist()
+    [[0.25, 1.0, 0.25]]
+    '''
+    idx1 = np.ascontiguousarray(idx1, dtype=np.int64)
+    idx2 = np.ascontiguousarray(idx2, dtype=np.int64)
+    if out is None:
+        shape = (len(idx1), 3) if metric in ("prefix", "suffix") else len(idx1)
+        out = np.empty(shape, dtype=np.uint8 if quantize else np.float64)
+    chars, offs = packed
+    getattr(cutil, metric + "_simi_batch")(chars, offs, idx1, idx2, out)
+    return out
+
+
 def jaccard_set(seta, setb):
     '''
     '''
@@ -573,34 +689,101 @@ def pick_args(func, args):
 
 class FileList(object):
     '''
-    Implementation of a list stored in a file, used as a backing
-    for the training matrix.
+    Growable array of w bit integers, used as a backing for the training
+    matrix. Elements are collected in a numpy chunk of chunk_size elements,
+    full chunks are spilled to the file fname. Arrays which never fill a
+    chunk stay in memory and no file is created.
+
+    >>> import tempfile
+    >>> d = tempfile.TemporaryDirectory()
+    >>> fname = os.path.join(d.name, "list")
+    >>> fl = FileList(32, fname, signed=True, chunk_size=4)
+    >>> fl.append(-1)
+    >>> fl.extend(np.arange(5))
+    >>> len(fl), fl.get_mmap().tolist()
+    (6, [-1, 0, 1, 2, 3, 4])
+    >>> type(fl.get_mmap()).__name__
+    'memmap'
+    >>> fl = FileList(8, fname)
+    >>> fl.extend([1, 2])
+    >>> type(fl.get_mmap()).__name__, fl.get_mmap().dtype.name
+    ('ndarray', 'uint8')
+    >>> fl.get_mmap().base is None
+    True
+    >>> os.path.exists(fname)
+    False
+    >>> d.cleanup()
     '''
 
-    def __init__(self, w, fname):
-        self.file = open(fname, "wb", buffering=1024 * 1000 * 100)
-        # write something as we cannot map empty file
+    def __init__(self, w, fname, signed=False, chunk_size=1 << 22):
         self.fname = fname
+        self.file = None
         self.size = 0
         self.w = -(-w // 8)
-        self.file.write((0).to_bytes(self.w, byteorder=sys.byteorder))
-        self.file.seek(0)
+        self.dtype = np.dtype(("i" if signed else "u") + str(self.w))
+        self.chunk = np.empty(chunk_size, dtype=self.dtype)
+        # number of elements in the chunk
+        self.n = 0
 
     def __del__(self):
-        if not self.file.closed:
-            self.file.close()
-        os.remove(self.fname)
+        if self.file is not None:
+            if not self.file.closed:
+                self.file.close()
+            os.remove(self.fname)
 
     def __len__(self):
         return self.size
 
     def append(self, i):
-        self.file.write((i).to_bytes(self.w, byteorder=sys.byteorder))
+        self.chunk[self.n] = i
+        self.n += 1
         self.size += 1
+        if self.n == len(self.chunk):
+            self.spill()
+
+    def extend(self, arr):
+        '''
+        Append all elements of the integer array arr
+        '''
+        arr = np.asarray(arr)
+        self.size += len(arr)
+
+        while len(arr):
+            if self.n == 0 and len(arr) >= len(self.chunk):
+                # write whole chunks directly from arr
+                k = len(arr) - len(arr) % len(self.chunk)
+                self.write(arr[:k].astype(self.dtype, copy=False))
+                arr = arr[k:]
+                continue
+
+            k = min(len(arr), len(self.chunk) - self.n)
+            self.chunk[self.n:self.n + k] = arr[:k]
+            self.n += k
+            arr = arr[k:]
+            if self.n == len(self.chunk):
+                self.spill()
+
+    def spill(self):
+        '''
+        Write the elements of the chunk to the file
+        '''
+        self.write(self.chunk[:self.n])
+        self.n = 0
+
+    def write(self, arr):
+        if self.file is None:
+            self.file = open(self.fname, "wb")
+        self.file.write(arr.data)
 
     def get_mmap(self):
+        '''
+        Return all elements as a numpy array, memory-mapped from the file if
+        they did not fit into a single chunk. Otherwise a trimmed copy is
+        returned, so the result does not pin the whole chunk.
+        '''
+        if self.file is None:
+            return self.chunk[:self.n].copy()
+        self.spill()
         self.file.flush()
-        os.fsync(self.file)
-        code = (sys.byteorder == 'little') and '<' or '>'
-        return np.memmap(self.fname, dtype=code + "u" +
-                         str(self.w), mode='r', shape=(self.size))
+        return np.memmap(self.fname, dtype=self.dtype, mode='r',
+                         shape=(self.size))